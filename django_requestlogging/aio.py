@@ -0,0 +1,76 @@
+# -*- mode: django; coding: utf-8 -*-
+#
+# Copyright © 2011, TrustCentric
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of TrustCentric nor the names of its contributors
+#       may be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Asynchronous support
+````````````````````
+
+Coroutine counterparts used by :class:`.middleware.LogSetupMiddleware`
+when it is mounted in an ASGI stack. This module needs Python 3.5 or
+later, so it is imported conditionally.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import asyncio
+
+try:
+    from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+except ImportError:  # asgiref < 3.6
+    iscoroutinefunction = asyncio.iscoroutinefunction
+
+    def markcoroutinefunction(func):
+        func._is_coroutine = asyncio.coroutines._is_coroutine
+        return func
+
+
+async def acall(middleware, request):
+    """
+    Runs *middleware* around an awaitable ``get_response``.
+
+    Binding and unbinding never block, so they run inline on the event
+    loop instead of being handed to a worker thread. The binding is
+    visible to the awaited view and, in ``'context'`` binding mode, to
+    any task it creates.
+    """
+    response = middleware.process_request(request)
+    if not response:
+        response = await middleware.get_response(request)
+    response = middleware.process_response(request, response)
+    return response
+
+
+async def aiter_access(middleware, request, response, content):
+    """Async counterpart of :meth:`.LogSetupMiddleware.iter_access`."""
+    size = 0
+    try:
+        async for chunk in content:
+            size += len(chunk)
+            yield chunk
+    finally:
+        middleware.log_access(request, response, size)
@@ -0,0 +1,398 @@
+# -*- mode: django; coding: utf-8 -*-
+#
+# Copyright © 2011, TrustCentric
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of TrustCentric nor the names of its contributors
+#       may be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+``analytics``
+-------------
+
+Offline analysis of request-enriched logs, as written by
+:class:`.formatters.JSONFormatter` or by a :class:`logging.Formatter`
+format string. Used by the ``analyze_request_logs`` management command.
+
+Files are streamed line by line, and everything kept per endpoint is
+bounded: latencies go into a :class:`Sketch` rather than a list, the
+busiest clients are tracked with a :class:`TopK` and endpoints beyond
+``max_endpoints`` are counted together as ``(other)``. Files can be
+split into byte ranges analysed by separate processes, whose
+:class:`Stats` are then merged.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import io
+import json
+import math
+import multiprocessing
+import os
+import re
+from collections import OrderedDict
+
+import six
+
+#: The key of the endpoints counted together once there are too many.
+OTHER = "(other)"
+
+FORMAT_FIELD_RE = re.compile(r"%\((\w+)\)[-#0 +]*\d*(?:\.\d+)?[a-zA-Z]")
+
+
+class Sketch(object):
+    """
+    A mergeable sketch of a distribution of positive values, whose
+    quantiles are within a relative *accuracy* of the true ones.
+
+    Values are counted in buckets whose bounds grow geometrically, as in
+    DDSketch and HDR histograms, so its size depends on the range of the
+    values rather than on how many there are.
+    """
+
+    def __init__(self, accuracy=0.01):
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if value <= 0:
+            self.zeros += 1
+            return
+        key = int(math.ceil(math.log(value) / self.log_gamma))
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+
+    def merge(self, other):
+        for key, count in six.iteritems(other.buckets):
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+
+    def quantile(self, q):
+        """Returns the *q* quantile (from 0 to 1), or ``None`` if empty."""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if rank < seen:
+                return 2 * self.gamma**key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+
+class TopK(object):
+    """
+    Approximate counts of the *size* most frequent keys, using the
+    Space-Saving algorithm: a new key replaces the least frequent one and
+    inherits its count, so counts are overestimated by at most that.
+    """
+
+    def __init__(self, size=100):
+        self.size = size
+        self.counts = {}
+
+    def add(self, key, count=1):
+        counts = self.counts
+        if key in counts or len(counts) < self.size:
+            counts[key] = counts.get(key, 0) + count
+        else:
+            least = min(counts, key=counts.get)
+            counts[key] = counts.pop(least) + count
+
+    def merge(self, other):
+        for key, count in six.iteritems(other.counts):
+            self.counts[key] = self.counts.get(key, 0) + count
+        if len(self.counts) > self.size:
+            self.counts = dict(self.most_common(self.size))
+
+    def most_common(self, n=None):
+        return sorted(six.iteritems(self.counts), key=lambda item: (-item[1], item[0]))[
+            :n
+        ]
+
+
+class EndpointStats(object):
+    """The records, errors and latencies of one endpoint."""
+
+    def __init__(self, accuracy=0.01):
+        self.count = 0
+        self.errors = 0
+        self.latency = Sketch(accuracy)
+
+    def merge(self, other):
+        self.count += other.count
+        self.errors += other.errors
+        self.latency.merge(other.latency)
+
+
+class Tally(object):
+    """The :class:`EndpointStats` by endpoint, and the busiest clients."""
+
+    def __init__(self, max_endpoints, top, accuracy):
+        self.max_endpoints = max_endpoints
+        self.accuracy = accuracy
+        self.endpoints = {}
+        self.remote_addrs = TopK(top)
+
+    def endpoint(self, key):
+        stats = self.endpoints.get(key)
+        if stats is None:
+            if len(self.endpoints) >= self.max_endpoints:
+                key = OTHER
+                stats = self.endpoints.get(key)
+            if stats is None:
+                stats = self.endpoints[key] = EndpointStats(self.accuracy)
+        return stats
+
+    def merge(self, other):
+        for key, stats in six.iteritems(other.endpoints):
+            self.endpoint(key).merge(stats)
+        self.remote_addrs.merge(other.remote_addrs)
+
+
+class Stats(object):
+    """
+    Statistics over log records, by endpoint (``request_method`` and
+    ``path_info``) and ``remote_addr``.
+
+    Records with a ``status_code``, as logged by the access log, are
+    tallied apart from the others. If there are any, only they are
+    reported, so that the other records logged during a request neither
+    count as requests nor dilute the error rate. Otherwise every record
+    counts, and is an error if it was logged at ``ERROR`` or above. An
+    access record is an error if its ``status_code`` is 500 or more.
+    Latencies are taken from ``duration_ms``.
+    """
+
+    def __init__(self, max_endpoints=1000, top=100, accuracy=0.01):
+        self.access = Tally(max_endpoints, top, accuracy)
+        self.other = Tally(max_endpoints, top, accuracy)
+        self.records = 0
+        self.skipped = 0
+
+    @property
+    def reported(self):
+        """The :class:`Tally` that is reported."""
+        return self.access if self.access.endpoints else self.other
+
+    @property
+    def endpoints(self):
+        return self.reported.endpoints
+
+    @property
+    def remote_addrs(self):
+        return self.reported.remote_addrs
+
+    def add(self, fields):
+        """Counts a record with the given :class:`dict` of *fields*."""
+        path = fields.get("path_info")
+        if not path or path == "-":
+            self.skipped += 1
+            return
+        self.records += 1
+        status = to_number(fields.get("status_code"))
+        if status is not None:
+            tally = self.access
+            error = status >= 500
+        else:
+            tally = self.other
+            error = fields.get("levelname") in ("ERROR", "CRITICAL")
+        stats = tally.endpoint("%s %s" % (fields.get("request_method", "-"), path))
+        stats.count += 1
+        if error:
+            stats.errors += 1
+        duration = to_number(fields.get("duration_ms"))
+        if duration is not None:
+            stats.latency.add(duration)
+        remote_addr = fields.get("remote_addr")
+        if remote_addr and remote_addr != "-":
+            tally.remote_addrs.add(remote_addr)
+
+    def merge(self, other):
+        self.records += other.records
+        self.skipped += other.skipped
+        self.access.merge(other.access)
+        self.other.merge(other.other)
+
+    def as_dict(self, percentiles=(50, 90, 99), top=None):
+        """Returns the statistics, busiest first, *e.g.* for JSON."""
+        endpoints = []
+        for key, stats in sorted(
+            six.iteritems(self.endpoints), key=lambda item: (-item[1].count, item[0])
+        )[:top]:
+            endpoint = OrderedDict(
+                [
+                    ("endpoint", key),
+                    ("count", stats.count),
+                    ("errors", stats.errors),
+                    ("error_rate", stats.errors / float(stats.count)),
+                ]
+            )
+            for p in percentiles:
+                endpoint["p%g_ms" % p] = stats.latency.quantile(p / 100.0)
+            endpoints.append(endpoint)
+        remote_addrs = [
+            OrderedDict([("remote_addr", remote_addr), ("count", count)])
+            for remote_addr, count in self.remote_addrs.most_common(top)
+        ]
+        return OrderedDict(
+            [
+                ("records", self.records),
+                ("skipped", self.skipped),
+                ("endpoints", endpoints),
+                ("remote_addrs", remote_addrs),
+            ]
+        )
+
+
+def to_number(value):
+    if value is None or isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_json(line):
+    """Returns the fields of a JSON log *line*, or ``None``."""
+    try:
+        fields = json.loads(line.decode("utf-8"))
+    except ValueError:
+        return None
+    return fields if isinstance(fields, dict) else None
+
+
+def format_parser(fmt):
+    """
+    Returns a function that parses a line written with the
+    :class:`logging.Formatter` format string *fmt* into its fields, or
+    returns ``None`` if the line does not match.
+    """
+    pattern = []
+    names = set()
+    position = 0
+    for match in FORMAT_FIELD_RE.finditer(fmt):
+        literal = fmt[position : match.start()]
+        pattern.append(re.escape(literal))
+        name = match.group(1)
+        pattern.append(".*?" if name in names else "(?P<%s>.*?)" % name)
+        names.add(name)
+        position = match.end()
+    pattern.append(re.escape(fmt[position:]) + r"\r?\n?$")
+    regex = re.compile("^" + "".join(pattern))
+
+    def parse(line):
+        match = regex.match(line.decode("utf-8", "replace"))
+        return match.groupdict() if match else None
+
+    return parse
+
+
+def iter_lines(path, start=0, end=None, buffer_size=1 << 20):
+    """
+    Yields the lines of the file at *path* that start within the byte
+    range [*start*, *end*).
+    """
+    with io.open(path, "rb", buffering=buffer_size) as f:
+        position = start
+        if start:
+            # The line running over start belongs to the range before.
+            f.seek(start - 1)
+            position += len(f.readline()) - 1
+        for line in f:
+            if end is not None and position >= end:
+                break
+            position += len(line)
+            yield line
+
+
+def analyze_lines(lines, parse=None, stats=None, **kwargs):
+    """
+    Adds the records in *lines* to *stats* (a new :class:`Stats` made with
+    *kwargs* by default), parsing them with *parse*, or as JSON if
+    ``None``. Returns *stats*.
+    """
+    if stats is None:
+        stats = Stats(**kwargs)
+    parse = parse or parse_json
+    for line in lines:
+        if not line.strip():
+            continue
+        fields = parse(line)
+        if fields is None:
+            stats.skipped += 1
+        else:
+            stats.add(fields)
+    return stats
+
+
+def _analyze_range(job):
+    path, start, end, fmt, kwargs = job
+    parse = format_parser(fmt) if fmt else None
+    return analyze_lines(iter_lines(path, start, end), parse, **kwargs)
+
+
+def split_ranges(path, parts):
+    """Splits the file at *path* into *parts* byte ranges."""
+    size = os.path.getsize(path)
+    step = max(1, -(-size // parts))
+    return [(start, min(start + step, size)) for start in range(0, size, step)] or [
+        (0, 0)
+    ]
+
+
+def analyze(paths, fmt=None, processes=1, **kwargs):
+    """
+    Returns the :class:`Stats` (made with *kwargs*) of the log files at
+    *paths*, written as JSON lines or with the format string *fmt*.
+
+    With more than one of *processes*, each file is split into that many
+    byte ranges, which are analysed in parallel.
+    """
+    jobs = [
+        (path, start, end, fmt, kwargs)
+        for path in paths
+        for start, end in (
+            split_ranges(path, processes) if processes > 1 else [(0, None)]
+        )
+    ]
+    stats = Stats(**kwargs)
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            for result in pool.imap_unordered(_analyze_range, jobs):
+                stats.merge(result)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for job in jobs:
+            stats.merge(_analyze_range(job))
+    return stats
@@ -0,0 +1,74 @@
+# -*- mode: django; coding: utf-8 -*-
+#
+# Copyright © 2011, TrustCentric
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of TrustCentric nor the names of its contributors
+#       may be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+``apps``
+--------
+
+Application configuration for :mod:`django_requestlogging`.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+from django.apps import AppConfig
+from django.conf import settings
+from django.core import checks
+
+
+class RequestLoggingConfig(AppConfig):
+    """
+    Checks the logging configuration once the apps are loaded.
+
+    Compiles ``REQUESTLOGGING_FIELDS`` and, with ``'filters'`` binding,
+    finds the loggers and handlers that carry an unbound
+    :class:`.logging_filters.RequestFilter`, so that configuration
+    mistakes raise at startup and the first request does not pay for the
+    discovery. Resolves the target names of forwarding handlers; see
+    :class:`.handlers.TargetHandlersMixin`. Registers
+    :func:`.checks.check_request_fields`.
+    """
+
+    name = "django_requestlogging"
+    verbose_name = "Request logging"
+
+    def ready(self):
+        from .checks import check_request_fields
+        from .logging_filters import get_field_extractor
+        from .middleware import BINDING_CONTEXT, BINDING_FILTERS, build_filterer_index
+
+        checks.register(check_request_fields)
+        get_field_extractor()
+        binding = getattr(settings, "REQUESTLOGGING_BINDING", BINDING_CONTEXT)
+        if binding == BINDING_FILTERS:
+            build_filterer_index()
+        try:
+            from .handlers import resolve_forwarding_handlers
+        except (ImportError, SyntaxError):  # Python 2
+            pass
+        else:
+            resolve_forwarding_handlers()
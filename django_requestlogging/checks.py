@@ -0,0 +1,135 @@
+# -*- mode: django; coding: utf-8 -*-
+#
+# Copyright © 2011, TrustCentric
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of TrustCentric nor the names of its contributors
+#       may be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+``checks``
+----------
+
+System checks for the logging configuration.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import re
+
+import six
+from django.conf import settings
+from django.core import checks
+
+from .logging_filters import RequestFilter, request_field_names
+
+# The fields a format string refers to, by formatting style.
+FORMAT_FIELD_RES = {
+    "%": re.compile(r"%\((\w+)\)"),
+    "{": re.compile(r"{(\w+)"),
+    "$": re.compile(r"\${?(\w+)"),
+}
+
+
+def formatter_fields(formatter):
+    """Returns the names of the record attributes *formatter* uses."""
+    fields = getattr(formatter, "fields", None)
+    if fields is not None:
+        return set(fields)
+    style = getattr(formatter, "_style", None)
+    fmt = getattr(style, "_fmt", None) or getattr(formatter, "_fmt", None) or ""
+    style_char = {
+        "StrFormatStyle": "{",
+        "StringTemplateStyle": "$",
+    }.get(type(style).__name__, "%")
+    return set(FORMAT_FIELD_RES[style_char].findall(fmt))
+
+
+def has_request_filter(filterer):
+    return any(isinstance(f, RequestFilter) for f in filterer.filters)
+
+
+def get_loggers():
+    """Returns every logger, including the root logger."""
+    with logging._lock:
+        loggers = list(six.itervalues(logging.Logger.manager.loggerDict))
+    return [logger for logger in loggers if isinstance(logger, logging.Logger)] + [
+        logging.getLogger()
+    ]
+
+
+def get_handlers():
+    """Returns every live handler."""
+    with logging._lock:
+        refs = list(logging._handlerList)
+    return [handler for handler in (ref() for ref in refs) if handler is not None]
+
+
+def check_request_fields(app_configs=None, **kwargs):
+    """
+    Warns about handlers whose formatter uses request fields that no
+    :class:`.logging_filters.RequestFilter` will set.
+
+    A handler is covered if it has the filter itself, if every logger it
+    is attached to has the filter, or if it is a target of a covered
+    handler such as :class:`.handlers.QueueHandler`. Nothing needs the
+    filter with the ``'factory'`` binding.
+    """
+    if getattr(settings, "REQUESTLOGGING_BINDING", None) == "factory":
+        return []
+    request_fields = set(request_field_names())
+    handlers = get_handlers()
+    owners = {}
+    for logger in get_loggers():
+        for handler in logger.handlers:
+            owners.setdefault(handler, []).append(logger)
+    covered = set()
+    for handler in handlers:
+        loggers = owners.get(handler, ())
+        if has_request_filter(handler) or (
+            loggers and all(map(has_request_filter, loggers))
+        ):
+            covered.add(handler)
+    # Handlers that pass records on to others cover their targets
+    for handler in list(covered):
+        if hasattr(handler, "get_handlers"):
+            try:
+                covered.update(handler.get_handlers())
+            except ValueError:
+                continue
+    warnings = []
+    for handler in handlers:
+        used = formatter_fields(handler.formatter) & request_fields
+        if not used or handler in covered:
+            continue
+        warnings.append(
+            checks.Warning(
+                "Logging handler %r formats request fields (%s) but has no RequestFilter."
+                % (handler.get_name() or handler, ", ".join(sorted(used))),
+                hint="Add an unbound django_requestlogging.logging_filters.RequestFilter to its 'filters'.",
+                obj=handler.get_name() or handler,
+                id="django_requestlogging.W001",
+            )
+        )
+    return warnings
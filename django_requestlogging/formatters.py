@@ -0,0 +1,139 @@
+# -*- mode: django; coding: utf-8 -*-
+#
+# Copyright © 2011, TrustCentric
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of TrustCentric nor the names of its contributors
+#       may be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+``formatters``
+--------------
+
+Formatters for records enriched by :class:`~.logging_filters.RequestFilter`.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import operator
+
+import six
+
+from .logging_filters import REQUEST_FIELDS, request_field_names
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+
+    # ``default`` was added in ujson 5.4
+    ujson.dumps(None, default=six.text_type)
+except (ImportError, TypeError):
+    ujson = None
+
+
+if orjson is not None:
+
+    def json_dumps(obj):
+        """Serializes *obj* to a compact JSON string."""
+        return orjson.dumps(obj, default=six.text_type).decode("utf-8")
+
+elif ujson is not None:
+
+    def json_dumps(obj):
+        """Serializes *obj* to a compact JSON string."""
+        return ujson.dumps(obj, ensure_ascii=False, default=six.text_type)
+
+else:
+    import json
+
+    json_dumps = json.JSONEncoder(
+        ensure_ascii=False, separators=(",", ":"), default=six.text_type
+    ).encode
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats each record as a single-line JSON object.
+
+    :param fields: The record attributes to include, in order. Defaults
+        to :attr:`DEFAULT_FIELDS` plus any fields configured with
+        ``REQUESTLOGGING_FIELDS``. ``message`` and ``asctime`` are computed
+        as they are by :class:`logging.Formatter`.
+    :param datefmt: The :func:`time.strftime` format for ``asctime``.
+
+    Attributes missing from a record, *e.g.* the request fields of a
+    record that never passed through a
+    :class:`~.logging_filters.RequestFilter`, are written as ``null``.
+    Exception and stack information are added as ``exc_info`` and
+    ``stack_info`` when present.
+
+    The attributes are fetched with a single prebuilt
+    :func:`operator.attrgetter`, and the fastest available encoder is
+    used: :mod:`orjson`, then :mod:`ujson`, then :mod:`json`. To use it
+    with :data:`settings.LOGGING`::
+
+       'formatters': {
+           'json': {
+               '()': 'django_requestlogging.formatters.JSONFormatter',
+           },
+       },
+    """
+
+    DEFAULT_FIELDS = ("created", "levelname", "name", "message") + REQUEST_FIELDS
+
+    def __init__(self, fields=None, datefmt=None):
+        super(JSONFormatter, self).__init__(datefmt=datefmt)
+        if not fields:
+            fields = self.DEFAULT_FIELDS + request_field_names()[len(REQUEST_FIELDS) :]
+        self.fields = tuple(fields)
+        self.uses_asctime = "asctime" in self.fields
+        getter = operator.attrgetter(*self.fields)
+        if len(self.fields) == 1:
+            self._get_values = lambda record: (getter(record),)
+        else:
+            self._get_values = getter
+
+    def get_values(self, record):
+        """Returns the values of :attr:`fields` on *record*."""
+        try:
+            return self._get_values(record)
+        except AttributeError:
+            return tuple(getattr(record, field, None) for field in self.fields)
+
+    def format(self, record):
+        record.message = record.getMessage()
+        if self.uses_asctime:
+            record.asctime = self.formatTime(record, self.datefmt)
+        obj = dict(zip(self.fields, self.get_values(record)))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            obj["exc_info"] = record.exc_text
+        if getattr(record, "stack_info", None):
+            obj["stack_info"] = self.formatStack(record.stack_info)
+        return json_dumps(obj)
@@ -0,0 +1,1295 @@
+# -*- mode: django; coding: utf-8 -*-
+#
+# Copyright © 2011, TrustCentric
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of TrustCentric nor the names of its contributors
+#       may be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+``handlers``
+------------
+
+Logging handlers suited to request logging. Requires Python 3.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import atexit
+import calendar
+import copy
+import gzip
+import io
+import logging
+import logging.handlers
+import os
+import re
+import select
+import shutil
+import socket
+import struct
+import sys
+import threading
+import time
+import traceback
+import weakref
+from collections import OrderedDict
+
+from six.moves import queue
+
+from .formatters import JSONFormatter
+from .logging_filters import add_request_finalizer, get_current_request, materialize
+from .metrics import queue_handlers
+from .segments import encode_entry
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+#: Wait for space in the queue.
+BLOCK = "block"
+#: Discard the oldest queued record to make space.
+DROP_OLDEST = "drop_oldest"
+#: Discard the record being logged.
+DROP_NEWEST = "drop_newest"
+
+
+def resolve_handlers(handlers, configured=None):
+    """
+    Returns *handlers*, looking up any names among *configured*, a
+    :class:`dict` of handlers, or else among the configured handlers.
+    """
+    resolved = []
+    for handler in handlers:
+        if not isinstance(handler, logging.Handler):
+            target = configured.get(handler) if configured is not None else None
+            if not isinstance(target, logging.Handler):
+                target = logging._handlers.get(handler)
+            if target is None:
+                raise ValueError("Unknown handler %r" % handler)
+            handler = target
+        resolved.append(handler)
+    return resolved
+
+
+def resolve_forwarding_handlers():
+    """
+    Resolves the target names of every forwarding handler.
+
+    Called by :class:`.apps.RequestLoggingConfig` once logging is
+    configured, so that unknown names raise at startup.
+    """
+    for ref in list(logging._handlerList):
+        handler = ref()
+        if isinstance(handler, TargetHandlersMixin):
+            handler.get_handlers()
+
+
+class TargetHandlersMixin(object):
+    """
+    Keeps the target *handlers* of a handler that forwards records, given
+    as handlers or names of handlers configured in :data:`settings.LOGGING`,
+    and resolves the names the first time they are needed.
+
+    :data:`logging._handlers` only holds weak references, so a target that
+    no logger uses is collected once :func:`logging.config.dictConfig` is
+    done. The list of names that ``dictConfig`` passes refers back to the
+    configuration being applied, which holds the handlers configured from
+    it, so that is kept until the names are resolved.
+    """
+
+    def set_handlers(self, handlers):
+        self.handlers = list(handlers)
+        self._configurator = getattr(handlers, "configurator", None)
+
+    def get_handlers(self):
+        """Returns the target handlers, resolving any names once."""
+        configurator = self._configurator
+        if configurator is not None or not all(
+            isinstance(h, logging.Handler) for h in self.handlers
+        ):
+            configured = (
+                configurator.config.get("handlers")
+                if configurator is not None
+                else None
+            )
+            self.handlers = resolve_handlers(self.handlers, configured)
+            self._configurator = None
+        return list(self.handlers)
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # The stock listener uses put_nowait(), which fails on a full queue.
+        self.queue.put(self._sentinel)
+
+
+class QueueHandler(TargetHandlersMixin, logging.handlers.QueueHandler):
+    """
+    Hands records to a background thread, which passes them to *handlers*.
+
+    :param handlers: The handlers, or names of handlers configured in
+        :data:`settings.LOGGING`, that do the actual I/O.
+    :param maxsize: The maximum number of queued records; ``0`` means
+        unbounded.
+    :param policy: What to do when the queue is full: :data:`BLOCK`,
+        :data:`DROP_OLDEST` or :data:`DROP_NEWEST`.
+    :param respect_handler_level: Whether the background thread honours
+        the level of each of *handlers*.
+
+    The request fields are materialized onto each record before it is
+    queued, since the request is gone by the time the background thread
+    formats it. Discarded records are counted in :attr:`dropped`, and
+    reported with the queue depth by :class:`.metrics.Metrics`.
+
+    The background thread is started by the first record and stopped at
+    exit. In :data:`settings.LOGGING`::
+
+       'handlers': {
+           'file': {
+               'class': 'logging.FileHandler',
+               'filename': 'requests.log',
+               'formatter': 'request_format',
+           },
+           'queue': {
+               '()': 'django_requestlogging.handlers.QueueHandler',
+               'handlers': ['file'],
+               'maxsize': 10000,
+               'policy': 'drop_oldest',
+               'filters': ['request'],
+           },
+       },
+    """
+
+    POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+    def __init__(
+        self, handlers=(), maxsize=10000, policy=BLOCK, respect_handler_level=True
+    ):
+        if policy not in self.POLICIES:
+            raise ValueError(
+                "policy must be one of %s, not %r" % (", ".join(self.POLICIES), policy)
+            )
+        super(QueueHandler, self).__init__(queue.Queue(maxsize))
+        self.set_handlers(handlers)
+        self.policy = policy
+        self.respect_handler_level = respect_handler_level
+        self.dropped = 0
+        self.listener = None
+        self._lock = threading.Lock()
+        queue_handlers.add(self)
+
+    def start(self):
+        """Starts the background thread, if it is not running already."""
+        with self._lock:
+            if self.listener is None:
+                listener = _QueueListener(
+                    self.queue,
+                    *self.get_handlers(),
+                    respect_handler_level=self.respect_handler_level
+                )
+                listener.start()
+                atexit.register(self.stop)
+                self.listener = listener
+
+    def stop(self):
+        """Processes the queued records and stops the background thread."""
+        with self._lock:
+            listener, self.listener = self.listener, None
+        if listener is not None:
+            listener.stop()
+
+    def close(self):
+        self.stop()
+        super(QueueHandler, self).close()
+
+    def prepare(self, record):
+        return materialize(super(QueueHandler, self).prepare(record))
+
+    def enqueue(self, record):
+        if self.listener is None:
+            self.start()
+        if self.policy == BLOCK:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if self.policy == DROP_NEWEST:
+                self._drop()
+                return
+            self._put_dropping_oldest(record)
+
+    def _put_dropping_oldest(self, record):
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            else:
+                self._drop()
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                continue
+
+    def _drop(self):
+        with self._lock:
+            self.dropped += 1
+
+
+class ForwardingHandler(TargetHandlersMixin, logging.Handler):
+    """
+    Base class for handlers that pass records on to other *handlers*,
+    given as handlers or names of handlers configured in
+    :data:`settings.LOGGING`.
+    """
+
+    def __init__(self, handlers=()):
+        super(ForwardingHandler, self).__init__()
+        self.set_handlers(handlers)
+
+    def dispatch(self, records):
+        """Passes *records* to each target handler whose level they meet."""
+        for handler in self.get_handlers():
+            for record in records:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+
+class RequestBufferHandler(ForwardingHandler):
+    """
+    Holds the records of each request back until it is complete, then
+    passes them to *handlers*.
+
+    :param handlers: The handlers, or names of handlers configured in
+        :data:`settings.LOGGING`, that the records are passed to.
+    :param discard_level: Records at or below this level are discarded
+        when the request succeeds.
+    :param flush_level: A record at or above this level keeps every
+        record of its request, as does a server error or an exception.
+    :param latency_ms: If set, every record of a request that took at
+        least this long is kept.
+    :param combine: Whether to pass on the kept records of a request as a
+        single record; see :meth:`combine`.
+
+    Records are buffered in ``request.logging_buffer``, which
+    :class:`.middleware.LogSetupMiddleware` only sets up with
+    ``REQUESTLOGGING_BUFFER = True`` (or *buffer*), and are flushed by the
+    middleware when the response or exception is processed. Records
+    logged outside a request are passed on at once. This way DEBUG
+    records cost next to nothing unless their request fails or is slow,
+    when all of them are written::
+
+       'handlers': {
+           'debug': {
+               '()': 'django_requestlogging.handlers.RequestBufferHandler',
+               'handlers': ['file'],
+               'latency_ms': 1000,
+               'filters': ['request'],
+           },
+       },
+    """
+
+    #: The message of a combined record.
+    COMBINED_MESSAGE = "%d records"
+
+    def __init__(
+        self,
+        handlers=(),
+        discard_level=logging.DEBUG,
+        flush_level=logging.ERROR,
+        latency_ms=None,
+        combine=False,
+    ):
+        super(RequestBufferHandler, self).__init__(handlers)
+        self.discard_level = discard_level
+        self.flush_level = flush_level
+        self.latency_ms = latency_ms
+        self.combine_records = combine
+
+    def emit(self, record):
+        buffer = getattr(get_current_request(), "logging_buffer", None)
+        if buffer is None:
+            self.dispatch([record])
+        else:
+            buffer.append(self, record)
+
+    def flush_request(self, records, failed, duration_ms):
+        """
+        Passes on the buffered *records* of a request that took
+        *duration_ms* and, if *failed*, ended in an error.
+        """
+        keep_all = (
+            failed
+            or (self.latency_ms is not None and duration_ms >= self.latency_ms)
+            or any(record.levelno >= self.flush_level for record in records)
+        )
+        if not keep_all:
+            records = [
+                record for record in records if record.levelno > self.discard_level
+            ]
+        if records and self.combine_records:
+            records = [self.combine(records)]
+        self.dispatch(records)
+
+    def combine(self, records):
+        """
+        Returns one record standing for *records*, which carries the
+        request fields and level of the most severe of them, and a
+        ``records`` attribute listing the ``created``, ``levelname``,
+        ``name`` and ``message`` of each.
+        """
+        worst = max(records, key=lambda record: record.levelno)
+        events = []
+        for record in records:
+            event = {
+                "created": record.created,
+                "levelname": record.levelname,
+                "name": record.name,
+                "message": record.getMessage(),
+            }
+            if record.exc_info and not record.exc_text:
+                record.exc_text = (
+                    self.formatter or logging._defaultFormatter
+                ).formatException(record.exc_info)
+            if record.exc_text:
+                event["exc_text"] = record.exc_text
+            events.append(event)
+        attrs = dict(materialize(worst).__dict__)
+        attrs.update(
+            msg=self.COMBINED_MESSAGE,
+            args=(len(records),),
+            exc_info=None,
+            exc_text=None,
+            stack_info=None,
+            records=events,
+        )
+        attrs.pop("message", None)
+        return logging.makeLogRecord(attrs)
+
+
+class _Flusher(object):
+    r"""
+    A daemon thread that flushes the :class:`BufferedFileHandler`\ s whose
+    buffers have waited for their ``flush_interval``, so that records are
+    written even if no further record is logged.
+    """
+
+    def __init__(self):
+        self.handlers = weakref.WeakSet()
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def add(self, handler):
+        with self.lock:
+            self.handlers.add(handler)
+
+    def discard(self, handler):
+        with self.lock:
+            self.handlers.discard(handler)
+
+    def start(self):
+        """Starts the thread in this process, if it is not running already."""
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                thread = threading.Thread(
+                    target=self.run, name="BufferedFileHandler flusher"
+                )
+                thread.daemon = True
+                thread.start()
+
+    def run(self):
+        while True:
+            with self.lock:
+                handlers = list(self.handlers)
+                if not handlers:
+                    self.pid = None
+                    return
+            now = time.time()
+            wakeup = now + min(1.0, min(handler.flush_interval for handler in handlers))
+            for handler in handlers:
+                if not handler.buffered:
+                    continue
+                due = handler.last_flush + handler.flush_interval
+                if due <= now:
+                    handler.flush()
+                else:
+                    wakeup = min(wakeup, due)
+            time.sleep(max(0.05, wakeup - now))
+
+
+_flusher = _Flusher()
+if hasattr(os, "register_at_fork"):
+    # The thread does not survive a fork, and its lock may be held.
+    os.register_at_fork(after_in_child=_flusher.reset)
+
+
+class BufferedFileHandler(logging.Handler):
+    """
+    The base of the handlers that buffer formatted records and write them
+    to a file with one system call.
+
+    :param buffer_size: Records are written once this many bytes are
+        buffered, ...
+    :param flush_interval: ... or this many seconds after the last write,
+        by a background thread if no record is logged meanwhile, ...
+    :param flush_level: ... or when a record at or above this level is
+        logged.
+    :param fsync_interval: The least number of seconds between calls to
+        :func:`os.fsync`; ``None`` to leave it to the operating system.
+    :param encoding: The encoding of the file.
+
+    Subclasses open :attr:`stream` unbuffered and pass each encoded record
+    to :meth:`buffer_data`. One daemon thread per process flushes idle
+    buffers, so at most *flush_interval* seconds of records are lost if
+    the process is killed.
+    """
+
+    def __init__(
+        self,
+        buffer_size=64 * 1024,
+        flush_interval=1.0,
+        flush_level=logging.ERROR,
+        fsync_interval=5.0,
+        encoding="utf-8",
+    ):
+        super(BufferedFileHandler, self).__init__()
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.flush_level = flush_level
+        self.fsync_interval = fsync_interval
+        self.encoding = encoding
+        self.stream = None
+        self.buffer = []
+        self.buffered = 0
+        self.last_flush = self.last_fsync = time.time()
+        _flusher.add(self)
+
+    def buffer_data(self, data, levelno):
+        """Buffers *data*, for a record at *levelno*, and writes it if due."""
+        if _flusher.pid != os.getpid():
+            _flusher.start()
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if (
+            self.buffered >= self.buffer_size
+            or levelno >= self.flush_level
+            or time.time() - self.last_flush >= self.flush_interval
+        ):
+            self.write_buffer()
+
+    def write_buffer(self, fsync=False):
+        """
+        Writes the buffered records to the file, with one system call,
+        and syncs it if *fsync* or :attr:`fsync_interval` has passed.
+        """
+        now = time.time()
+        self.last_flush = now
+        if self.stream is None:
+            return
+        if self.buffer:
+            data = memoryview(b"".join(self.buffer))
+            self.buffer, self.buffered = [], 0
+            while data:
+                data = data[self.stream.write(data) :]
+        if fsync or (
+            self.fsync_interval is not None
+            and now - self.last_fsync >= self.fsync_interval
+        ):
+            os.fsync(self.stream.fileno())
+            self.last_fsync = now
+
+    def flush(self):
+        self.acquire()
+        try:
+            self.write_buffer()
+        finally:
+            self.release()
+
+    def close(self):
+        self.acquire()
+        try:
+            try:
+                self.write_buffer(fsync=self.fsync_interval is not None)
+            finally:
+                if self.stream is not None:
+                    self.stream.close()
+                    self.stream = None
+        finally:
+            self.release()
+        _flusher.discard(self)
+        super(BufferedFileHandler, self).close()
+
+
+class SegmentFileHandler(BufferedFileHandler):
+    """
+    Writes records to a segment file of its own in each worker process.
+
+    :param directory: Where to write the segments, which are named
+        ``<prefix>-<YYYYMMDD>-<pid>.log`` after the UTC day of the records
+        and the process ID.
+    :param prefix: The start of the segment names.
+    :param buffer_size: Records are written once this many bytes are
+        buffered, ...
+    :param flush_interval: ... or this many seconds after the last write,
+        by a background thread if no record is logged meanwhile, ...
+    :param flush_level: ... or when a record at or above this level is
+        logged.
+    :param fsync_interval: The least number of seconds between calls to
+        :func:`os.fsync`; ``None`` to leave it to the operating system.
+    :param encoding: The encoding of the segments.
+
+    Processes never share a file, so prefork workers neither interleave
+    lines nor race to rotate, and a new segment is started each day.
+    Each entry is stamped with the record's creation time, or that of
+    the entry before it if later, so that a segment is always in order
+    even when threads log concurrently. A
+    process forked after the handler is set up starts its own segment,
+    and its own thread to flush idle buffers, so a killed worker loses at
+    most *flush_interval* seconds of records.
+    Merge the segments into one log ordered by time with the
+    ``merge_log_segments`` management command; see :mod:`.segments`::
+
+       'handlers': {
+           'segments': {
+               '()': 'django_requestlogging.handlers.SegmentFileHandler',
+               'directory': '/var/log/myapp',
+               'formatter': 'request_format',
+               'filters': ['request'],
+           },
+       },
+    """
+
+    def __init__(
+        self,
+        directory,
+        prefix="requests",
+        buffer_size=64 * 1024,
+        flush_interval=1.0,
+        flush_level=logging.ERROR,
+        fsync_interval=5.0,
+        encoding="utf-8",
+    ):
+        super(SegmentFileHandler, self).__init__(
+            buffer_size, flush_interval, flush_level, fsync_interval, encoding
+        )
+        self.directory = directory
+        self.prefix = prefix
+        self.path = None
+        self.pid = os.getpid()
+        # The [start, end) of the current segment's day, in epoch seconds
+        self.day = (0, 0)
+        # The timestamp of the last entry written
+        self.latest = 0.0
+
+    def segment_path(self, created):
+        """Returns the path of the segment for a record *created* at that time."""
+        day = time.strftime("%Y%m%d", time.gmtime(created))
+        return os.path.join(
+            self.directory, "%s-%s-%d.log" % (self.prefix, day, os.getpid())
+        )
+
+    def open_segment(self, created):
+        """Switches to the segment for a record *created* at that time."""
+        self.write_buffer()
+        if self.stream is not None:
+            self.stream.close()
+        self.path = self.segment_path(created)
+        # Unbuffered, as records are buffered here and written together
+        self.stream = io.open(self.path, "ab", buffering=0)
+        start = calendar.timegm(time.gmtime(created)[:3] + (0, 0, 0))
+        self.day = (start, start + 86400)
+
+    def emit(self, record):
+        try:
+            # Records are created before the handler lock is taken, so
+            # threads may hand them over out of order. Stamp entries here,
+            # under the lock, so that each segment stays sorted as
+            # merging requires.
+            created = self.latest = max(record.created, self.latest)
+            data = encode_entry(created, self.format(record)).encode(self.encoding)
+            if self.pid != os.getpid():
+                # Forked; the parent writes what it buffered.
+                self.pid = os.getpid()
+                self.buffer, self.buffered, self.stream = [], 0, None
+                self.day = (0, 0)
+            start, end = self.day
+            if not start <= created < end:
+                self.open_segment(created)
+            self.buffer_data(data, record.levelno)
+        except Exception:
+            self.handleError(record)
+
+    def write_buffer(self, fsync=False):
+        if self.pid != os.getpid():
+            self.last_flush = time.time()
+            return
+        super(SegmentFileHandler, self).write_buffer(fsync)
+
+
+#: Compress rotated files with :mod:`gzip`.
+GZIP = "gzip"
+#: Compress rotated files with Zstandard; requires the ``zstandard`` package.
+ZSTD = "zstd"
+
+
+def _open_gzip(path):
+    return gzip.open(path, "wb", compresslevel=6)
+
+
+def _open_zstd(path):
+    return zstandard.ZstdCompressor(level=3).stream_writer(io.open(path, "wb"))
+
+
+class CompressingRotatingFileHandler(BufferedFileHandler):
+    """
+    Writes records to a file, renaming it once it reaches *max_bytes* and
+    compressing the renamed file in a background thread.
+
+    :param filename: The file to write.
+    :param max_bytes: The size at which the file is rotated.
+    :param backup_count: How many rotated files to keep; ``0`` keeps all.
+    :param compression: :data:`GZIP`, :data:`ZSTD` or ``None``.
+    :param buffer_size: Records are written once this many bytes are
+        buffered, ...
+    :param flush_interval: ... or this many seconds after the last write,
+        by a background thread if no record is logged meanwhile, ...
+    :param flush_level: ... or when a record at or above this level is
+        logged.
+    :param fsync_interval: The least number of seconds between calls to
+        :func:`os.fsync`; ``None`` to leave it to the operating system.
+    :param encoding: The encoding of the file.
+
+    Rotated files are named after the UTC time of their rotation, like
+    ``requests.log.20170714T020000.123456.gz``, so rotating never renames
+    older files and they sort by age. The thread that logs the record
+    crossing *max_bytes* writes the buffer, closes the file, renames it,
+    opens a new one and queues the old one; at worst, then, a record waits
+    for one write of *buffer_size* bytes and three metadata operations.
+    Compressing and pruning old files happen in the background thread.
+    Files left uncompressed by an earlier process are compressed when the
+    handler starts. As with :class:`logging.handlers.RotatingFileHandler`,
+    only one process may write the file; give prefork workers a
+    :class:`SegmentFileHandler` instead::
+
+       'handlers': {
+           'file': {
+               '()': 'django_requestlogging.handlers.CompressingRotatingFileHandler',
+               'filename': '/var/log/myapp/requests.log',
+               'max_bytes': 1 << 30,
+               'backup_count': 50,
+               'formatter': 'request_format',
+               'filters': ['request'],
+           },
+       },
+    """
+
+    COMPRESSORS = {
+        GZIP: (".gz", _open_gzip),
+        ZSTD: (".zst", _open_zstd),
+        None: ("", None),
+    }
+
+    def __init__(
+        self,
+        filename,
+        max_bytes=1 << 30,
+        backup_count=0,
+        compression=GZIP,
+        buffer_size=256 * 1024,
+        flush_interval=1.0,
+        flush_level=logging.ERROR,
+        fsync_interval=None,
+        encoding="utf-8",
+    ):
+        if compression not in self.COMPRESSORS:
+            choices = ", ".join(map(repr, self.COMPRESSORS))
+            raise ValueError(
+                "compression must be one of %s, not %r" % (choices, compression)
+            )
+        if compression == ZSTD and zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+        super(CompressingRotatingFileHandler, self).__init__(
+            buffer_size, flush_interval, flush_level, fsync_interval, encoding
+        )
+        self.filename = os.path.abspath(filename)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compression = compression
+        self.suffix, self.opener = self.COMPRESSORS[compression]
+        self.size = 0
+        self.pending = queue.Queue()
+        self.thread = None
+        self._sentinel = object()
+        self.open()
+        for path in self.rotated_files(complete=False):
+            if path.endswith(".tmp"):
+                os.remove(path)
+            else:
+                self.submit(path)
+
+    def open(self):
+        # Unbuffered, as records are buffered here and written together
+        self.stream = io.open(self.filename, "ab", buffering=0)
+        self.size = os.fstat(self.stream.fileno()).st_size
+
+    def rotated_files(self, complete=True):
+        """
+        Returns the paths of the files named by :meth:`rotate`, oldest
+        first: those that are compressed if *complete*, or else those that
+        are not yet. Other files next to the log are left alone.
+        """
+        directory, base = os.path.split(self.filename)
+        pattern = re.compile(
+            r"%s\.\d{8}T\d{6}\.\d{6}_*(\.gz|\.zst)?(\.tmp)?\Z" % re.escape(base)
+        )
+        paths = []
+        for name in sorted(os.listdir(directory)):
+            match = pattern.match(name)
+            if match is None:
+                continue
+            suffix, temporary = match.groups()
+            done = (suffix or "") == self.suffix and not temporary
+            if done == complete:
+                paths.append(os.path.join(directory, name))
+        return paths
+
+    def emit(self, record):
+        try:
+            data = (self.format(record) + "\n").encode(self.encoding)
+            if (
+                self.size + self.buffered + len(data) > self.max_bytes
+                and self.size + self.buffered
+            ):
+                self.rotate()
+            self.buffer_data(data, record.levelno)
+        except Exception:
+            self.handleError(record)
+
+    def write_buffer(self, fsync=False):
+        if self.stream is not None:
+            self.size += self.buffered
+        super(CompressingRotatingFileHandler, self).write_buffer(fsync)
+
+    def rotate(self):
+        """Renames the file, opens a new one and queues the old one."""
+        self.write_buffer()
+        self.stream.close()
+        self.stream = None
+        now = time.time()
+        path = "%s.%s.%06d" % (
+            self.filename,
+            time.strftime("%Y%m%dT%H%M%S", time.gmtime(now)),
+            int(now % 1 * 1e6),
+        )
+        while os.path.exists(path) or os.path.exists(path + self.suffix):
+            path += "_"
+        os.rename(self.filename, path)
+        self.open()
+        self.submit(path)
+
+    def submit(self, path):
+        """Queues the rotated *path* for the background thread."""
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(
+                target=self.run, name="CompressingRotatingFileHandler"
+            )
+            self.thread.daemon = True
+            self.thread.start()
+        self.pending.put(path)
+
+    def run(self):
+        """The background thread: compresses rotated files and prunes old ones."""
+        while True:
+            path = self.pending.get()
+            if path is self._sentinel:
+                return
+            try:
+                self.compress(path)
+                self.prune()
+            except Exception:
+                if logging.raiseExceptions:
+                    traceback.print_exc(file=sys.stderr)
+
+    def compress(self, path):
+        """Replaces the rotated *path* with its compressed copy."""
+        if self.opener is None:
+            return
+        temporary = path + self.suffix + ".tmp"
+        with io.open(path, "rb") as source:
+            with self.opener(temporary) as target:
+                shutil.copyfileobj(source, target, 1024 * 1024)
+        os.rename(temporary, path + self.suffix)
+        os.remove(path)
+
+    def prune(self):
+        """Removes the oldest rotated files beyond :attr:`backup_count`."""
+        if self.backup_count:
+            for path in self.rotated_files()[: -self.backup_count]:
+                os.remove(path)
+
+    def close(self):
+        """Writes the buffer, closes the file and waits for the background thread."""
+        super(CompressingRotatingFileHandler, self).close()
+        thread, self.thread = self.thread, None
+        if thread is not None and thread.is_alive():
+            self.pending.put(self._sentinel)
+            thread.join()
+
+
+class _Repeats(object):
+    """The records suppressed for one key of a :class:`CoalescingHandler`."""
+
+    __slots__ = ("start", "count", "first", "last", "record")
+
+    def __init__(self, created):
+        self.start = created
+        self.count = 0
+        self.first = self.last = self.record = None
+
+
+class CoalescingHandler(ForwardingHandler):
+    """
+    Passes the first of a run of similar records on to *handlers*, and
+    folds the rest into one summary record.
+
+    :param handlers: The handlers, or names of handlers configured in
+        :data:`settings.LOGGING`, that the records are passed to.
+    :param window: Outside a request, how many seconds a run of similar
+        records lasts.
+    :param max_keys: The most runs tracked per request, and outside
+        requests, at once; the least recently seen run is summarized to
+        make room for a new one.
+
+    Records are similar if they have the same logger, level, ``msg``
+    template and ``path_info``, whatever their arguments; records whose
+    ``msg`` is not a string are passed on as they are. During a request
+    a run lasts until the request is finished by
+    :class:`.middleware.LogSetupMiddleware`. The summary is the last
+    suppressed record with its message replaced by :attr:`MESSAGE`, and
+    with these attributes:
+
+    ``coalesced``
+       How many records were suppressed.
+
+    ``first_created``, ``last_created``
+       When the first and last of them were created.
+
+    Runs still open are summarized by :meth:`flush` and at exit::
+
+       'handlers': {
+           'coalesce': {
+               '()': 'django_requestlogging.handlers.CoalescingHandler',
+               'handlers': ['console'],
+               'window': 10,
+               'filters': ['request'],
+           },
+       },
+    """
+
+    #: The message of a summary record.
+    MESSAGE = "%s [repeated %d more times]"
+
+    def __init__(self, handlers=(), window=1.0, max_keys=1024):
+        super(CoalescingHandler, self).__init__(handlers)
+        self.window = window
+        self.max_keys = max_keys
+        self.runs = OrderedDict()
+
+    def emit(self, record):
+        try:
+            self.coalesce(record)
+        except Exception:
+            self.handleError(record)
+
+    def coalesce(self, record):
+        """Passes on *record*, or counts it as a repeat."""
+        if not isinstance(record.msg, str):
+            # Not a template, and possibly unhashable, e.g. a dict.
+            self.dispatch([record])
+            return
+        request = get_current_request()
+        key = (
+            record.name,
+            record.levelno,
+            record.msg,
+            getattr(record, "path_info", None),
+        )
+        if request is None:
+            runs = self.runs
+            self.expire(runs, record.created)
+        else:
+            runs = self.request_runs(request)
+        run = runs.get(key)
+        if run is None:
+            if len(runs) >= self.max_keys:
+                self.summarize(runs.popitem(last=False)[1])
+            runs[key] = _Repeats(record.created)
+            self.dispatch([record])
+            return
+        runs.move_to_end(key)
+        if request is None and record.created - run.start >= self.window:
+            self.summarize(run)
+            runs[key] = _Repeats(record.created)
+            self.dispatch([record])
+            return
+        run.count += 1
+        if run.first is None:
+            run.first = record.created
+        run.last = record.created
+        run.record = record
+
+    def request_runs(self, request):
+        """Returns the runs of *request*, which are summarized as it finishes."""
+        runs = getattr(request, "logging_coalescing", None)
+        if runs is None:
+            runs = request.logging_coalescing = {}
+        try:
+            return runs[self]
+        except KeyError:
+            runs[self] = request_runs = OrderedDict()
+            add_request_finalizer(request, lambda: self.finish(request_runs))
+            return request_runs
+
+    def expire(self, runs, now):
+        """Summarizes the runs outside requests that ended before *now*."""
+        while runs:
+            # Runs are in the order they were last seen, so any others that
+            # have ended are summarized when they are next seen.
+            key, run = next(iter(runs.items()))
+            if now - run.start < self.window:
+                return
+            del runs[key]
+            self.summarize(run)
+
+    def finish(self, runs):
+        self.acquire()
+        try:
+            while runs:
+                self.summarize(runs.popitem(last=False)[1])
+        finally:
+            self.release()
+
+    def summarize(self, run):
+        """Passes on the summary record of *run*, if anything was suppressed."""
+        if not run.count:
+            return
+        record = run.record
+        attrs = dict(materialize(record).__dict__)
+        attrs.update(
+            msg=self.MESSAGE,
+            args=(record.getMessage(), run.count),
+            exc_info=None,
+            exc_text=None,
+            stack_info=None,
+            coalesced=run.count,
+            first_created=run.first,
+            last_created=run.last,
+        )
+        attrs.pop("message", None)
+        self.dispatch([logging.makeLogRecord(attrs)])
+
+    def flush(self):
+        self.finish(self.runs)
+
+    def close(self):
+        self.flush()
+        super(CoalescingHandler, self).close()
+
+
+#: The prefix of each frame sent by :class:`BatchingSocketHandler`: the
+#: length of the payload that follows, as a big-endian unsigned int.
+FRAME_HEADER = struct.Struct(">I")
+
+
+def encode_frame(payload):
+    """Returns *payload* (:class:`bytes`) prefixed with its length."""
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+def iter_frames(stream):
+    """
+    Yields the payload of each frame read from the binary *stream*,
+    ignoring an incomplete last frame.
+    """
+    while True:
+        header = stream.read(FRAME_HEADER.size)
+        if len(header) < FRAME_HEADER.size:
+            return
+        (size,) = FRAME_HEADER.unpack(header)
+        payload = stream.read(size)
+        if len(payload) < size:
+            return
+        yield payload
+
+
+class BatchingSocketHandler(logging.Handler):
+    """
+    Sends records to a collector over a persistent TCP connection, in
+    batches, from a background thread.
+
+    :param host: The collector's host.
+    :param port: The collector's port.
+    :param batch_size: The most records in a batch.
+    :param batch_bytes: A batch is sent once it holds this many bytes ...
+    :param flush_interval: ... or this many seconds after its first record.
+    :param maxsize: The most records waiting for the background thread;
+        further records are dropped.
+    :param spill_path: A file to keep batches in while the collector is
+        unreachable, to send once it is back. Without one, those batches
+        are dropped.
+    :param spill_bytes: The largest the spill file may grow.
+    :param backoff: The first and the longest delay, in seconds, before
+        reconnecting; the delay doubles after each failure.
+    :param timeout: The socket timeout, in seconds.
+
+    Each batch is sent as one frame: the length of the payload as a
+    4-byte big-endian integer, then a JSON array of the records, each
+    formatted by the handler's formatter, which must produce a JSON
+    object; the default is :class:`.formatters.JSONFormatter`. The logging
+    thread queues a copy of each record made by :meth:`prepare`, with its
+    message and exception rendered and its request fields materialized,
+    so arguments changed after the call are logged as they were; turning
+    records into JSON, sending and reconnecting happen in the background
+    thread. Batches in the spill
+    file are sent before new ones, so delivery is at least once and in
+    order. Dropped records are counted in :attr:`dropped`::
+
+       'handlers': {
+           'collector': {
+               '()': 'django_requestlogging.handlers.BatchingSocketHandler',
+               'host': 'logs.internal',
+               'port': 5170,
+               'spill_path': '/var/spool/myapp/logs.spill',
+               'filters': ['request'],
+           },
+       },
+    """
+
+    def __init__(
+        self,
+        host,
+        port,
+        batch_size=500,
+        batch_bytes=1 << 20,
+        flush_interval=1.0,
+        maxsize=10000,
+        spill_path=None,
+        spill_bytes=256 << 20,
+        backoff=(0.1, 30.0),
+        timeout=5.0,
+    ):
+        super(BatchingSocketHandler, self).__init__()
+        self.address = (host, port)
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize)
+        self.spill_path = spill_path
+        self.spill_bytes = spill_bytes
+        self.min_backoff, self.max_backoff = backoff
+        self.timeout = timeout
+        self.formatter = JSONFormatter()
+        self.dropped = 0
+        self.sock = None
+        self.delay = 0
+        self.retry_at = 0
+        self.thread = None
+        self._lock = threading.Lock()
+        self._sentinel = object()
+
+    def start(self):
+        """Starts the background thread, if it is not running already."""
+        with self._lock:
+            if self.thread is None:
+                thread = threading.Thread(target=self.run, name="BatchingSocketHandler")
+                thread.daemon = True
+                thread.start()
+                self.thread = thread
+
+    def emit(self, record):
+        try:
+            if self.thread is None:
+                self.start()
+            self.queue.put_nowait(self.prepare(record))
+        except queue.Full:
+            self._drop()
+        except Exception:
+            self.handleError(record)
+
+    def prepare(self, record):
+        """
+        Returns a copy of *record* that the background thread can format
+        without the caller's arguments, exception or request, as
+        :meth:`logging.handlers.QueueHandler.prepare` does.
+        """
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = (
+                    self.formatter or logging._defaultFormatter
+                ).formatException(record.exc_info)
+            record.exc_info = None
+        return materialize(record)
+
+    def _drop(self, count=1):
+        with self._lock:
+            self.dropped += count
+
+    def run(self):
+        """The background thread: batches records and sends them."""
+        while True:
+            batch, done = self.collect()
+            if batch:
+                self.send(b"[" + b",".join(batch) + b"]", len(batch))
+            if done:
+                break
+
+    def collect(self):
+        """
+        Returns the next batch of formatted records, and whether the
+        handler is closing.
+        """
+        batch = []
+        size = 0
+        deadline = None
+        while len(batch) < self.batch_size and size < self.batch_bytes:
+            if deadline is None:
+                record = self.queue.get()
+                deadline = time.time() + self.flush_interval
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    record = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if record is self._sentinel:
+                return batch, True
+            try:
+                data = self.format(record).encode("utf-8")
+            except Exception:
+                self.handleError(record)
+                continue
+            batch.append(data)
+            size += len(data)
+        return batch, False
+
+    def connect(self):
+        sock = socket.create_connection(self.address, self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def send(self, payload, count):
+        """
+        Sends one batch of *count* records, or spills it if the collector
+        is unreachable.
+        """
+        frame = encode_frame(payload)
+        if self.sock is None and time.time() < self.retry_at:
+            self.spill(frame, count)
+            return
+        try:
+            if self.sock is not None and self.closed_by_peer():
+                self.disconnect(backoff=False)
+            if self.sock is None:
+                self.sock = self.connect()
+            self.replay()
+            self.sock.sendall(frame)
+        except (OSError, socket.error):
+            self.disconnect()
+            self.spill(frame, count)
+        else:
+            self.delay = 0
+
+    def closed_by_peer(self):
+        """
+        Returns whether the collector closed the connection. The collector
+        never writes, so a readable socket means it did; without this check
+        the first batch after that would vanish into the send buffer.
+        """
+        readable, _, _ = select.select([self.sock], [], [], 0)
+        if not readable:
+            return False
+        try:
+            return not self.sock.recv(1, socket.MSG_PEEK)
+        except (OSError, socket.error):
+            return True
+
+    def disconnect(self, backoff=True):
+        """Closes the connection and schedules the next attempt."""
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except (OSError, socket.error):
+                pass
+            self.sock = None
+        if not backoff:
+            return
+        self.delay = min(self.max_backoff, self.delay * 2 or self.min_backoff)
+        self.retry_at = time.time() + self.delay
+
+    def spill(self, frame, count):
+        """Keeps *frame* in the spill file, or drops its *count* records."""
+        if self.spill_path is not None:
+            try:
+                size = os.path.getsize(self.spill_path)
+            except OSError:
+                size = 0
+            if size + len(frame) <= self.spill_bytes:
+                with io.open(self.spill_path, "ab") as f:
+                    f.write(frame)
+                return
+        self._drop(count)
+
+    def replay(self):
+        """Sends the spilled frames over the connection, then empties the file."""
+        if self.spill_path is None or not os.path.exists(self.spill_path):
+            return
+        with io.open(self.spill_path, "rb") as f:
+            for payload in iter_frames(f):
+                self.sock.sendall(encode_frame(payload))
+        os.remove(self.spill_path)
+
+    def close(self):
+        """Sends the queued records, waiting up to *timeout*, and stops."""
+        with self._lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(self._sentinel)
+            thread.join(self.timeout)
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        super(BatchingSocketHandler, self).close()
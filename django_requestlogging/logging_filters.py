@@ -40,9 +40,670 @@ also :class:`~.middleware.LogSetupMiddleware`.
    http://docs.python.org/2.6/library/logging.html#\
    adding-contextual-information-to-your-logging-output
 """
+
 from __future__ import absolute_import, unicode_literals
 
+import functools
+import logging
+import random
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+
 import django
+import six
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .metrics import get_metrics
+
+try:
+    from contextvars import ContextVar
+except ImportError:  # Python < 3.7
+    ContextVar = None
+
+monotonic = getattr(time, "monotonic", time.time)
+
+
+if ContextVar is not None:
+    _current_request = ContextVar("django_requestlogging.request", default=None)
+
+    def get_current_request():
+        """Returns the request bound to the current context, or ``None``."""
+        return _current_request.get()
+
+    def set_current_request(request):
+        """
+        Binds *request* to the current context.
+
+        Returns a token for :func:`reset_current_request`.
+        """
+        return _current_request.set(request)
+
+    def reset_current_request(token):
+        """Restores the binding that was replaced when *token* was issued."""
+        try:
+            _current_request.reset(token)
+        except ValueError:
+            # The token was created in another context, e.g. on the other
+            # side of a sync/async boundary.
+            _current_request.set(None)
+
+else:
+    _local = threading.local()
+
+    class _Token(object):
+        __slots__ = ("previous",)
+
+        def __init__(self, previous):
+            self.previous = previous
+
+    def get_current_request():
+        """Returns the request bound to the current thread, or ``None``."""
+        return getattr(_local, "request", None)
+
+    def set_current_request(request):
+        """
+        Binds *request* to the current thread.
+
+        Returns a token for :func:`reset_current_request`.
+        """
+        token = _Token(get_current_request())
+        _local.request = request
+        return token
+
+    def reset_current_request(token):
+        """Restores the binding that was replaced when *token* was issued."""
+        _local.request = token.previous
+
+
+def add_request_finalizer(request, callback):
+    """
+    Calls *callback* with no arguments once
+    :class:`~.middleware.LogSetupMiddleware` has finished with *request*,
+    while it is still bound.
+    """
+    finalizers = getattr(request, "logging_finalizers", None)
+    if finalizers is None:
+        finalizers = request.logging_finalizers = []
+    finalizers.append(callback)
+
+
+def run_request_finalizers(request):
+    """Calls the callbacks added by :func:`add_request_finalizer`, once."""
+    finalizers = getattr(request, "logging_finalizers", None)
+    if finalizers:
+        request.logging_finalizers = None
+        for callback in finalizers:
+            callback()
+
+
+@six.python_2_unicode_compatible
+class LazyValue(object):
+    """
+    A value that is only computed when it is first used.
+
+    ``LazyValue(func, *args)`` calls ``func(*args)`` the first time the
+    value is formatted, compared, hashed or tested for truth, and caches
+    the result. It pickles as the resolved string, so it is safe to send
+    through :class:`~logging.handlers.SocketHandler` and friends.
+    """
+
+    __slots__ = ("_func", "_args", "_value")
+    _unresolved = object()
+
+    def __init__(self, func, *args):
+        self._func = func
+        self._args = args
+        self._value = self._unresolved
+
+    def resolve(self):
+        """Returns the value, computing it on first use."""
+        if self._value is self._unresolved:
+            self._value = self._func(*self._args)
+            self._func = self._args = None
+        return self._value
+
+    def __str__(self):
+        return six.text_type(self.resolve())
+
+    def __repr__(self):
+        return repr(self.resolve())
+
+    def __format__(self, format_spec):
+        return format(self.resolve(), format_spec)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyValue):
+            other = other.resolve()
+        return self.resolve() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.resolve())
+
+    def __bool__(self):
+        return bool(self.resolve())
+
+    __nonzero__ = __bool__
+
+    def __reduce__(self):
+        return (six.text_type, (six.text_type(self),))
+
+
+#: The record attributes added by :class:`RequestFilter`.
+REQUEST_FIELDS = (
+    "request_id",
+    "request_method",
+    "path_info",
+    "username",
+    "remote_addr",
+    "server_protocol",
+    "http_user_agent",
+)
+
+#: The record attributes added by :class:`RequestFilter` with
+#: ``REQUESTLOGGING_DB_QUERIES``.
+DB_FIELDS = ("db_queries", "db_time_ms")
+
+
+def get_session_value(request, key):
+    """Returns *key* from *request*'s session, or ``'-'``."""
+    session = getattr(request, "session", None)
+    if session is None:
+        return "-"
+    return session.get(key, "-")
+
+
+def get_resolver_value(request, name):
+    """Returns attribute *name* of *request*'s URL match, or ``'-'``."""
+    match = getattr(request, "resolver_match", None)
+    value = getattr(match, name, None)
+    return "-" if value is None else value
+
+
+def or_dash(value):
+    return "-" if value is None else value
+
+
+def attr_expression(path):
+    """Returns an expression that follows dotted *path* from ``request``."""
+    expression = "request"
+    for name in path.split("."):
+        expression = "getattr(%s, %r, None)" % (expression, str(name))
+    return expression
+
+
+FIELD_NAME_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+# Names that extra fields may not take, as stamping them would overwrite
+# the record's own attributes or the other request fields.
+RESERVED_FIELD_NAMES = (
+    frozenset(vars(logging.LogRecord("", logging.INFO, "", 0, "", (), None)))
+    | frozenset(("message", "asctime"))
+    | frozenset(REQUEST_FIELDS + DB_FIELDS)
+)
+
+# Expressions for each kind of field source, in terms of the locals of the
+# generated extractor.
+FIELD_SOURCES = {
+    "header": lambda arg: "META.get(%r, '-')"
+    % ("HTTP_" + arg.upper().replace("-", "_")),
+    "meta": lambda arg: "META.get(%r, '-')" % arg,
+    "cookie": lambda arg: "COOKIES.get(%r, '-')" % arg,
+    # Loading the session or resolving the URL may not have happened yet
+    # and the former can hit the database, so these resolve lazily.
+    "session": lambda arg: "LazyValue(get_session_value, request, %r)" % arg,
+    "resolver": lambda arg: "LazyValue(get_resolver_value, request, %r)" % arg,
+    "attr": lambda arg: "or_dash(%s)" % attr_expression(arg),
+}
+
+EXTRACTOR_TEMPLATE = """\
+def extract_fields(request):
+    META = getattr(request, "META", None) or {}
+    COOKIES = getattr(request, "COOKIES", None) or {}
+    return {%s}
+"""
+
+
+def compile_fields(spec):
+    """
+    Compiles *spec* into a function that extracts extra fields from a
+    request, returning a :class:`dict` of record attributes.
+
+    *spec* is a :class:`dict` mapping record attribute names to
+    sources, which are one of:
+
+    ``header:<name>``
+       A request header, *e.g.* ``header:X-Tenant``.
+
+    ``meta:<key>``
+       A key in ``request.META``, *e.g.* ``meta:SERVER_NAME``.
+
+    ``cookie:<name>``
+       A cookie.
+
+    ``session:<key>``
+       A session value. Resolved lazily.
+
+    ``resolver:<attribute>``
+       An attribute of ``request.resolver_match``, *e.g.*
+       ``resolver:view_name``. Resolved lazily.
+
+    ``attr:<dotted.path>``
+       An attribute of the request, *e.g.* ``attr:site.domain``.
+
+    Missing values are ``'-'``. Names of :class:`~logging.LogRecord`
+    attributes and of the built-in request fields raise
+    :exc:`~django.core.exceptions.ImproperlyConfigured`. The function is
+    generated as Python source, so extracting the fields costs no more
+    than hand-written code. Returns ``None`` if *spec* is empty.
+    """
+    items = []
+    names = []
+    for name, source in six.iteritems(spec):
+        kind, _, arg = source.partition(":")
+        if not FIELD_NAME_RE.match(name) or name in RESERVED_FIELD_NAMES:
+            raise ImproperlyConfigured("Invalid request logging field name %r." % name)
+        if kind not in FIELD_SOURCES or not arg:
+            raise ImproperlyConfigured(
+                "Invalid source %r for request logging field %r; expected one of %s followed by ':'."
+                % (source, name, ", ".join(sorted(FIELD_SOURCES)))
+            )
+        items.append("%r: %s" % (str(name), FIELD_SOURCES[kind](arg)))
+        names.append(name)
+    if not items:
+        return None
+    namespace = {
+        "LazyValue": LazyValue,
+        "get_session_value": get_session_value,
+        "get_resolver_value": get_resolver_value,
+        "or_dash": or_dash,
+    }
+    source = EXTRACTOR_TEMPLATE % ", ".join(items)
+    six.exec_(compile(source, "<REQUESTLOGGING_FIELDS>", "exec"), namespace)
+    extractor = namespace["extract_fields"]
+    extractor.field_names = tuple(names)
+    extractor.source = source
+    return extractor
+
+
+_field_extractor = False
+
+
+def get_field_extractor():
+    """
+    Returns the extractor compiled from ``settings.REQUESTLOGGING_FIELDS``,
+    or ``None`` if no extra fields are configured.
+    """
+    global _field_extractor
+    if _field_extractor is False:
+        spec = (
+            getattr(settings, "REQUESTLOGGING_FIELDS", None)
+            if settings.configured
+            else None
+        )
+        _field_extractor = compile_fields(spec or {})
+    return _field_extractor
+
+
+_placeholders = None
+
+
+def get_placeholders():
+    """
+    Returns the shared :class:`dict` of ``'-'`` placeholders for every
+    request field, stamped on records logged outside any request.
+    """
+    global _placeholders
+    if _placeholders is None:
+        _placeholders = dict.fromkeys(request_field_names(), "-")
+    return _placeholders
+
+
+#: The replacement for scrubbed text, unless
+#: ``REQUESTLOGGING_SCRUB_REPLACEMENT`` is set.
+SCRUB_REPLACEMENT = "[REDACTED]"
+
+# The most values a request remembers the scrubbed form of.
+SCRUB_CACHE_SIZE = 256
+
+
+def compile_scrubber(patterns, replacement=SCRUB_REPLACEMENT):
+    """
+    Compiles the regular expressions *patterns* into a single function
+    that replaces every match in a string with *replacement*.
+
+    The patterns are combined into one regular expression, so a string is
+    scanned once however many there are. Each match is replaced as a
+    whole, so use lookarounds to keep context, *e.g.*
+    ``(?<=token=)[^&\\s]+``; the patterns must not use backreferences.
+    Returns ``None`` if there are no *patterns*.
+    """
+    if not patterns:
+        return None
+    try:
+        regex = re.compile("|".join("(?:%s)" % pattern for pattern in patterns))
+    except re.error as e:
+        raise ImproperlyConfigured("Invalid REQUESTLOGGING_SCRUB pattern: %s" % e)
+    scrub = functools.partial(regex.sub, replacement.replace("\\", "\\\\"))
+    scrub.regex = regex
+    return scrub
+
+
+_scrubber = False
+
+
+def get_scrubber():
+    """
+    Returns the scrubber compiled from ``settings.REQUESTLOGGING_SCRUB``,
+    or ``None`` if no patterns are configured.
+    """
+    global _scrubber
+    if _scrubber is False:
+        patterns = (
+            getattr(settings, "REQUESTLOGGING_SCRUB", None)
+            if settings.configured
+            else None
+        )
+        replacement = getattr(
+            settings, "REQUESTLOGGING_SCRUB_REPLACEMENT", SCRUB_REPLACEMENT
+        )
+        _scrubber = compile_scrubber(patterns, replacement)
+    return _scrubber
+
+
+_db_queries = None
+
+
+def db_queries_enabled():
+    """Returns whether ``settings.REQUESTLOGGING_DB_QUERIES`` is set."""
+    global _db_queries
+    if _db_queries is None:
+        _db_queries = (
+            bool(getattr(settings, "REQUESTLOGGING_DB_QUERIES", False))
+            if settings.configured
+            else False
+        )
+    return _db_queries
+
+
+@receiver(setting_changed)
+def _fields_setting_changed(setting, **kwargs):
+    global _field_extractor, _placeholders, _scrubber, _db_queries
+    if setting == "REQUESTLOGGING_FIELDS":
+        _field_extractor = False
+        _placeholders = None
+    elif setting == "REQUESTLOGGING_DB_QUERIES":
+        _db_queries = None
+        _placeholders = None
+    elif setting in ("REQUESTLOGGING_SCRUB", "REQUESTLOGGING_SCRUB_REPLACEMENT"):
+        _scrubber = False
+
+
+def request_field_names():
+    """Returns the names of all record attributes added by the filter."""
+    names = REQUEST_FIELDS
+    extractor = get_field_extractor()
+    if extractor:
+        names += extractor.field_names
+    if db_queries_enabled():
+        names += DB_FIELDS
+    return names
+
+
+def materialize(record):
+    """
+    Resolves any :class:`LazyValue` request fields on *record* in place.
+
+    Call this before a record leaves the request, *e.g.* when it is
+    queued for another thread, since the request may be gone by the time
+    the record is formatted.
+    """
+    attrs = record.__dict__
+    for name in request_field_names():
+        value = attrs.get(name)
+        if isinstance(value, LazyValue):
+            attrs[name] = value.resolve()
+    return record
+
+
+# ``User.is_anonymous`` became a property in Django 1.10.
+ANONYMOUS_IS_CALLABLE = django.VERSION < (1, 10)
+
+
+def get_username(user):
+    """Returns the username of *user*, or ``'-'`` if it is anonymous."""
+    if not user:
+        return "-"
+    if ANONYMOUS_IS_CALLABLE:
+        anonymous = user.is_anonymous()
+    else:
+        anonymous = user.is_anonymous
+    return "-" if anonymous else user.username
+
+
+class RequestFields(object):
+    """
+    Snapshot of the information :class:`RequestFilter` extracts from a
+    *request*.
+
+    It is built once per request by :meth:`for_request` and copied onto
+    every record logged during that request.
+    """
+
+    __slots__ = ("user", "extra", "scrubber", "scrubbed", "queries") + REQUEST_FIELDS
+
+    def __init__(self, request):
+        # Basic
+        self.request_id = getattr(request, "request_id", "-")
+        self.request_method = getattr(request, "method", "-")
+        self.path_info = getattr(request, "path_info", "-")
+        # User, resolved lazily since it may need a session and DB lookup.
+        # Reading the attribute itself does not evaluate a lazy user.
+        self.user = getattr(request, "user", None)
+        self.username = (
+            LazyValue(get_username, self.user) if self.user is not None else "-"
+        )
+        # Headers
+        META = getattr(request, "META", {})  # NOQA: N806
+        self.remote_addr = META.get("REMOTE_ADDR", "-")
+        self.server_protocol = META.get("SERVER_PROTOCOL", "-")
+        self.http_user_agent = META.get("HTTP_USER_AGENT", "-")
+        # REQUESTLOGGING_FIELDS
+        extractor = get_field_extractor()
+        self.extra = extractor(request) if extractor is not None else None
+        # REQUESTLOGGING_DB_QUERIES, read when stamping as it keeps counting
+        self.queries = getattr(request, "logging_queries", None)
+        # REQUESTLOGGING_SCRUB
+        self.scrubber = get_scrubber()
+        self.scrubbed = {}
+        if self.scrubber is not None:
+            self.path_info = self.scrub(self.path_info)
+            self.http_user_agent = self.scrub(self.http_user_agent)
+            if self.extra:
+                self.extra = dict(
+                    (name, self.scrub(value))
+                    for name, value in six.iteritems(self.extra)
+                )
+
+    @classmethod
+    def for_request(cls, request):
+        """
+        Returns the snapshot cached on *request*, building it if needed.
+
+        The snapshot is rebuilt when ``request.user`` is replaced, *e.g.*
+        by :func:`django.contrib.auth.login`.
+        """
+        fields = getattr(request, "logging_fields", None)
+        if fields is None or fields.user is not getattr(request, "user", None):
+            if fields is not None:
+                fields.resolve()
+            fields = cls(request)
+            if request is not None:
+                request.logging_fields = fields
+        return fields
+
+    def resolve(self):
+        """
+        Resolves the :class:`LazyValue` fields, shared by the records
+        stamped with them, so that records still held by a handler once
+        the request is over do not look at it from another thread.
+        Called by :class:`~.middleware.LogSetupMiddleware` when it unbinds
+        the request.
+        """
+        values = [self.username]
+        if self.extra:
+            values.extend(six.itervalues(self.extra))
+        for value in values:
+            if isinstance(value, LazyValue):
+                try:
+                    value.resolve()
+                except Exception:
+                    # Left to raise, as before, when it is formatted
+                    pass
+
+    def as_dict(self):
+        """Returns the fields as a :class:`dict`, *e.g.* for ``extra``."""
+        result = dict((name, getattr(self, name)) for name in REQUEST_FIELDS)
+        if self.extra:
+            result.update(self.extra)
+        if self.queries is not None:
+            result["db_queries"] = self.queries.count
+            result["db_time_ms"] = self.queries.time_ms
+        return result
+
+    def scrub(self, value):
+        """
+        Returns *value* with any matches of ``REQUESTLOGGING_SCRUB``
+        replaced, if it is a string. Each distinct value is only scrubbed
+        once per request. A :class:`LazyValue` is scrubbed once it is
+        resolved.
+        """
+        if isinstance(value, LazyValue):
+            return LazyValue(self._scrub_lazy, value)
+        if not isinstance(value, six.string_types):
+            return value
+        scrubbed = self.scrubbed.get(value)
+        if scrubbed is None:
+            if len(self.scrubbed) >= SCRUB_CACHE_SIZE:
+                self.scrubbed = {}
+            scrubbed = self.scrubber(value)
+            # Scrubbing twice, e.g. by stacked filters, is then a lookup.
+            self.scrubbed[value] = self.scrubbed[scrubbed] = scrubbed
+        return scrubbed
+
+    def _scrub_lazy(self, value):
+        return self.scrub(value.resolve())
+
+    def stamp(self, record):
+        """Copies the fields onto *record*, scrubbing its arguments."""
+        record.request_id = self.request_id
+        record.request_method = self.request_method
+        record.path_info = self.path_info
+        record.username = self.username
+        record.remote_addr = self.remote_addr
+        record.server_protocol = self.server_protocol
+        record.http_user_agent = self.http_user_agent
+        if self.extra:
+            record.__dict__.update(self.extra)
+        if self.queries is not None:
+            record.db_queries = self.queries.count
+            record.db_time_ms = self.queries.time_ms
+        if self.scrubber is not None and record.args:
+            args = record.args
+            if isinstance(args, dict):
+                record.args = dict(
+                    (key, self.scrub(value)) for key, value in six.iteritems(args)
+                )
+            else:
+                record.args = tuple(map(self.scrub, args))
+
+
+class RequestRecordFactory(object):
+    """
+    A log record factory that stamps the fields of the current request
+    on every record as it is created, wrapping the factory *wrapped*.
+    Records created outside any request are left alone, so that
+    ``extra`` can still set the fields there.
+
+    Installed by :func:`install_record_factory`.
+    """
+
+    def __init__(self, wrapped):
+        self.wrapped = wrapped
+        self.enabled = True
+        self.metrics = get_metrics()
+
+    def __call__(self, *args, **kwargs):
+        record = self.wrapped(*args, **kwargs)
+        if not self.enabled:
+            return record
+        request = get_current_request()
+        if self.metrics is not None:
+            self.metrics.filtered(record, request)
+        if request is not None:
+            RequestFields.for_request(request).stamp(record)
+        return record
+
+
+# The installed RequestRecordFactory, if any.
+_record_factory = None
+
+
+def install_record_factory():
+    """
+    Makes every record created from now on carry the fields of the
+    current request, whichever logger it is logged to, by wrapping the
+    current :func:`logging.getLogRecordFactory`. Unbound
+    :class:`RequestFilter`\\ s then leave records alone. Requires Python 3.
+
+    The fields are set before any ``extra`` is, and
+    :meth:`logging.Logger.makeRecord` refuses to overwrite them, so
+    ``extra`` may not contain request fields during a request while this
+    is installed. Records created outside any request get their
+    placeholders from a :class:`RequestFilter`, if one is configured.
+
+    Does nothing if the factory is already installed.
+    """
+    global _record_factory
+    if not hasattr(logging, "setLogRecordFactory"):
+        raise ImproperlyConfigured("The 'factory' request binding requires Python 3.")
+    with _factory_lock:
+        if _record_factory is not None:
+            return _record_factory
+        factory = RequestRecordFactory(logging.getLogRecordFactory())
+        logging.setLogRecordFactory(factory)
+        _record_factory = factory
+        return factory
+
+
+def uninstall_record_factory():
+    """
+    Reverses :func:`install_record_factory`. If another factory has
+    wrapped it since, it is left in place but stops stamping records.
+    """
+    global _record_factory
+    with _factory_lock:
+        factory, _record_factory = _record_factory, None
+        if factory is None:
+            return
+        factory.enabled = False
+        if logging.getLogRecordFactory() is factory:
+            logging.setLogRecordFactory(factory.wrapped)
+
+
+_factory_lock = threading.Lock()
+
+
+def record_factory_installed():
+    """Returns whether :func:`install_record_factory` is in effect."""
+    return _record_factory is not None
 
 
 class RequestFilter(object):
@@ -63,6 +724,9 @@ class RequestFilter(object):
     ``remote_addr``
        The remote IP address.
 
+    ``request_id``
+       The ID assigned by :class:`~.middleware.LogSetupMiddleware`.
+
     ``request_method``
        The HTTP request method (*e.g.* GET, POST, PUT, DELETE, *etc.*)
 
@@ -70,35 +734,228 @@ class RequestFilter(object):
        The server protocol (*e.g.* HTTP, HTTPS, *etc.*)
 
     ``username``
-       The username for the logged-in user.
+       The username for the logged-in user. This is a :class:`LazyValue`,
+       so ``request.user`` is only loaded if the record is formatted
+       with it during the request, or else once the request is unbound
+       by :class:`~.middleware.LogSetupMiddleware`, so that handlers that
+       hold on to records, such as :class:`logging.handlers.QueueHandler`
+       or :class:`logging.handlers.MemoryHandler`, never load it from
+       another thread after the response.
+
+    Further fields can be configured with ``REQUESTLOGGING_FIELDS``; see
+    :func:`compile_fields`.
+
+    With ``REQUESTLOGGING_DB_QUERIES = True``, the database queries run so
+    far in the request are counted by :class:`~.middleware.LogSetupMiddleware`:
+
+    ``db_queries``
+       The number of queries.
+
+    ``db_time_ms``
+       The time spent in them, in milliseconds.
+
+    Matches of the regular expressions in ``REQUESTLOGGING_SCRUB`` are
+    replaced with ``REQUESTLOGGING_SCRUB_REPLACEMENT`` (``'[REDACTED]'``
+    by default) in ``path_info``, ``http_user_agent``, the configured
+    fields and the string arguments of records logged during a request;
+    see :func:`compile_scrubber`.
+
+    An unbound filter (*request* is ``None``) uses the request bound to
+    the current context by :func:`set_current_request`, if any. A bound
+    filter ignores records logged while another request is bound to the
+    current context.
+
+    Records logged outside any request, *e.g.* by management commands,
+    get the placeholders from :func:`get_placeholders` in one step. Pass
+    ``placeholders=False`` to leave them alone instead, if the formatter
+    tolerates missing fields, as :class:`.formatters.JSONFormatter` does.
+
+    Once :func:`install_record_factory` has been called, unbound filters
+    leave records alone, as records are stamped when they are created
+    instead, except to add the placeholders to records created outside
+    any request, keeping any fields set with ``extra``.
+
+    With ``REQUESTLOGGING_METRICS`` set when the filter is created, its
+    calls are counted; see :class:`.metrics.Metrics`.
     """
 
-    def __init__(self, request=None):
+    def __init__(self, request=None, placeholders=True):
         """Saves *request* (a WSGIRequest object) for later."""
         self.request = request
+        self.placeholders = placeholders
+        self.metrics = get_metrics()
 
     def filter(self, record):
         """
         Adds information from the request to the logging *record*.
 
         If certain information cannot be extracted from ``self.request``,
-        a hyphen ``'-'`` is substituted as a placeholder.
+        a hyphen ``'-'`` is substituted as a placeholder. The information
+        is extracted once per request; see :class:`RequestFields`.
         """
         request = self.request
-        # Basic
-        record.request_method = getattr(request, "method", "-")
-        record.path_info = getattr(request, "path_info", "-")
-        # User
-        user = getattr(request, "user", None)
-        if django.VERSION < (1, 10) and user and not user.is_anonymous():
-            record.username = user.username
-        elif django.VERSION > (1, 10) and user and not user.is_anonymous:
-            record.username = user.username
-        else:
-            record.username = "-"
-        # Headers
-        META = getattr(request, "META", {})  # NOQA: N806
-        record.remote_addr = META.get("REMOTE_ADDR", "-")
-        record.server_protocol = META.get("SERVER_PROTOCOL", "-")
-        record.http_user_agent = META.get("HTTP_USER_AGENT", "-")
+        if request is None and _record_factory is not None:
+            # Stamped when the record was created, if within a request.
+            if self.placeholders:
+                attrs = record.__dict__
+                for name, value in six.iteritems(get_placeholders()):
+                    attrs.setdefault(name, value)
+            return True
+        current = get_current_request()
+        if request is None:
+            if current is None:
+                if self.metrics is not None:
+                    self.metrics.filtered(record, None)
+                if self.placeholders:
+                    record.__dict__.update(get_placeholders())
+                return True
+            request = current
+        elif current is not None and current is not request:
+            # Bound to a concurrent request; leave this record alone.
+            return True
+        if self.metrics is not None:
+            self.metrics.filtered(record, request)
+        RequestFields.for_request(request).stamp(record)
         return True
+
+
+class SamplingFilter(object):
+    """
+    Filter that logs a sample of requests, each one completely or not at
+    all.
+
+    :param rates: A :class:`dict` mapping path prefixes (starting with
+        ``/``) or HTTP methods to the fraction of requests to log, from
+        ``0`` to ``1``. The longest matching prefix wins, then the method.
+    :param default_rate: The fraction of other requests to log.
+    :param rate_limit: If given, at most this many requests per second
+        are logged for each value of *key*, using a token bucket.
+    :param burst: The size of each token bucket; defaults to
+        *rate_limit*.
+    :param key: The request field to rate limit on, *e.g.*
+        ``'remote_addr'``, ``'username'`` or a field configured in
+        ``REQUESTLOGGING_FIELDS``; other names raise
+        :exc:`~django.core.exceptions.ImproperlyConfigured`.
+    :param level: Records at this level or above are always logged.
+    :param max_buckets: The number of token buckets to keep; the least
+        recently used are discarded first.
+
+    The decision is made on the first record of each request, using the
+    request bound by :class:`~.middleware.LogSetupMiddleware`, and reused
+    for the rest of that request. Records logged outside a request are
+    always kept. The number of suppressed records is counted in
+    :attr:`suppressed`, keyed by the matching rule (a prefix, method or
+    ``'default'``) or by ``'<key>:<value>'`` for rate-limited requests.
+    In :data:`settings.LOGGING`::
+
+       'filters': {
+           'sample': {
+               '()': 'django_requestlogging.logging_filters.SamplingFilter',
+               'rates': {'/health/': 0, '/api/': 0.1, 'POST': 1},
+               'rate_limit': 10,
+               'key': 'remote_addr',
+           },
+       },
+    """
+
+    def __init__(
+        self,
+        rates=None,
+        default_rate=1.0,
+        rate_limit=None,
+        burst=None,
+        key="remote_addr",
+        level=logging.WARNING,
+        max_buckets=10000,
+    ):
+        rates = rates or {}
+        # Longest prefix first
+        self.prefixes = sorted(
+            (
+                (prefix, rate)
+                for prefix, rate in six.iteritems(rates)
+                if prefix.startswith("/")
+            ),
+            key=lambda item: len(item[0]),
+            reverse=True,
+        )
+        self.methods = dict(
+            (method.upper(), rate)
+            for method, rate in six.iteritems(rates)
+            if not method.startswith("/")
+        )
+        self.default_rate = default_rate
+        self.rate_limit = rate_limit
+        self.burst = burst if burst is not None else rate_limit
+        if key not in request_field_names():
+            raise ImproperlyConfigured("Invalid request logging field name %r." % key)
+        self.key = key
+        self.level = logging._checkLevel(level)
+        self.max_buckets = max_buckets
+        self.buckets = OrderedDict()
+        self.suppressed = Counter()
+        self.random = random.random
+        self._lock = threading.Lock()
+
+    def match(self, fields):
+        """Returns the rule name and sample rate for request *fields*."""
+        path = fields.path_info
+        for prefix, rate in self.prefixes:
+            if path.startswith(prefix):
+                return prefix, rate
+        method = fields.request_method
+        if method in self.methods:
+            return method, self.methods[method]
+        return "default", self.default_rate
+
+    def take_token(self, key):
+        """Takes a token from *key*'s bucket; returns ``False`` if empty."""
+        now = monotonic()
+        with self._lock:
+            bucket = self.buckets.pop(key, None)
+            if bucket is None:
+                tokens = self.burst
+            else:
+                tokens, last = bucket
+                tokens = min(self.burst, tokens + (now - last) * self.rate_limit)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+        return allowed
+
+    def decide(self, request):
+        """
+        Returns ``None`` if *request* should be logged, or the name of the
+        rule that suppresses it.
+        """
+        fields = RequestFields.for_request(request)
+        rule, rate = self.match(fields)
+        if rate < 1 and self.random() >= rate:
+            return rule
+        if self.rate_limit is not None:
+            rule = "%s:%s" % (self.key, fields.as_dict().get(self.key, "-"))
+            if not self.take_token(rule):
+                return rule
+        return None
+
+    def filter(self, record):
+        if record.levelno >= self.level:
+            return True
+        request = get_current_request()
+        if request is None:
+            return True
+        decisions = getattr(request, "logging_sampling", None)
+        if decisions is None:
+            decisions = request.logging_sampling = {}
+        try:
+            rule = decisions[self]
+        except KeyError:
+            rule = decisions[self] = self.decide(request)
+        if rule is None:
+            return True
+        with self._lock:
+            self.suppressed[rule] += 1
+        return False
@@ -0,0 +1,131 @@
+# -*- mode: django; coding: utf-8 -*-
+#
+# Copyright © 2011, TrustCentric
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of TrustCentric nor the names of its contributors
+#       may be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import absolute_import, unicode_literals
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...analytics import analyze
+
+
+class Command(BaseCommand):
+    help = (
+        "Reports per-endpoint counts, error rates and latency percentiles, and the busiest clients, "
+        "from request logs written as JSON lines or with a format string."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("logs", nargs="+", help="log files")
+        parser.add_argument(
+            "--format",
+            help="the logging format string the logs were written with; default JSON",
+        )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=1,
+            help="split each file over this many processes",
+        )
+        parser.add_argument(
+            "--percentiles",
+            type=lambda value: [float(p) for p in value.split(",")],
+            default=[50, 90, 99],
+            help="latency percentiles to report (default: 50,90,99)",
+        )
+        parser.add_argument(
+            "--top", type=int, default=20, help="endpoints and clients to report"
+        )
+        parser.add_argument(
+            "--max-endpoints",
+            type=int,
+            default=1000,
+            help="endpoints to track separately",
+        )
+        parser.add_argument(
+            "--accuracy",
+            type=float,
+            default=0.01,
+            help="relative accuracy of the percentiles",
+        )
+        parser.add_argument(
+            "--json", action="store_true", help="write the report as JSON"
+        )
+
+    def handle(self, *args, **options):
+        if options["processes"] < 1:
+            raise CommandError("--processes must be at least 1.")
+        stats = analyze(
+            options["logs"],
+            fmt=options["format"],
+            processes=options["processes"],
+            max_endpoints=options["max_endpoints"],
+            top=max(options["top"] * 10, 100),
+            accuracy=options["accuracy"],
+        )
+        report = stats.as_dict(options["percentiles"], options["top"])
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        self.stdout.write(
+            "%d records, %d skipped" % (report["records"], report["skipped"])
+        )
+        percentiles = ["p%g_ms" % p for p in options["percentiles"]]
+        self.stdout.write("")
+        self.stdout.write(
+            "%-50s %8s %8s %7s %s"
+            % (
+                "endpoint",
+                "count",
+                "errors",
+                "error%",
+                " ".join("%10s" % p for p in percentiles),
+            )
+        )
+        for endpoint in report["endpoints"]:
+            self.stdout.write(
+                "%-50s %8d %8d %6.2f%% %s"
+                % (
+                    endpoint["endpoint"],
+                    endpoint["count"],
+                    endpoint["errors"],
+                    endpoint["error_rate"] * 100,
+                    " ".join("%10s" % format_ms(endpoint[p]) for p in percentiles),
+                )
+            )
+        self.stdout.write("")
+        self.stdout.write("%-50s %8s" % ("remote_addr", "count"))
+        for remote_addr in report["remote_addrs"]:
+            self.stdout.write(
+                "%-50s %8d" % (remote_addr["remote_addr"], remote_addr["count"])
+            )
+
+
+def format_ms(value):
+    return "-" if value is None else "%.1f" % value
@@ -0,0 +1,325 @@
+# -*- mode: django; coding: utf-8 -*-
+#
+# Copyright © 2011, TrustCentric
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of TrustCentric nor the names of its contributors
+#       may be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+``metrics``
+-----------
+
+An in-process registry of metrics about the cost of request logging,
+enabled with ``REQUESTLOGGING_METRICS = True``. When it is disabled,
+:func:`get_metrics` returns ``None`` and nothing is measured.
+
+The registry can be dumped with :meth:`Registry.collect` or scraped in
+the Prometheus text format from :func:`metrics_view`.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import bisect
+import threading
+import weakref
+from collections import OrderedDict
+
+import six
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import HttpResponse
+
+#: Bucket upper bounds for durations, in seconds.
+DURATION_BUCKETS = (
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+)
+
+#: Bucket upper bounds for counts.
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"'
+        % (name, six.text_type(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in sorted(labels.items())
+    )
+
+
+class Counter(object):
+    """A value that only goes up."""
+
+    type = "counter"
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def collect(self):
+        return self.value
+
+    def samples(self):
+        yield self.name, {}, self.value
+
+
+class Histogram(object):
+    """Counts observations in cumulative buckets, like Prometheus."""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, buckets=DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def collect(self):
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        cumulative = 0
+        buckets = OrderedDict()
+        for bound, n in zip(self.buckets + (float("inf"),), counts):
+            cumulative += n
+            buckets[format_value(bound)] = cumulative
+        return OrderedDict([("buckets", buckets), ("count", count), ("sum", total)])
+
+    def samples(self):
+        snapshot = self.collect()
+        for bound, n in snapshot["buckets"].items():
+            yield self.name + "_bucket", {"le": bound}, n
+        yield self.name + "_count", {}, snapshot["count"]
+        yield self.name + "_sum", {}, snapshot["sum"]
+
+
+class Gauge(object):
+    """
+    A value read when the registry is collected, from *func*, which
+    returns an iterable of ``(labels, value)`` pairs.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, func, type=None):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+        if type is not None:
+            self.type = type
+
+    def collect(self):
+        return [
+            OrderedDict([("labels", labels), ("value", value)])
+            for labels, value in self.func()
+        ]
+
+    def samples(self):
+        for labels, value in self.func():
+            yield self.name, labels, value
+
+
+class Registry(object):
+    """A collection of named metrics."""
+
+    def __init__(self):
+        self.metrics = OrderedDict()
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError("Metric %r is already registered" % metric.name)
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation):
+        return self.register(Counter(name, documentation))
+
+    def histogram(self, name, documentation, buckets=DURATION_BUCKETS):
+        return self.register(Histogram(name, documentation, buckets))
+
+    def gauge(self, name, documentation, func, type=None):
+        return self.register(Gauge(name, documentation, func, type))
+
+    def collect(self):
+        """Returns the current value of every metric, *e.g.* for JSON."""
+        return OrderedDict(
+            (name, metric.collect()) for name, metric in self.metrics.items()
+        )
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append("# HELP %s %s" % (name, metric.documentation))
+            lines.append("# TYPE %s %s" % (name, metric.type))
+            for sample, labels, value in metric.samples():
+                lines.append(
+                    "%s%s %s" % (sample, format_labels(labels), format_value(value))
+                )
+        return "\n".join(lines) + "\n"
+
+
+#: The live :class:`.handlers.QueueHandler` instances.
+queue_handlers = weakref.WeakSet()
+
+
+def queue_labels(handler):
+    return {
+        "handler": handler.get_name() or "%s@%x" % (type(handler).__name__, id(handler))
+    }
+
+
+class Metrics(object):
+    """
+    The metrics measured by :class:`.middleware.LogSetupMiddleware` and
+    :class:`.logging_filters.RequestFilter`:
+
+    ``requestlogging_bind_seconds``, ``requestlogging_unbind_seconds``
+       Histograms of the time taken to bind and unbind each request.
+
+    ``requestlogging_records_per_request``
+       A histogram of the records stamped with each request's fields.
+
+    ``requestlogging_filter_calls_total``, ``requestlogging_records_total``
+       The calls to :class:`~.logging_filters.RequestFilter` and the
+       distinct records they were for. More than one call per record means
+       filters are stacked on a logger and its handlers.
+
+    ``requestlogging_queue_depth``, ``requestlogging_queue_dropped_total``
+       The records queued and dropped by each
+       :class:`.handlers.QueueHandler`.
+    """
+
+    def __init__(self, registry=None):
+        self.registry = registry = registry if registry is not None else Registry()
+        self.bind_seconds = registry.histogram(
+            "requestlogging_bind_seconds", "Time taken to bind a request."
+        )
+        self.unbind_seconds = registry.histogram(
+            "requestlogging_unbind_seconds", "Time taken to unbind a request."
+        )
+        self.records_per_request = registry.histogram(
+            "requestlogging_records_per_request",
+            "Records stamped with the fields of a request.",
+            COUNT_BUCKETS,
+        )
+        self.filter_calls = registry.counter(
+            "requestlogging_filter_calls_total", "Calls to RequestFilter.filter."
+        )
+        self.records = registry.counter(
+            "requestlogging_records_total", "Records passed to RequestFilter.filter."
+        )
+        registry.gauge(
+            "requestlogging_queue_depth",
+            "Records waiting in a QueueHandler.",
+            lambda: [(queue_labels(h), h.queue.qsize()) for h in list(queue_handlers)],
+        )
+        registry.gauge(
+            "requestlogging_queue_dropped_total",
+            "Records dropped by a QueueHandler.",
+            lambda: [(queue_labels(h), h.dropped) for h in list(queue_handlers)],
+            type="counter",
+        )
+
+    def filtered(self, record, request):
+        """Counts a call to RequestFilter.filter for *record*."""
+        self.filter_calls.inc()
+        calls = record.__dict__.get("requestlogging_filter_calls", 0) + 1
+        record.requestlogging_filter_calls = calls
+        if calls == 1:
+            self.records.inc()
+            if request is not None:
+                request.logging_records = getattr(request, "logging_records", 0) + 1
+
+
+_metrics = False
+
+
+def get_metrics():
+    """
+    Returns the :class:`Metrics`, or ``None`` unless
+    ``REQUESTLOGGING_METRICS`` is set.
+    """
+    global _metrics
+    if _metrics is False:
+        enabled = settings.configured and getattr(
+            settings, "REQUESTLOGGING_METRICS", False
+        )
+        _metrics = Metrics() if enabled else None
+    return _metrics
+
+
+@receiver(setting_changed)
+def _metrics_setting_changed(setting, **kwargs):
+    global _metrics
+    if setting == "REQUESTLOGGING_METRICS":
+        _metrics = False
+
+
+def metrics_view(request):
+    """Serves the metrics in the Prometheus text format; 404 if disabled."""
+    metrics = get_metrics()
+    if metrics is None:
+        return HttpResponse(
+            "Request logging metrics are disabled.\n",
+            status=404,
+            content_type="text/plain",
+        )
+    return HttpResponse(
+        metrics.registry.render(),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+    )
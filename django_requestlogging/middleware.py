@@ -30,23 +30,222 @@
 Request logging middleware
 ``````````````````````````
 """
+
 from __future__ import absolute_import, unicode_literals
 
+import binascii
+import itertools
 import logging
+import os
+import re
+import threading
+import time
 import weakref
 
 import six
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .logging_filters import (
+    RequestFields,
+    RequestFilter,
+    db_queries_enabled,
+    install_record_factory,
+    record_factory_installed,
+    reset_current_request,
+    run_request_finalizers,
+    set_current_request,
+)
+from .metrics import get_metrics
+from .queries import ExitStack, track_queries
+
+try:
+    from .aio import acall, aiter_access, iscoroutinefunction, markcoroutinefunction
+except SyntaxError:  # Python < 3.5
+    acall = None
+
+try:
+    from time import perf_counter_ns
+except ImportError:  # Python < 3.7
+
+    def perf_counter_ns():
+        return int(getattr(time, "perf_counter", time.time)() * 1e9)
+
 
-from .logging_filters import RequestFilter
+try:
+    # Per-thread CPU time, so concurrent requests are not counted.
+    from time import thread_time_ns as cpu_time_ns
+except ImportError:
+    try:
+        from time import process_time_ns as cpu_time_ns
+    except ImportError:  # Python < 3.7
+
+        def cpu_time_ns():
+            return int(getattr(time, "process_time", time.clock)() * 1e9)
 
 
 weakref_type = type(weakref.ref(lambda: None))
 
+#: Bind each request by adding a bound filter to every filterer.
+BINDING_FILTERS = "filters"
+#: Bind each request to the current context only.
+BINDING_CONTEXT = "context"
+#: Bind each request to the current context, and stamp every record when
+#: it is created.
+BINDING_FACTORY = "factory"
+
+# Serializes the copy-on-write updates of filter lists.
+_filters_lock = threading.Lock()
+
+# Incoming request IDs are only trusted if they look like this.
+REQUEST_ID_RE = re.compile(r"^[A-Za-z0-9._:/+=-]{1,128}$")
+
+# Bumped by :func:`invalidate_filterer_index` to force every
+# :class:`LogSetupMiddleware` to rediscover its filterers.
+_index_generation = 0
+
+# The filterers found by LogSetupMiddleware.find_filterers_with_filter,
+# with the logging_config_key() they were found under.
+_filterer_index = (None, {})
+
 
 def deref(x):
     return x() if x and type(x) == weakref_type else x
 
 
+def _reset_request_ids():
+    global _request_id_prefix, _request_id_counter
+    _request_id_prefix = binascii.hexlify(os.urandom(6)).decode("ascii")
+    _request_id_counter = itertools.count(1)
+
+
+_reset_request_ids()
+if hasattr(os, "register_at_fork"):
+    # Forked workers must not hand out their parent's IDs.
+    os.register_at_fork(after_in_child=_reset_request_ids)
+    _request_id_pid = None
+else:  # Python < 3.7
+    _request_id_pid = os.getpid()
+
+
+def generate_request_id():
+    """
+    Returns a new request ID, unique within this process's lifetime.
+
+    IDs are a random per-process prefix followed by a hexadecimal
+    counter, *e.g.* ``'3f9a1c2b4d5e-1a'``.
+    """
+    global _request_id_pid
+    if _request_id_pid is not None and _request_id_pid != os.getpid():
+        _request_id_pid = os.getpid()
+        _reset_request_ids()
+    # next() on itertools.count is atomic under the GIL
+    return "%s-%x" % (_request_id_prefix, next(_request_id_counter))
+
+
+def add_filter(filterer, f):
+    """
+    Adds filter *f* to *filterer* without modifying its filter list.
+
+    The list is replaced with a copy instead, so that other threads that
+    are iterating over it, in :meth:`logging.Filterer.filter`, are not
+    affected.
+    """
+    with _filters_lock:
+        if f not in filterer.filters:
+            filterer.filters = filterer.filters + [f]
+
+
+def remove_filter(filterer, f):
+    """Removes filter *f* from *filterer*, like :func:`add_filter`."""
+    with _filters_lock:
+        if f in filterer.filters:
+            filterer.filters = [other for other in filterer.filters if other is not f]
+
+
+def invalidate_filterer_index(**kwargs):
+    """
+    Forces every :class:`LogSetupMiddleware` to rediscover its filterers.
+
+    New handlers and :func:`logging.config.dictConfig` are noticed
+    automatically. Call this after adding an unbound
+    :class:`.logging_filters.RequestFilter` to a logger or an existing
+    handler at runtime. Accepts and ignores signal keyword arguments.
+    """
+    global _index_generation
+    _index_generation += 1
+
+
+def logging_config_key():
+    """
+    Returns a cheap fingerprint of the logging configuration.
+
+    The fingerprint changes whenever a handler is created or removed,
+    which covers :func:`logging.config.dictConfig`. Creating a logger does
+    not change it: new loggers have no filters, and lazily imported
+    modules creating theirs must not force a rescan during a request.
+    """
+    handlers = logging._handlerList
+    return (
+        _index_generation,
+        id(handlers),
+        len(handlers),
+        handlers[-1] if handlers else None,
+    )
+
+
+def build_filterer_index(root=""):
+    """
+    Finds the loggers and handlers under *root* that carry an unbound
+    :class:`.logging_filters.RequestFilter`, so that requests do not have
+    to. Called at startup by :class:`.apps.RequestLoggingConfig` with
+    ``REQUESTLOGGING_BINDING = 'filters'``, the only binding that uses
+    them.
+    """
+    # Skip __init__, which checks the settings and may install the
+    # record factory; looking for filterers only needs the root.
+    middleware = LogSetupMiddleware.__new__(LogSetupMiddleware)
+    middleware.root = root
+    return middleware.find_filterers_with_filter(RequestFilter)
+
+
+@receiver(setting_changed)
+def _logging_setting_changed(setting, **kwargs):
+    if setting == "LOGGING":
+        invalidate_filterer_index()
+
+
+class RequestBuffer(object):
+    """
+    The records held back for a request by
+    :class:`.handlers.RequestBufferHandler`, with the handler that holds
+    each of them.
+    """
+
+    __slots__ = ("start", "entries")
+
+    def __init__(self):
+        self.start = perf_counter_ns()
+        self.entries = []
+
+    def append(self, handler, record):
+        self.entries.append((handler, record))
+
+    def flush(self, failed):
+        """Hands the records back to their handlers. Safe to call more than once."""
+        entries, self.entries = self.entries, []
+        if not entries:
+            return
+        duration_ms = (perf_counter_ns() - self.start) / 1e6
+        by_handler = {}
+        for handler, record in entries:
+            by_handler.setdefault(handler, []).append(record)
+        for handler, records in by_handler.items():
+            handler.flush_request(records, failed, duration_ms)
+
+
 class LogSetupMiddleware(object):
     r"""
     Adds :class:`.logging_filters.RequestFilter` to every request.
@@ -60,8 +259,11 @@ class LogSetupMiddleware(object):
 
     Automatically detects which handlers and logger need
     RequestFilter installed, by looking for an unbound RequestFilter
-    attached to a handler or logger. To configure Django, in your
-    :envvar:`DJANGO_SETTINGS_MODULE`::
+    attached to a handler or logger. The result of that scan is cached
+    until the logging configuration changes (see
+    :func:`invalidate_filterer_index`), so binding a request only touches
+    the loggers and handlers that carry the filter. To configure Django,
+    in your :envvar:`DJANGO_SETTINGS_MODULE`::
 
        LOGGING = {
            'filters': {
@@ -86,15 +288,142 @@ class LogSetupMiddleware(object):
                },
            },
        }
+
+    The request is bound to the current context with
+    :func:`.logging_filters.set_current_request`, where unbound filters
+    read it, so the logging tree is never modified per request and
+    concurrent requests cannot see each other's data.
+
+    With ``REQUESTLOGGING_BINDING = 'filters'`` in your settings (or
+    ``binding='filters'``), a :class:`.logging_filters.RequestFilter`
+    bound to the request is also added to those loggers and handlers for
+    the duration of the request, so that records logged from threads
+    without a request of their own see it too. Filter lists are then
+    replaced rather than modified, and a bound filter leaves alone the
+    records of threads that are handling another request.
+
+    With ``REQUESTLOGGING_BINDING = 'factory'``, the request is bound
+    to the current context and :func:`.logging_filters.install_record_factory`
+    is called, so that every record is stamped once as it is created,
+    including records of loggers outside *root* or without a filter. No
+    loggers or handlers are looked for, and unbound filters do nothing.
+    As :meth:`logging.Logger.makeRecord` refuses to overwrite attributes,
+    ``extra`` can then no longer set the request fields.
+
+    The middleware is both sync and async capable. Under ASGI it runs as a
+    coroutine, so requests do not pay for a thread hop; use ``'context'``
+    binding there so that concurrent requests on the event loop, and the
+    tasks they spawn, each see their own request.
+
+    With ``REQUESTLOGGING_ACCESS_LOG`` set to a logger name (or
+    *access_log*), one record is logged to that logger per request once
+    the response is complete. Besides the request fields it carries:
+
+    ``status_code``
+       The HTTP status code of the response.
+
+    ``response_bytes``
+       The size of the response body. For streaming responses the
+       record is logged once the content has been sent.
+
+    ``duration_ms``
+       The wall time spent in and below this middleware, so put it first
+       in :data:`settings.MIDDLEWARE`.
+
+    ``cpu_time_ms``
+       The CPU time spent by the request thread over the same period.
+
+    With ``REQUESTLOGGING_DB_QUERIES = True`` (or *db_queries*), the
+    queries run on the request thread's database connections are counted
+    by a :class:`.queries.QueryStats` until the response is processed,
+    stored as ``request.logging_queries``. Records logged during the
+    request get the ``db_queries`` and ``db_time_ms`` so far, and the
+    access record also carries:
+
+    ``db_queries``, ``db_time_ms``
+       The number of queries and the time spent in them.
+
+    ``db_slowest_ms``, ``db_slowest_sql``
+       The time and the normalized SQL of the slowest query; see
+       :func:`.queries.normalize_sql`.
+
+    Under ASGI, queries of sync views, which run in another thread, are
+    not counted.
+
+    Every request is given an ID by :func:`generate_request_id`, stored
+    as ``request.request_id``. If ``REQUESTLOGGING_REQUEST_ID_HEADER`` (or
+    *request_id_header*) names a header, *e.g.* ``'X-Request-ID'``, a
+    well-formed ID in that request header is used instead, and the ID is
+    set in that response header.
+
+    With ``REQUESTLOGGING_BUFFER = True`` (or *buffer*), each request is
+    given a :class:`RequestBuffer`, stored as ``request.logging_buffer``,
+    in which :class:`.handlers.RequestBufferHandler` collects its records
+    until the response is processed.
+
+    With ``REQUESTLOGGING_METRICS = True``, the time taken to bind and
+    unbind each request and the records logged during it are measured;
+    see :class:`.metrics.Metrics`.
     """
+
     FILTER = RequestFilter
+    BINDINGS = (BINDING_FILTERS, BINDING_CONTEXT, BINDING_FACTORY)
+    sync_capable = True
+    async_capable = acall is not None
 
-    def __init__(self, get_response=None, root=""):
+    ACCESS_MESSAGE = '"%s %s" %s %s'
+
+    def __init__(
+        self,
+        get_response=None,
+        root="",
+        binding=None,
+        access_log=None,
+        request_id_header=None,
+        buffer=None,
+        db_queries=None,
+    ):
         self.root = root
         self.get_response = get_response
+        if binding is None:
+            binding = getattr(settings, "REQUESTLOGGING_BINDING", BINDING_CONTEXT)
+        if binding not in self.BINDINGS:
+            raise ImproperlyConfigured(
+                "REQUESTLOGGING_BINDING must be one of %s, not %r."
+                % (", ".join(self.BINDINGS), binding)
+            )
+        self.binding = binding
+        if binding == BINDING_FACTORY:
+            install_record_factory()
+        if access_log is None:
+            access_log = getattr(settings, "REQUESTLOGGING_ACCESS_LOG", None)
+        self.access_logger = logging.getLogger(access_log) if access_log else None
+        if request_id_header is None:
+            request_id_header = getattr(
+                settings, "REQUESTLOGGING_REQUEST_ID_HEADER", None
+            )
+        self.request_id_header = request_id_header
+        if request_id_header:
+            self.request_id_meta = "HTTP_" + request_id_header.upper().replace("-", "_")
+        else:
+            self.request_id_meta = None
+        if buffer is None:
+            buffer = getattr(settings, "REQUESTLOGGING_BUFFER", False)
+        self.buffer = buffer
+        if db_queries is None:
+            db_queries = db_queries_enabled()
+        if db_queries and ExitStack is None:
+            raise ImproperlyConfigured("REQUESTLOGGING_DB_QUERIES requires Python 3.")
+        self.db_queries = db_queries
+        self.metrics = get_metrics()
+        self.is_async = acall is not None and iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
         super(LogSetupMiddleware, self).__init__()
 
     def __call__(self, request):
+        if self.is_async:
+            return acall(self, request)
         response = None
         response = self.process_request(request)
         if not response:
@@ -110,7 +439,11 @@ class LogSetupMiddleware(object):
         # that are under ``self.root``.
         result = {}
         prefix = self.root + "."
-        for name, logger in six.iteritems(logging.Logger.manager.loggerDict):
+        # Copy under the logging lock, in case another thread is creating
+        # a logger.
+        with logging._lock:
+            items = list(six.iteritems(logging.Logger.manager.loggerDict))
+        for name, logger in items:
             if self.root and not name.startswith(prefix):
                 # Does not fall under self.root
                 continue
@@ -123,7 +456,8 @@ class LogSetupMiddleware(object):
         """
         Returns a list of handlers.
         """
-        return list(logging._handlerList)
+        with logging._lock:
+            return list(logging._handlerList)
 
     def _find_filterer_with_filter(self, filterers, filter_cls):
         """
@@ -162,36 +496,184 @@ class LogSetupMiddleware(object):
         """
         return self._find_filterer_with_filter(self.find_handlers(), filter_cls)
 
+    def find_filterers_with_filter(self, filter_cls):
+        """
+        Returns a :class:`tuple` of loggers and handlers that have
+        *filter_cls* filters.
+
+        The result is shared by all middleware with the same *root*, and
+        cached until :func:`logging_config_key` changes. It is built at
+        startup for the default *root*; see :func:`build_filterer_index`.
+        Handlers are held as weak references, so they may need to be
+        dereferenced with :func:`deref`.
+        """
+        global _filterer_index
+        key = logging_config_key()
+        # Read and replaced as a whole, so concurrent requests never see
+        # a half-updated index.
+        index_key, index = _filterer_index
+        if key != index_key:
+            index = {}
+            _filterer_index = (key, index)
+        entry = (type(self), self.root, filter_cls)
+        try:
+            return index[entry]
+        except KeyError:
+            pass
+        loggers = list(self.find_loggers_with_filter(filter_cls))
+        handlers = [weakref.ref(h) for h in self.find_handlers_with_filter(filter_cls)]
+        filterers = index[entry] = tuple(loggers + handlers)
+        return filterers
+
     def add_filter(self, f, filter_cls=None):
         """Add filter *f* to any loggers that have *filter_cls* filters."""
         if filter_cls is None:
             filter_cls = type(f)
-        for logger in self.find_loggers_with_filter(filter_cls):
-            logger.addFilter(f)
-        for handler in self.find_handlers_with_filter(filter_cls):
-            handler.addFilter(f)
+        for filterer in map(deref, self.find_filterers_with_filter(filter_cls)):
+            if filterer is not None:
+                add_filter(filterer, f)
 
     def remove_filter(self, f):
         """Remove filter *f* from all loggers."""
-        for logger in self.find_loggers_with_filter(type(f)):
-            logger.removeFilter(f)
-        for handler in self.find_handlers_with_filter(type(f)):
-            handler.removeFilter(f)
+        for filterer in map(deref, self.find_filterers_with_filter(type(f))):
+            if filterer is not None:
+                remove_filter(filterer, f)
+
+    def bind(self, request):
+        """Makes *request* visible to the request filters."""
+        metrics = self.metrics
+        if metrics is not None:
+            start = perf_counter_ns()
+        request.logging_context = set_current_request(request)
+        if self.binding == BINDING_FILTERS:
+            request.logging_filter = RequestFilter(request)
+            self.add_filter(request.logging_filter)
+        if metrics is not None:
+            metrics.bind_seconds.observe((perf_counter_ns() - start) / 1e9)
+
+    def unbind(self, request):
+        """Reverses :meth:`bind`. Safe to call more than once."""
+        metrics = self.metrics
+        if metrics is not None:
+            start = perf_counter_ns()
+        fields = getattr(request, "logging_fields", None)
+        if fields is not None:
+            fields.resolve()
+        token = getattr(request, "logging_context", None)
+        if token is not None:
+            request.logging_context = None
+            reset_current_request(token)
+        f = getattr(request, "logging_filter", None)
+        if f:
+            self.remove_filter(f)
+        if metrics is not None and token is not None:
+            metrics.unbind_seconds.observe((perf_counter_ns() - start) / 1e9)
+            metrics.records_per_request.observe(getattr(request, "logging_records", 0))
+
+    def log_access(self, request, response, size):
+        """Logs the access record for *request* to :attr:`access_logger`."""
+        timer = getattr(request, "logging_timer", None)
+        if timer is None:
+            return
+        request.logging_timer = None
+        start, cpu_start = timer
+        status = response.status_code
+        fields = RequestFields.for_request(request)
+        # Logger.makeRecord() refuses extra keys that the record factory
+        # has already set.
+        extra = {} if record_factory_installed() else fields.as_dict()
+        extra["status_code"] = status
+        extra["response_bytes"] = size
+        extra["duration_ms"] = (perf_counter_ns() - start) / 1e6
+        extra["cpu_time_ms"] = (cpu_time_ns() - cpu_start) / 1e6
+        queries = getattr(request, "logging_queries", None)
+        if queries is not None:
+            extra["db_slowest_ms"] = queries.slowest_ms
+            extra["db_slowest_sql"] = queries.slowest_sql
+        if status >= 500:
+            level = logging.ERROR
+        elif status >= 400:
+            level = logging.WARNING
+        else:
+            level = logging.INFO
+        # The request may already be unbound; rebind it so that unbound
+        # filters on the access logger do not overwrite the fields.
+        token = set_current_request(request)
+        try:
+            self.access_logger.log(
+                level,
+                self.ACCESS_MESSAGE,
+                fields.request_method,
+                fields.path_info,
+                status,
+                size,
+                extra=extra,
+            )
+        finally:
+            reset_current_request(token)
+        fields.resolve()
+
+    def iter_access(self, request, response, content):
+        """Passes *content* through, logging the access record at the end."""
+        size = 0
+        try:
+            for chunk in content:
+                size += len(chunk)
+                yield chunk
+        finally:
+            self.log_access(request, response, size)
+
+    def flush_buffer(self, request, response=None):
+        """
+        Flushes the records held back for *request*, if any, as failed
+        unless there is a *response* without a server error.
+        """
+        buffer = getattr(request, "logging_buffer", None)
+        if buffer is not None:
+            buffer.flush(response is None or response.status_code >= 500)
+
+    def get_request_id(self, request):
+        """Returns the ID for *request*, from its header if allowed."""
+        if self.request_id_meta is not None:
+            request_id = request.META.get(self.request_id_meta)
+            if request_id and REQUEST_ID_RE.match(request_id):
+                return request_id
+        return generate_request_id()
 
     def process_request(self, request):
         """Adds a filter, bound to *request*, to the appropriate loggers."""
-        request.logging_filter = RequestFilter(request)
-        self.add_filter(request.logging_filter)
+        request.request_id = self.get_request_id(request)
+        if self.access_logger is not None:
+            request.logging_timer = (perf_counter_ns(), cpu_time_ns())
+        if self.buffer:
+            request.logging_buffer = RequestBuffer()
+        if self.db_queries:
+            request.logging_queries = track_queries(request)
+        self.bind(request)
 
     def process_response(self, request, response):
         """Removes this *request*'s filter from all loggers."""
-        f = getattr(request, "logging_filter", None)
-        if f:
-            self.remove_filter(f)
+        run_request_finalizers(request)
+        self.flush_buffer(request, response)
+        self.unbind(request)
+        if self.request_id_header and hasattr(request, "request_id"):
+            response[self.request_id_header] = request.request_id
+        if self.access_logger is None:
+            return response
+        if not getattr(response, "streaming", False):
+            self.log_access(request, response, len(response.content))
+        elif getattr(response, "is_async", False):
+            response.streaming_content = aiter_access(
+                self, request, response, response.streaming_content
+            )
+        else:
+            response.streaming_content = self.iter_access(
+                request, response, response.streaming_content
+            )
         return response
 
     def process_exception(self, request, exception):
         """Removes this *request*'s filter from all loggers."""
-        f = getattr(request, "logging_filter", None)
-        if f:
-            self.remove_filter(f)
+        run_request_finalizers(request)
+        self.flush_buffer(request)
+        self.unbind(request)
@@ -0,0 +1,135 @@
+# -*- mode: django; coding: utf-8 -*-
+#
+# Copyright © 2011, TrustCentric
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of TrustCentric nor the names of its contributors
+#       may be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+``queries``
+-----------
+
+Per-request database query statistics, collected with
+:meth:`~django.db.backends.base.base.BaseDatabaseWrapper.execute_wrapper`.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import re
+
+from django.db import connections
+
+from .logging_filters import add_request_finalizer
+
+try:
+    from contextlib import ExitStack
+except ImportError:  # Python 2
+    ExitStack = None
+
+try:
+    from time import perf_counter_ns
+except ImportError:  # Python < 3.7
+    import time
+
+    def perf_counter_ns():
+        return int(time.perf_counter() * 1e9)
+
+
+# String and number literals, which normalize to a placeholder.
+LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+# Lists of placeholders, as in ``IN (%s, %s, %s)``.
+PLACEHOLDER_LIST_RE = re.compile(r"\(\s*%s(?:\s*,\s*%s)+\s*\)")
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_sql(sql):
+    """
+    Returns *sql* with literals replaced by ``%s``, lists of placeholders
+    collapsed to ``(%s, ...)`` and whitespace collapsed, so that the same
+    statement with different arguments reads the same.
+    """
+    sql = LITERAL_RE.sub("%s", sql)
+    sql = PLACEHOLDER_LIST_RE.sub("(%s, ...)", sql)
+    return WHITESPACE_RE.sub(" ", sql).strip()
+
+
+class QueryStats(object):
+    """
+    The queries run during a request: their :attr:`count`, their total
+    time and the slowest of them.
+
+    An instance is a database execute wrapper. Each query costs two clock
+    reads and a few additions; the slowest statement is only normalized
+    when it is read, and no record is logged per query.
+    """
+
+    __slots__ = ("count", "time_ns", "slowest_ns", "slowest")
+
+    def __init__(self):
+        self.count = 0
+        self.time_ns = 0
+        self.slowest_ns = 0
+        self.slowest = None
+
+    def __call__(self, execute, sql, params, many, context):
+        start = perf_counter_ns()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = perf_counter_ns() - start
+            self.count += 1
+            self.time_ns += elapsed
+            if elapsed > self.slowest_ns:
+                self.slowest_ns = elapsed
+                self.slowest = sql
+
+    @property
+    def time_ms(self):
+        """The total time spent in queries, in milliseconds."""
+        return self.time_ns / 1e6
+
+    @property
+    def slowest_ms(self):
+        """The time taken by the slowest query, in milliseconds."""
+        return self.slowest_ns / 1e6
+
+    @property
+    def slowest_sql(self):
+        """The normalized SQL of the slowest query, or ``'-'``."""
+        return normalize_sql(self.slowest) if self.slowest is not None else "-"
+
+
+def track_queries(request):
+    """
+    Returns a :class:`QueryStats` wrapping the queries run on every
+    database connection of the current thread until the request
+    finalizers of *request* run; see
+    :func:`.logging_filters.run_request_finalizers`.
+    """
+    stats = QueryStats()
+    stack = ExitStack()
+    for connection in connections.all():
+        stack.enter_context(connection.execute_wrapper(stats))
+    add_request_finalizer(request, stack.close)
+    return stats
@@ -0,0 +1,206 @@
+# -*- mode: django; coding: utf-8 -*-
+#
+# Copyright © 2011, TrustCentric
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of TrustCentric nor the names of its contributors
+#       may be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+``segments``
+------------
+
+Reading and merging the per-worker segment files written by
+:class:`.handlers.SegmentFileHandler`.
+
+Each entry in a segment is the record's creation time, a tab and the
+formatted record. Entries are in order within a segment, so the
+segments can be merged without sorting them. Any further lines of the record are indented with a
+tab, so that an entry can be told apart from a multi-line message.
+
+The segments can be merged into one stream, ordered by time, with the
+``merge_log_segments`` management command or with::
+
+    python -m django_requestlogging.segments [--output FILE] [--prefix PREFIX] SEGMENT ...
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import argparse
+import glob
+import heapq
+import io
+import os
+import sys
+
+#: The file name pattern of segments with a given prefix, within a
+#: directory.
+SEGMENT_GLOB = "%s-*-*.log"
+
+
+def encode_entry(created, text):
+    """Returns the segment entry for a record *created* and formatted as *text*."""
+    return "%.6f\t%s\n" % (created, text.replace("\n", "\n\t"))
+
+
+def read_entries(stream):
+    """
+    Yields ``(timestamp, lines)`` for each entry in the binary *stream*,
+    where *lines* is a :class:`list` of the raw lines of the entry.
+
+    Lines without a timestamp, such as what is left of a write cut short
+    by a crash, are kept with the entry before them.
+    """
+    timestamp, lines = None, None
+    for line in stream:
+        if not line.startswith(b"\t"):
+            created, sep, _ = line.partition(b"\t")
+            try:
+                created = float(created) if sep else None
+            except ValueError:
+                created = None
+            if created is not None:
+                if lines is not None:
+                    yield timestamp, lines
+                timestamp, lines = created, [line]
+                continue
+        if lines is None:
+            timestamp, lines = 0.0, []
+        lines.append(line)
+    if lines is not None:
+        yield timestamp, lines
+
+
+def _keyed_entries(index, stream):
+    for n, (timestamp, lines) in enumerate(read_entries(stream)):
+        # Unique keys, so the lines themselves are never compared
+        yield timestamp, index, n, lines
+
+
+def strip_entry(lines):
+    """Returns *lines* without the timestamp and continuation indents."""
+    first = lines[0]
+    if not first.startswith(b"\t"):
+        first = first.partition(b"\t")[2]
+    return [first] + [
+        line[1:] if line.startswith(b"\t") else line for line in lines[1:]
+    ]
+
+
+def merge_segments(streams, output, timestamps=False):
+    """
+    Writes the entries of the binary *streams* to *output*, ordered by
+    time, as the formatted records unless *timestamps* is set.
+
+    The streams are merged lazily, so memory use is bounded by one entry
+    per stream however large they are. Entries with the same timestamp
+    stay in the order of *streams*. Returns the number of entries.
+    """
+    count = 0
+    merged = heapq.merge(
+        *[_keyed_entries(i, stream) for i, stream in enumerate(streams)]
+    )
+    for count, (_, _, _, lines) in enumerate(merged, 1):
+        output.writelines(lines if timestamps else strip_entry(lines))
+    return count
+
+
+def segment_paths(paths, prefix="requests"):
+    """
+    Expands any directories among *paths* to the segments in them whose
+    names start with *prefix*, so that other files there, such as a
+    merged log, are left out.
+    """
+    result = []
+    for path in paths:
+        if os.path.isdir(path):
+            pattern = os.path.join(path, SEGMENT_GLOB % prefix)
+            result.extend(sorted(glob.glob(pattern)))
+        else:
+            result.append(path)
+    return result
+
+
+def merge_segment_files(
+    paths,
+    output,
+    timestamps=False,
+    buffer_size=io.DEFAULT_BUFFER_SIZE,
+    prefix="requests",
+):
+    """
+    Opens the segments at *paths*, found with :func:`segment_paths`, and
+    merges them with :func:`merge_segments`.
+    """
+    streams = []
+    try:
+        for path in segment_paths(paths, prefix):
+            streams.append(io.open(path, "rb", buffering=buffer_size))
+        return merge_segments(streams, output, timestamps)
+    finally:
+        for stream in streams:
+            stream.close()
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "segments", nargs="+", help="segment files, or directories of them"
+    )
+    parser.add_argument(
+        "--output",
+        "-o",
+        default="-",
+        help="write the merged log here instead of stdout",
+    )
+    parser.add_argument(
+        "--timestamps", action="store_true", help="keep the timestamp of each entry"
+    )
+    parser.add_argument(
+        "--prefix",
+        default="requests",
+        help="the prefix of the segments to merge from directories",
+    )
+
+
+def merge(segments, output="-", timestamps=False, prefix="requests"):
+    """Merges *segments* into the file *output*, or stdout for ``'-'``."""
+    if output == "-":
+        stream = getattr(sys.stdout, "buffer", sys.stdout)
+        count = merge_segment_files(segments, stream, timestamps, prefix=prefix)
+        stream.flush()
+        return count
+    with io.open(output, "wb") as stream:
+        return merge_segment_files(segments, stream, timestamps, prefix=prefix)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Merges log segments into one stream ordered by time."
+    )
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    merge(args.segments, args.output, args.timestamps, args.prefix)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+# -*- mode: django; coding: utf-8 -*-
+#
+# Copyright © 2011, TrustCentric
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of TrustCentric nor the names of its contributors
+#       may be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+``testing``
+-----------
+
+Stand-ins for the services request logs are sent to, for tests and
+benchmarks.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import json
+import socket
+import threading
+import time
+
+from .handlers import FRAME_HEADER
+
+
+class FakeCollector(object):
+    """
+    A TCP server on the loopback interface that accepts the frames sent by
+    :class:`.handlers.BatchingSocketHandler` and keeps the records in
+    :attr:`records`, and the raw payloads in :attr:`frames`::
+
+       collector = FakeCollector()
+       handler = BatchingSocketHandler("127.0.0.1", collector.port)
+       ...
+       collector.wait_for(10)
+       collector.stop()
+
+    :param port: The port to listen on; by default, any free port.
+    :param decode: Whether to decode the frames; with ``False``, the
+        collector only counts the bytes it reads, in :attr:`received`, so
+        it can stand in for other protocols.
+    """
+
+    def __init__(self, port=0, decode=True):
+        self.decode = decode
+        self.records = []
+        self.frames = []
+        self.received = 0
+        self.condition = threading.Condition()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(("127.0.0.1", port))
+        self.server.listen(16)
+        self.port = self.server.getsockname()[1]
+        self.connections = []
+        self.running = True
+        self.thread = self._spawn(self.accept)
+
+    def _spawn(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def accept(self):
+        while self.running:
+            try:
+                conn, _ = self.server.accept()
+            except (OSError, socket.error):
+                return
+            self.connections.append(conn)
+            self._spawn(self.serve, conn)
+
+    def serve(self, conn):
+        stream = conn.makefile("rb")
+        try:
+            if not self.decode:
+                for chunk in iter(lambda: stream.read1(65536), b""):
+                    with self.condition:
+                        self.received += len(chunk)
+                        self.condition.notify_all()
+                return
+            while True:
+                header = stream.read(FRAME_HEADER.size)
+                if len(header) < FRAME_HEADER.size:
+                    return
+                (size,) = FRAME_HEADER.unpack(header)
+                payload = stream.read(size)
+                if len(payload) < size:
+                    return
+                with self.condition:
+                    self.frames.append(payload)
+                    self.records.extend(json.loads(payload.decode("utf-8")))
+                    self.received += FRAME_HEADER.size + size
+                    self.condition.notify_all()
+        except (OSError, socket.error, ValueError):
+            pass
+        finally:
+            stream.close()
+            conn.close()
+
+    def wait_for(self, count, timeout=5.0):
+        """
+        Waits until :attr:`records` holds *count* records (or, without
+        decoding, :attr:`received` *count* bytes); returns whether it does.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while (len(self.records) if self.decode else self.received) < count:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+    def stop(self):
+        """Closes the listening socket and every connection."""
+        self.running = False
+        try:
+            # Wakes up the thread blocked in accept().
+            self.server.shutdown(socket.SHUT_RDWR)
+        except (OSError, socket.error):
+            pass
+        self.server.close()
+        for conn in self.connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except (OSError, socket.error):
+                pass
+            conn.close()
+        self.thread.join(1)
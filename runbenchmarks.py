@@ -0,0 +1,528 @@
+#!/usr/bin/env python
+"""
+Benchmarks for django_requestlogging.
+
+Usage::
+
+    python runbenchmarks.py [--number N] [--output FILE] [--compare FILE] [benchmark ...]
+
+Results are written as a single JSON object keyed by benchmark name,
+along with the versions and commit they were measured on. Pass the
+output of an earlier run to ``--compare`` to print the ratio of every
+measurement to it. Requires Python 3.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+
+import django
+
+
+BENCHMARKS = OrderedDict()
+
+# The parameters that identify a row of a grid benchmark.
+GRID_PARAMETERS = ('binding', 'loggers', 'handlers', 'lines', 'threads')
+
+
+def benchmark(func):
+    """Registers *func* as a benchmark taking the parsed arguments."""
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def result(elapsed, number):
+    return OrderedDict([
+        ('per_call_us', elapsed / number * 1e6),
+        ('calls_per_sec', number / elapsed if elapsed else float('inf')),
+    ])
+
+
+def timed(func, number):
+    """Calls *func* *number* times and returns the timing result."""
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    return result(time.perf_counter() - start, number)
+
+
+def timed_async(func, number):
+    """Awaits *func* *number* times on a fresh event loop."""
+    async def run():
+        start = time.perf_counter()
+        for _ in range(number):
+            await func()
+        return time.perf_counter() - start
+
+    return result(asyncio.run(run()), number)
+
+
+@benchmark
+def middleware_sync_vs_async(args):
+    """
+    Throughput of the ``testapp`` ``HelloWorld`` view behind
+    LogSetupMiddleware under WSGI and under ASGI, both with a sync-only
+    middleware (adapted by Django with a thread hop each way) and with
+    the native coroutine path.
+    """
+    from asgiref.sync import async_to_sync, sync_to_async
+    from django.test import RequestFactory
+
+    from django_requestlogging.middleware import LogSetupMiddleware
+    from testapp.urls import HelloWorld
+
+    view = HelloWorld.as_view()
+
+    async def async_view(request):
+        return view(request)
+
+    number = args.number
+    request = RequestFactory().get('/')
+    results = OrderedDict()
+    for binding in ('filters', 'context'):
+        wsgi = LogSetupMiddleware(view, binding=binding)
+        asgi_sync_only = sync_to_async(LogSetupMiddleware(async_to_sync(async_view), binding=binding))
+        asgi_native = LogSetupMiddleware(async_view, binding=binding)
+        results[binding] = OrderedDict([
+            ('wsgi', timed(lambda: wsgi(request), number)),
+            ('asgi_sync_only', timed_async(lambda: asgi_sync_only(request), number)),
+            ('asgi_native', timed_async(lambda: asgi_native(request), number)),
+        ])
+    return results
+
+
+@benchmark
+def json_formatter(args):
+    """
+    Records/sec of JSONFormatter against ``json.dumps(record.__dict__)``
+    for a record stamped by RequestFilter.
+    """
+    import logging
+
+    from django.test import RequestFactory
+
+    from django_requestlogging import formatters
+    from django_requestlogging.logging_filters import RequestFilter
+
+    record = logging.LogRecord('benchmark', logging.INFO, __file__, 1, 'hello %s', ('world',), None)
+    RequestFilter(RequestFactory().get('/')).filter(record)
+    formatter = formatters.JSONFormatter()
+    number = args.number
+
+    def stdlib():
+        record.message = record.getMessage()
+        return json.dumps(record.__dict__, default=str)
+
+    return OrderedDict([
+        ('encoder', 'orjson' if formatters.orjson else 'ujson' if formatters.ujson else 'json'),
+        ('json_formatter', timed(lambda: formatter.format(record), number)),
+        ('stdlib_dict_dumps', timed(stdlib, number)),
+    ])
+
+
+@benchmark
+def request_id(args):
+    """Cost of generate_request_id() against ``str(uuid.uuid4())``."""
+    import uuid
+
+    from django_requestlogging.middleware import generate_request_id
+
+    return OrderedDict([
+        ('generate_request_id', timed(generate_request_id, args.number)),
+        ('uuid4', timed(lambda: str(uuid.uuid4()), args.number)),
+    ])
+
+
+@benchmark
+def filter_outside_request(args):
+    """
+    Cost of an unbound RequestFilter on a record logged outside any
+    request, stamping placeholders and leaving the record alone, against
+    extracting the fields from a missing request.
+    """
+    from django_requestlogging.logging_filters import RequestFields, RequestFilter
+
+    record = logging.LogRecord('benchmark', logging.INFO, __file__, 1, 'hello', (), None)
+    placeholders = RequestFilter()
+    no_placeholders = RequestFilter(placeholders=False)
+    return OrderedDict([
+        ('placeholders', timed(lambda: placeholders.filter(record), args.number)),
+        ('no_placeholders', timed(lambda: no_placeholders.filter(record), args.number)),
+        ('extract_from_none', timed(lambda: RequestFields(None).stamp(record), args.number)),
+    ])
+
+
+@benchmark
+def scrubbing(args):
+    """
+    Per-record cost of RequestFilter within a request, without scrubbing
+    and with ten REQUESTLOGGING_SCRUB patterns, for records whose
+    arguments repeat within the request and for distinct ones.
+    """
+    from django.test import RequestFactory
+    from django.test.utils import override_settings
+
+    from django_requestlogging.logging_filters import RequestFilter
+
+    patterns = [r'(?<=%s=)[^&\s]+' % name for name in ('token', 'key', 'secret', 'password', 'code')]
+    patterns += [r'\bsk_\w+', r'\bpk_\w+', r'\beyJ[\w-]+\.[\w-]+\.[\w-]+', r'\b\d{16}\b', r'\bghp_\w+']
+    counter = itertools.count()
+
+    def measure():
+        request = RequestFactory().get('/orders/1234/', {'token': 'abc'}, HTTP_USER_AGENT='benchmark')
+        request_filter = RequestFilter(request)
+
+        def repeated():
+            record = logging.LogRecord('benchmark', logging.INFO, __file__, 1, 'GET %s -> %s',
+                                       ('/api/items?page=2&token=abc123', 200), None)
+            request_filter.filter(record)
+
+        def distinct():
+            record = logging.LogRecord('benchmark', logging.INFO, __file__, 1, 'GET %s -> %s',
+                                       ('/api/items?page=%d&token=abc123' % next(counter), 200), None)
+            request_filter.filter(record)
+
+        return OrderedDict([
+            ('repeated_args', timed(repeated, args.number)),
+            ('distinct_args', timed(distinct, args.number)),
+        ])
+
+    results = OrderedDict()
+    with override_settings(REQUESTLOGGING_SCRUB=None):
+        results['disabled'] = measure()
+    with override_settings(REQUESTLOGGING_SCRUB=patterns):
+        results['enabled'] = measure()
+    return results
+
+
+@benchmark
+def network_handler(args):
+    """
+    Per-record cost, on the logging thread, of BatchingSocketHandler and of
+    the stdlib SocketHandler (one pickled record per write) sending to a
+    local FakeCollector, and the time until the collector has received
+    every batched record.
+    """
+    from logging.handlers import SocketHandler
+
+    from django_requestlogging.handlers import BatchingSocketHandler
+    from django_requestlogging.testing import FakeCollector
+
+    record = logging.LogRecord('benchmark', logging.INFO, __file__, 1, 'GET %s -> %s', ('/api/items', 200), None)
+    results = OrderedDict()
+
+    collector = FakeCollector()
+    handler = BatchingSocketHandler('127.0.0.1', collector.port, maxsize=args.number)
+    try:
+        start = time.perf_counter()
+        results['batching'] = timed(lambda: handler.handle(record), args.number)
+        collector.wait_for(args.number, timeout=60)
+        results['batching_delivered'] = result(time.perf_counter() - start, args.number)
+        results['batching_dropped'] = handler.dropped
+    finally:
+        handler.close()
+        collector.stop()
+
+    collector = FakeCollector(decode=False)
+    handler = SocketHandler('127.0.0.1', collector.port)
+    try:
+        results['stdlib_socket'] = timed(lambda: handler.handle(record), args.number)
+    finally:
+        handler.close()
+        collector.stop()
+    return results
+
+
+@benchmark
+def query_stats(args):
+    """
+    Per-query overhead of the REQUESTLOGGING_DB_QUERIES execute wrapper
+    around a query that does nothing, against calling it directly.
+    """
+    from django_requestlogging.queries import QueryStats
+
+    stats = QueryStats()
+
+    def execute(sql, params, many, context):
+        return None
+
+    sql = 'SELECT "auth_user"."id" FROM "auth_user" WHERE "auth_user"."id" = %s'
+    return OrderedDict([
+        ('direct', timed(lambda: execute(sql, (1,), False, None), args.number)),
+        ('wrapped', timed(lambda: stats(execute, sql, (1,), False, None), args.number)),
+    ])
+
+
+def pauses(func, number):
+    """
+    Calls *func* *number* times and returns the timing result with the
+    99.9th percentile and the longest call.
+    """
+    durations = []
+    for _ in range(number):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    durations.sort()
+    timing = result(sum(durations), number)
+    timing['p999_us'] = durations[int(number * 0.999)] * 1e6
+    timing['max_ms'] = durations[-1] * 1e3
+    return timing
+
+
+@benchmark
+def rotating_handler(args):
+    """
+    Per-record cost and longest pause of CompressingRotatingFileHandler,
+    rotating every 1 MiB and compressing in the background, against the
+    stdlib RotatingFileHandler with a gzip rotator, which compresses in
+    the logging thread.
+    """
+    import gzip
+    import shutil
+    import tempfile
+    from logging.handlers import RotatingFileHandler
+
+    from django_requestlogging.handlers import CompressingRotatingFileHandler
+
+    def gzip_rotator(source, dest):
+        with open(source, 'rb') as f, gzip.open(dest, 'wb', compresslevel=6) as out:
+            shutil.copyfileobj(f, out, 1024 * 1024)
+        os.remove(source)
+
+    record = logging.LogRecord('benchmark', logging.INFO, __file__, 1, 'GET %s -> %s %s',
+                               ('/api/items', 200, 'x' * 150), None)
+    results = OrderedDict()
+    directory = tempfile.mkdtemp()
+    try:
+        handler = CompressingRotatingFileHandler(os.path.join(directory, 'compressing.log'), max_bytes=1 << 20)
+        try:
+            results['compressing'] = pauses(lambda: handler.handle(record), args.number)
+        finally:
+            handler.close()
+
+        handler = RotatingFileHandler(os.path.join(directory, 'stdlib.log'), maxBytes=1 << 20, backupCount=1000)
+        handler.namer = lambda name: name + '.gz'
+        handler.rotator = gzip_rotator
+        try:
+            results['stdlib_gzip'] = pauses(lambda: handler.handle(record), args.number)
+        finally:
+            handler.close()
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+class FormattingHandler(logging.Handler):
+    """A handler that formats records and throws them away."""
+
+    def emit(self, record):
+        self.format(record)
+
+
+def build_tree(loggers, handlers):
+    """
+    Creates *loggers* loggers under ``benchmark`` and *handlers* handlers
+    carrying an unbound RequestFilter. Returns a cleanup function.
+    """
+    from django_requestlogging.logging_filters import RequestFilter
+    from django_requestlogging.middleware import invalidate_filterer_index
+
+    request_filter = RequestFilter()
+    formatter = logging.Formatter('%(request_id)s %(remote_addr)s %(path_info)s %(message)s')
+    root = logging.getLogger('benchmark')
+    root.propagate = False
+    root.setLevel(logging.INFO)
+    root.addFilter(request_filter)
+    for i in range(loggers - 1):
+        logging.getLogger('benchmark.tree.%d' % i)
+    for _ in range(handlers):
+        handler = FormattingHandler()
+        handler.setFormatter(formatter)
+        handler.addFilter(request_filter)
+        root.addHandler(handler)
+
+    def cleanup():
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+            handler.close()
+        root.filters = []
+        manager = logging.Logger.manager
+        for name in [name for name in manager.loggerDict if name.startswith('benchmark.')]:
+            del manager.loggerDict[name]
+        invalidate_filterer_index()
+
+    return cleanup
+
+
+def run_threads(func, number, threads):
+    """Runs *func* *number* times over *threads* threads; returns seconds."""
+    per_thread = [number // threads + (i < number % threads) for i in range(threads)]
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(count):
+        barrier.wait()
+        for _ in range(count):
+            func()
+
+    workers = [threading.Thread(target=worker, args=(count,)) for count in per_thread]
+    for worker_thread in workers:
+        worker_thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for worker_thread in workers:
+        worker_thread.join()
+    return time.perf_counter() - start
+
+
+@benchmark
+def middleware_overhead(args):
+    """
+    Per-request overhead of LogSetupMiddleware around the ``testapp``
+    ``HelloWorld`` view, over the grid of logger tree sizes, handlers
+    carrying an unbound RequestFilter, log lines per request, worker
+    threads and binding modes given on the command line.
+    """
+    from django.test import RequestFactory
+
+    from django_requestlogging.middleware import LogSetupMiddleware
+    from testapp.urls import HelloWorld
+
+    hello = HelloWorld.as_view()
+    view_logger = logging.getLogger('benchmark.view')
+    factory = RequestFactory()
+    results = []
+    grid = itertools.product(args.bindings, args.loggers, args.handlers, args.lines, args.threads)
+    for binding, loggers, handlers, lines, threads in grid:
+        cleanup = build_tree(loggers, handlers)
+        try:
+            def view(request):
+                for i in range(lines):
+                    view_logger.info('line %d', i)
+                return hello(request)
+
+            middleware = LogSetupMiddleware(view, root='benchmark', binding=binding)
+
+            def with_middleware():
+                middleware(factory.get('/'))
+
+            def without_middleware():
+                view(factory.get('/'))
+
+            # Warm up, e.g. the filterer index
+            with_middleware()
+            baseline = run_threads(without_middleware, args.number, threads)
+            elapsed = run_threads(with_middleware, args.number, threads)
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            for _ in range(100):
+                with_middleware()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        finally:
+            cleanup()
+        results.append(OrderedDict([
+            ('binding', binding),
+            ('loggers', loggers),
+            ('handlers', handlers),
+            ('lines', lines),
+            ('threads', threads),
+            ('per_request_us', elapsed / args.number * 1e6),
+            ('overhead_us', (elapsed - baseline) / args.number * 1e6),
+            ('requests_per_sec', args.number / elapsed),
+            ('records_per_sec', args.number * lines / elapsed),
+            ('peak_alloc_bytes_per_request', (peak - before) / 100.0),
+            ('retained_bytes_per_request', (current - before) / 100.0),
+        ]))
+    return results
+
+
+def environment():
+    """Describes what the results were measured on."""
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return OrderedDict([
+        ('commit', commit),
+        ('python', platform.python_version()),
+        ('django', django.get_version()),
+        ('platform', platform.platform()),
+    ])
+
+
+def flatten(results, prefix=''):
+    """Yields ``(path, value)`` for every measurement in *results*."""
+    if isinstance(results, dict):
+        items = ((key, value) for key, value in results.items() if key not in GRID_PARAMETERS)
+    elif isinstance(results, list):
+        items = ((describe(item, i), item) for i, item in enumerate(results))
+    else:
+        if isinstance(results, (int, float)) and not isinstance(results, bool):
+            yield prefix, results
+        return
+    for key, value in items:
+        yield from flatten(value, '%s/%s' % (prefix, key) if prefix else str(key))
+
+
+def describe(item, index):
+    """Names a row of a grid benchmark by its parameters."""
+    if not isinstance(item, dict):
+        return str(index)
+    return ','.join('%s=%s' % (key, item[key]) for key in GRID_PARAMETERS if key in item)
+
+
+def compare(baseline, results):
+    """Prints the ratio of every measurement in *results* to *baseline*."""
+    old = dict(flatten(baseline.get('benchmarks', baseline)))
+    for path, value in flatten(results['benchmarks']):
+        if path in old and old[path]:
+            sys.stderr.write('%-100s %12.3f %12.3f %8.2fx\n' % (path, old[path], value, value / old[path]))
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',')]
+
+
+def runbenchmarks(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--number', type=int, default=10000, help='iterations per measurement')
+    parser.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout, help='write JSON here')
+    parser.add_argument('--compare', type=argparse.FileType('r'), help='JSON from an earlier run')
+    parser.add_argument('--loggers', type=int_list, default=[10, 100, 1000, 10000],
+                        help='logger tree sizes for middleware_overhead')
+    parser.add_argument('--handlers', type=int_list, default=[1, 10],
+                        help='handlers carrying an unbound RequestFilter')
+    parser.add_argument('--lines', type=int_list, default=[0, 10], help='log lines per request')
+    parser.add_argument('--threads', type=int_list, default=[1, 8], help='worker thread counts')
+    parser.add_argument('--bindings', type=lambda value: value.split(','), default=['filters', 'context'],
+                        help='binding modes')
+    parser.add_argument('names', nargs='*', help='benchmarks to run (default: all of %s)' % ', '.join(BENCHMARKS))
+    args = parser.parse_args(argv)
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark %r' % name)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'testapp.settings')
+    django.setup()
+    results = OrderedDict([('environment', environment()), ('benchmarks', OrderedDict())])
+    for name in args.names or BENCHMARKS:
+        results['benchmarks'][name] = BENCHMARKS[name](args)
+    json.dump(results, args.output, indent=2)
+    args.output.write('\n')
+    if args.compare:
+        compare(json.load(args.compare), results)
+
+
+if __name__ == '__main__':
+    runbenchmarks()
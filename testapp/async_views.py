@@ -0,0 +1,19 @@
+import asyncio
+
+from django.http import HttpResponse
+
+from django_requestlogging.logging_filters import get_current_request
+
+
+async def hello_world(request):
+    return HttpResponse('Hello, world!')
+
+
+async def current_path():
+    await asyncio.sleep(0)
+    return getattr(get_current_request(), 'path_info', '-')
+
+
+async def spawn_task(request):
+    task = asyncio.ensure_future(current_path())
+    return HttpResponse(await task)
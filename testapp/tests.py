@@ -27,17 +27,76 @@
 # POSSIBILITY OF SUCH DAMAGE.
 from __future__ import absolute_import, unicode_literals
 
+import functools
+import gc
+import gzip
+import json
 import logging
+import logging.config
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from unittest import skipIf
 
 import six
+from django.apps import apps
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.http import HttpResponse
-from django.test import TestCase
+from django.core.management import call_command
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import TestCase, override_settings
 from django.test.client import RequestFactory
+from django.utils.functional import SimpleLazyObject
+from django.utils.log import configure_logging
 from six.moves import reload_module as reload
 
-from django_requestlogging.logging_filters import RequestFilter
-from django_requestlogging.middleware import LogSetupMiddleware, deref
+from django_requestlogging.analytics import (
+    Sketch, Stats, analyze, analyze_lines, format_parser, iter_lines, split_ranges,
+)
+from django_requestlogging.apps import RequestLoggingConfig
+from django_requestlogging.checks import check_request_fields
+from django_requestlogging.formatters import JSONFormatter
+from django_requestlogging.logging_filters import (
+    REQUEST_FIELDS, RequestFields, RequestFilter, SamplingFilter, compile_fields,
+    compile_scrubber, get_current_request, get_placeholders, get_scrubber, install_record_factory, materialize,
+    request_field_names, set_current_request, uninstall_record_factory,
+)
+from django_requestlogging.metrics import Histogram, get_metrics, metrics_view
+from django_requestlogging.middleware import (
+    REQUEST_ID_RE, LogSetupMiddleware, build_filterer_index, deref, generate_request_id, invalidate_filterer_index,
+    logging_config_key,
+)
+from django_requestlogging.queries import ExitStack, QueryStats, normalize_sql
+from django_requestlogging.segments import encode_entry, merge_segment_files, read_entries
+
+
+try:
+    from django_requestlogging.handlers import (
+        BatchingSocketHandler, CoalescingHandler, CompressingRotatingFileHandler, QueueHandler, RequestBufferHandler,
+        SegmentFileHandler, encode_frame, iter_frames, resolve_forwarding_handlers,
+    )
+    from django_requestlogging.testing import FakeCollector
+except (ImportError, AttributeError):  # Python 2
+    BatchingSocketHandler = CoalescingHandler = CompressingRotatingFileHandler = QueueHandler = None
+    RequestBufferHandler = SegmentFileHandler = None
+
+try:
+    from django.urls import resolve
+except ImportError:  # Django < 1.10
+    from django.core.urlresolvers import resolve
+
+try:
+    import asyncio
+    from asgiref.sync import async_to_sync
+    from testapp import async_views
+except (ImportError, SyntaxError):  # Python < 3.5 or Django < 3.0
+    async_views = None
 
 
 class LogSetupMiddlewareTest(TestCase):
@@ -48,7 +107,7 @@ class LogSetupMiddlewareTest(TestCase):
         self.factory = RequestFactory()
         # LogSetupMiddleware only looks under this module
         logging_root = __name__
-        self.middleware = LogSetupMiddleware(root=logging_root)
+        self.middleware = LogSetupMiddleware(root=logging_root, binding='filters')
         self.filter = RequestFilter(request=None)
         # Create test logger with a placeholder logger
         self.logger = logging.getLogger(__name__)
@@ -151,6 +210,315 @@ class LogSetupMiddlewareTest(TestCase):
         handlers = self.middleware.find_handlers_with_filter(RequestFilter)
         self.assertTrue(self.handler in handlers)
 
+    def test_find_filterers_with_filter(self):
+        filterers = self.middleware.find_filterers_with_filter(RequestFilter)
+        self.assertEqual(list(map(deref, filterers)), [self.logger, self.handler])
+        # The scan is cached while the logging configuration is unchanged
+        self.assertIs(self.middleware.find_filterers_with_filter(RequestFilter), filterers)
+
+    def child_logger(self, name):
+        name = '%s.%s' % (__name__, name)
+        self.addCleanup(logging.Logger.manager.loggerDict.pop, name, None)
+        logger = logging.getLogger(name)
+        logger.filters = []
+        return logger
+
+    def test_filterer_index_new_logger(self):
+        filterers = self.middleware.find_filterers_with_filter(RequestFilter)
+        # New loggers have no filters, so do not force a rescan
+        child = self.child_logger('new_logger')
+        self.assertIs(self.middleware.find_filterers_with_filter(RequestFilter), filterers)
+        child.addFilter(self.filter)
+        invalidate_filterer_index()
+        self.assertIn(child, self.middleware.find_filterers_with_filter(RequestFilter))
+
+    def test_filterer_index_invalidate(self):
+        child = self.child_logger('existing_logger')
+        self.assertNotIn(child, self.middleware.find_filterers_with_filter(RequestFilter))
+        child.addFilter(self.filter)
+        self.assertNotIn(child, self.middleware.find_filterers_with_filter(RequestFilter))
+        invalidate_filterer_index()
+        self.assertIn(child, self.middleware.find_filterers_with_filter(RequestFilter))
+
+
+class ContextBindingTest(TestCase):
+
+    def setUp(self, *args, **kwargs):
+        super(ContextBindingTest, self).setUp(*args, **kwargs)
+        self.factory = RequestFactory()
+        self.middleware = LogSetupMiddleware(root=__name__, binding='context')
+        self.filter = RequestFilter(request=None)
+        self.logger = logging.getLogger(__name__)
+        self.logger.filters = []
+        self.logger.addFilter(self.filter)
+
+    def record(self):
+        record = logging.LogRecord(__name__, logging.INFO, '/fake/path', 123,
+                                   'test message', (), None)
+        self.filter.filter(record)
+        return record
+
+    def test_request(self):
+        request = self.factory.get('/context/')
+        self.middleware.process_request(request)
+        self.assertEqual(self.logger.filters, [self.filter])
+        self.assertIs(get_current_request(), request)
+        self.assertEqual('/context/', self.record().path_info)
+        self.middleware.process_response(request, HttpResponse(''))
+        self.assertIsNone(get_current_request())
+        self.assertEqual('-', self.record().path_info)
+
+    def test_exception(self):
+        request = self.factory.get('/')
+        self.middleware.process_request(request)
+        self.middleware.process_exception(request, Exception())
+        self.assertIsNone(get_current_request())
+        self.middleware.process_response(request, HttpResponse(''))
+        self.assertIsNone(get_current_request())
+
+    def test_threads(self):
+        results = {}
+
+        def run():
+            results['before'] = self.record().path_info
+            request = self.factory.get('/thread/')
+            self.middleware.process_request(request)
+            results['during'] = self.record().path_info
+            self.middleware.process_response(request, HttpResponse(''))
+
+        request = self.factory.get('/main/')
+        self.middleware.process_request(request)
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        self.assertEqual('/main/', self.record().path_info)
+        self.middleware.process_response(request, HttpResponse(''))
+        self.assertEqual(results, {'before': '-', 'during': '/thread/'})
+
+    @skipIf(not hasattr(logging.handlers, 'QueueHandler'), 'Requires Python 3')
+    def test_stdlib_queue_handler(self):
+        # Records queued by the standard library are formatted after the
+        # response, so the lazy username must be resolved by then
+        records = six.moves.queue.Queue()
+        handler = logging.handlers.QueueHandler(records)
+        self.logger.addHandler(handler)
+        self.addCleanup(self.logger.removeHandler, handler)
+        loaded = []
+
+        def load_user():
+            loaded.append(True)
+            return User.objects.create_user(username='queued', password='test')
+
+        request = self.factory.get('/queued/')
+        request.user = SimpleLazyObject(load_user)
+        self.middleware.process_request(request)
+        self.logger.warning('queued')
+        self.assertEqual(loaded, [])
+        self.middleware.process_response(request, HttpResponse(''))
+        self.assertEqual(loaded, [True])
+        record = records.get_nowait()
+        self.assertEqual(record.username, 'queued')
+        self.assertEqual(loaded, [True])
+
+    def test_default(self):
+        self.assertEqual(LogSetupMiddleware().binding, 'context')
+
+    @override_settings(REQUESTLOGGING_BINDING='filters')
+    def test_setting(self):
+        self.assertEqual(LogSetupMiddleware().binding, 'filters')
+
+    def test_invalid_binding(self):
+        with self.assertRaises(ImproperlyConfigured):
+            LogSetupMiddleware(binding='nonsense')
+
+
+@skipIf(not hasattr(logging, 'setLogRecordFactory'), 'Requires Python 3')
+class RecordFactoryBindingTest(TestCase):
+
+    def setUp(self, *args, **kwargs):
+        super(RecordFactoryBindingTest, self).setUp(*args, **kwargs)
+        self.factory = RequestFactory()
+        self.original_factory = logging.getLogRecordFactory()
+        self.addCleanup(logging.setLogRecordFactory, self.original_factory)
+        self.addCleanup(uninstall_record_factory)
+        # A logger outside any root, with no RequestFilter anywhere
+        self.logger = logging.getLogger('thirdparty.factory')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.handler = ListHandler()
+        self.logger.addHandler(self.handler)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+        self.addCleanup(logging.Logger.manager.loggerDict.pop, 'thirdparty.factory', None)
+
+    def view(self, request):
+        self.logger.info('hello')
+        return HttpResponse()
+
+    def test_request(self):
+        LogSetupMiddleware(self.view, root='myapp', binding='factory')(self.factory.get('/factory/'))
+        record, = self.handler.records
+        self.assertEqual(record.path_info, '/factory/')
+        self.logger.info('outside')
+        self.assertFalse(hasattr(self.handler.records[1], 'path_info'))
+
+    def test_outside_request(self):
+        # extra may set the fields outside a request; the filter fills in the rest
+        install_record_factory()
+        self.handler.addFilter(RequestFilter())
+        self.addCleanup(setattr, self.handler, 'filters', [])
+        self.logger.info('command', extra={'path_info': '/x', 'username': 'cron'})
+        record, = self.handler.records
+        self.assertEqual((record.path_info, record.username), ('/x', 'cron'))
+        self.assertEqual(record.request_id, '-')
+
+    def test_setting(self):
+        import django_requestlogging.logging_filters
+        with override_settings(REQUESTLOGGING_BINDING='factory'):
+            self.assertEqual(LogSetupMiddleware().binding, 'factory')
+        # Looked up on the module, which another test reloads
+        self.assertIsInstance(logging.getLogRecordFactory(),
+                              django_requestlogging.logging_filters.RequestRecordFactory)
+
+    def test_stamped_once(self):
+        def change(record):
+            record.path_info = '/changed/'
+            return True
+
+        # The filters must leave the record alone
+        self.logger.addFilter(RequestFilter())
+        self.logger.addFilter(change)
+        self.addCleanup(setattr, self.logger, 'filters', [])
+        self.handler.addFilter(RequestFilter())
+        LogSetupMiddleware(self.view, binding='factory')(self.factory.get('/factory/'))
+        self.assertEqual(self.handler.records[0].path_info, '/changed/')
+
+    def test_access_log(self):
+        middleware = LogSetupMiddleware(self.view, binding='factory', access_log='thirdparty.factory')
+        middleware(self.factory.get('/access/'))
+        hello, access = self.handler.records
+        self.assertEqual(access.getMessage(), '"GET /access/" 200 0')
+        self.assertEqual((access.path_info, access.status_code), ('/access/', 200))
+
+    def test_composes(self):
+        def factory(*args, **kwargs):
+            record = self.original_factory(*args, **kwargs)
+            record.custom = 'custom'
+            return record
+
+        logging.setLogRecordFactory(factory)
+        installed = install_record_factory()
+        self.assertIs(install_record_factory(), installed)
+        LogSetupMiddleware(self.view, binding='factory')(self.factory.get('/factory/'))
+        record, = self.handler.records
+        self.assertEqual((record.custom, record.path_info), ('custom', '/factory/'))
+        uninstall_record_factory()
+        self.assertIs(logging.getLogRecordFactory(), factory)
+
+    def test_uninstall_when_wrapped(self):
+        installed = install_record_factory()
+
+        def wrapper(*args, **kwargs):
+            return installed(*args, **kwargs)
+
+        logging.setLogRecordFactory(wrapper)
+        uninstall_record_factory()
+        self.assertIs(logging.getLogRecordFactory(), wrapper)
+        self.logger.info('plain')
+        self.assertFalse(hasattr(self.handler.records[0], 'path_info'))
+
+
+@skipIf(async_views is None, 'Requires Python 3.5+ and asgiref')
+class AsyncMiddlewareTest(TestCase):
+
+    def setUp(self, *args, **kwargs):
+        super(AsyncMiddlewareTest, self).setUp(*args, **kwargs)
+        self.factory = RequestFactory()
+
+    def test_sync(self):
+        middleware = LogSetupMiddleware(lambda request: HttpResponse(''))
+        self.assertFalse(middleware.is_async)
+        self.assertFalse(asyncio.iscoroutinefunction(middleware))
+
+    def test_async(self):
+        middleware = LogSetupMiddleware(async_views.hello_world)
+        self.assertTrue(middleware.is_async)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        response = async_to_sync(middleware)(self.factory.get('/'))
+        self.assertEqual(response.content, b'Hello, world!')
+
+    def test_context_propagates_to_tasks(self):
+        middleware = LogSetupMiddleware(async_views.spawn_task, binding='context')
+        response = async_to_sync(middleware)(self.factory.get('/spawned/'))
+        self.assertEqual(response.content, b'/spawned/')
+        self.assertIsNone(get_current_request())
+
+
+class ConcurrencyStressTest(TestCase):
+    threads = 16
+    requests = 25
+    lines = 4
+
+    def setUp(self, *args, **kwargs):
+        super(ConcurrencyStressTest, self).setUp(*args, **kwargs)
+        self.factory = RequestFactory()
+        self.filter = RequestFilter()
+        self.handler = ListHandler()
+        self.handler.addFilter(self.filter)
+        self.logger = logging.getLogger(__name__ + '.stress')
+        self.logger.filters = [self.filter]
+        self.logger.handlers = [self.handler]
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.addCleanup(self.remove_loggers)
+
+    def remove_loggers(self):
+        logger_dict = logging.Logger.manager.loggerDict
+        for name in list(logger_dict):
+            if name.startswith(self.logger.name):
+                del logger_dict[name]
+
+    def view(self, request):
+        for i in range(self.lines):
+            self.logger.info(request.path_info)
+            # Let the other requests run
+            time.sleep(0.001)
+        return HttpResponse('')
+
+    def hammer(self, binding):
+        middleware = LogSetupMiddleware(self.view, root=__name__, binding=binding)
+        errors = []
+
+        def worker(n):
+            try:
+                for i in range(self.requests):
+                    middleware(self.factory.get('/%d/%d/' % (n, i)))
+            except Exception as e:  # pragma: no cover
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        # Create loggers while the middleware scans the logger tree
+        for i in range(200):
+            logging.getLogger('%s.stress.churn%d' % (__name__, i))
+            invalidate_filterer_index()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        records = self.handler.records
+        self.assertEqual(len(records), self.threads * self.requests * self.lines)
+        for record in records:
+            self.assertEqual(record.path_info, record.msg)
+        # Nothing is left behind on the shared loggers and handlers
+        self.assertEqual(self.logger.filters, [self.filter])
+        self.assertEqual(self.handler.filters, [self.filter])
+
+    def test_context(self):
+        self.hammer('context')
+
+    def test_filters(self):
+        self.hammer('filters')
+
 
 class LoggingFiltersTest(TestCase):
     def setUp(self, *args, **kwargs):
@@ -178,6 +546,44 @@ class LoggingFiltersTest(TestCase):
         self.assertEqual('-', record.http_user_agent)
         self.assertEqual('test message', record.msg)
 
+    def test_username_is_lazy(self):
+        request = self.factory.get('/')
+        loaded = []
+
+        def load_user():
+            loaded.append(True)
+            return User.objects.create_user(username='lazy', password='test')
+
+        request.user = SimpleLazyObject(load_user)
+        record = logging.LogRecord('request_filter', 1, '/fake/path', 123,
+                                   'test message', (), None)
+        RequestFilter(request).filter(record)
+        self.assertEqual(loaded, [])
+        formatter = logging.Formatter('%(path_info)s %(username)s')
+        self.assertEqual(formatter.format(record), '/ lazy')
+        self.assertEqual(formatter.format(record), '/ lazy')
+        self.assertEqual(loaded, [True])
+        self.assertEqual(pickle.loads(pickle.dumps(record)).username, 'lazy')
+
+    def test_request_fields_are_cached(self):
+        request = self.factory.get('/')
+        rf = RequestFilter(request)
+        first = logging.LogRecord('request_filter', 1, '/fake/path', 123,
+                                  'first', (), None)
+        rf.filter(first)
+        fields = request.logging_fields
+        second = logging.LogRecord('request_filter', 1, '/fake/path', 123,
+                                   'second', (), None)
+        rf.filter(second)
+        self.assertIs(request.logging_fields, fields)
+        self.assertEqual('-', second.username)
+        # Logging in replaces request.user, which invalidates the snapshot
+        request.user = User.objects.create_user(username='login', password='test')
+        rf.filter(second)
+        self.assertIsNot(request.logging_fields, fields)
+        self.assertEqual('login', second.username)
+        self.assertEqual('-', first.username)
+
     def test_unbound(self):
         record = logging.LogRecord('request_filter', 1, '/fake/path', 123,
                                    'test message', (), None)
@@ -191,6 +597,18 @@ class LoggingFiltersTest(TestCase):
         self.assertEqual('-', record.http_user_agent)
         self.assertEqual('test message', record.msg)
 
+    def test_unbound_without_placeholders(self):
+        record = logging.LogRecord('request_filter', 1, '/fake/path', 123,
+                                   'test message', (), None)
+        self.assertTrue(RequestFilter(placeholders=False).filter(record))
+        self.assertFalse(hasattr(record, 'path_info'))
+        # Formatters that tolerate missing fields still work
+        self.assertIsNone(json.loads(JSONFormatter().format(record))['path_info'])
+
+    def test_placeholders_are_shared(self):
+        self.assertIs(get_placeholders(), get_placeholders())
+        self.assertEqual(set(get_placeholders()), set(REQUEST_FIELDS))
+
     def test_request_data_is_preserved(self):
         request = self.factory.get('/')
         record = logging.LogRecord('request_filter', 1, '/fake/path', 123,
@@ -211,6 +629,1291 @@ class LoggingFiltersTest(TestCase):
         self.assertEqual('test message', record.msg)
 
 
+FIELDS = {
+    'tenant': 'header:X-Tenant',
+    'server_name': 'meta:SERVER_NAME',
+    'theme': 'cookie:theme',
+    'plan': 'session:plan',
+    'view_name': 'resolver:view_name',
+    'scheme': 'attr:scheme',
+    'missing': 'attr:missing.attribute',
+}
+
+
+@override_settings(REQUESTLOGGING_FIELDS=FIELDS)
+class RequestFieldsSettingTest(TestCase):
+
+    def setUp(self, *args, **kwargs):
+        super(RequestFieldsSettingTest, self).setUp(*args, **kwargs)
+        self.factory = RequestFactory()
+
+    def record(self, request):
+        record = logging.LogRecord('fields', logging.INFO, '/fake/path', 123,
+                                   'test message', (), None)
+        RequestFilter(request).filter(record)
+        return record
+
+    def test_fields(self):
+        request = self.factory.get('/', HTTP_X_TENANT='acme')
+        request.COOKIES['theme'] = 'dark'
+        request.session = {'plan': 'gold'}
+        record = self.record(request)
+        request.resolver_match = resolve('/')
+        self.assertEqual(record.tenant, 'acme')
+        self.assertEqual(record.server_name, 'testserver')
+        self.assertEqual(record.theme, 'dark')
+        self.assertEqual(record.plan, 'gold')
+        # Resolved lazily, after URL resolution
+        self.assertEqual(record.view_name, 'hello')
+        self.assertEqual(record.scheme, 'http')
+        self.assertEqual(record.missing, '-')
+        self.assertEqual(materialize(record).view_name, 'hello')
+        self.assertIs(type(record.view_name), six.text_type)
+
+    def test_missing(self):
+        record = self.record(self.factory.get('/'))
+        for name in ('tenant', 'theme', 'plan', 'view_name', 'missing'):
+            self.assertEqual(getattr(record, name), '-', name)
+
+    def test_unbound(self):
+        record = self.record(None)
+        self.assertEqual(record.tenant, '-')
+        self.assertEqual(record.path_info, '-')
+
+    def test_json_formatter(self):
+        self.assertEqual(JSONFormatter().fields[-len(FIELDS):], tuple(FIELDS))
+
+    def test_invalid(self):
+        for spec in ({'tenant': 'nonsense:X'}, {'tenant': 'header:'},
+                     {'not valid': 'header:X'}, {'username': 'header:X'}, {'msg': 'header:X'},
+                     {'levelno': 'header:X'}, {'message': 'header:X'}, {'db_queries': 'header:X'}):
+            with self.assertRaises(ImproperlyConfigured):
+                compile_fields(spec)
+        self.assertIsNone(compile_fields({}))
+
+
+@override_settings(REQUESTLOGGING_SCRUB=[r'(?<=token=)[^&\s]+', r'\bsk_\w+'],
+                   REQUESTLOGGING_FIELDS={'query': 'meta:QUERY_STRING'})
+class ScrubbingTest(TestCase):
+
+    def setUp(self, *args, **kwargs):
+        super(ScrubbingTest, self).setUp(*args, **kwargs)
+        self.factory = RequestFactory()
+        self.request = self.factory.get('/keys/sk_live123/', {'token': 'abc', 'page': '2'},
+                                        HTTP_USER_AGENT='client token=xyz')
+
+    def record(self, args=('token=secret&next=/',)):
+        record = logging.LogRecord('scrub', logging.INFO, '/fake/path', 123, 'args %s', args, None)
+        RequestFilter(self.request).filter(record)
+        return record
+
+    def test_request_fields(self):
+        record = self.record()
+        self.assertEqual(record.path_info, '/keys/[REDACTED]/')
+        self.assertEqual(record.http_user_agent, 'client token=[REDACTED]')
+        self.assertEqual(record.query, 'token=[REDACTED]&page=2')
+
+    @override_settings(REQUESTLOGGING_FIELDS={'key': 'session:api_key', 'view': 'resolver:url_name'})
+    def test_lazy_fields(self):
+        self.request.session = {'api_key': 'sk_secret'}
+        self.request.resolver_match = resolve('/')
+        record = self.record()
+        self.assertEqual(record.key, '[REDACTED]')
+        self.assertEqual(record.view, 'hello')
+
+    def test_args(self):
+        record = self.record(('token=secret&next=/', 42, 'sk_abc'))
+        self.assertEqual(record.args, ('token=[REDACTED]&next=/', 42, '[REDACTED]'))
+        record = self.record(({'key': 'sk_abc', 'n': 1},))
+        self.assertEqual(record.args, {'key': '[REDACTED]', 'n': 1})
+
+    def test_cached_per_request(self):
+        fields = RequestFields.for_request(self.request)
+        calls = []
+
+        def scrubber(value):
+            calls.append(value)
+            return get_scrubber()(value)
+
+        fields.scrubber = scrubber
+        for _ in range(3):
+            record = self.record(('sk_abc',))
+            # Stacked filters see the scrubbed value
+            RequestFilter(self.request).filter(record)
+        self.assertEqual(record.args, ('[REDACTED]',))
+        self.assertEqual(calls, ['sk_abc'])
+
+    def test_disabled(self):
+        with override_settings(REQUESTLOGGING_SCRUB=None):
+            self.assertIsNone(get_scrubber())
+            record = self.record()
+        self.assertEqual(record.path_info, '/keys/sk_live123/')
+        self.assertEqual(record.args, ('token=secret&next=/',))
+
+    @override_settings(REQUESTLOGGING_SCRUB_REPLACEMENT='\\*\\')
+    def test_replacement(self):
+        self.assertEqual(self.record().args, ('token=\\*\\&next=/',))
+
+    def test_invalid(self):
+        with self.assertRaises(ImproperlyConfigured):
+            compile_scrubber(['(unclosed'])
+        self.assertIsNone(compile_scrubber([]))
+
+
+class SamplingFilterTest(TestCase):
+
+    def setUp(self, *args, **kwargs):
+        super(SamplingFilterTest, self).setUp(*args, **kwargs)
+        self.factory = RequestFactory()
+        self.addCleanup(set_current_request, None)
+
+    def logged(self, sampler, request, level=logging.INFO):
+        set_current_request(request)
+        record = logging.LogRecord('sampling', level, '/fake/path', 123,
+                                   'test message', (), None)
+        return sampler.filter(record)
+
+    def test_rates(self):
+        sampler = SamplingFilter(rates={'/api/': 0, '/api/public/': 1, 'POST': 0})
+        self.assertFalse(self.logged(sampler, self.factory.get('/api/private/')))
+        self.assertTrue(self.logged(sampler, self.factory.get('/api/public/')))
+        self.assertFalse(self.logged(sampler, self.factory.post('/other/')))
+        self.assertTrue(self.logged(sampler, self.factory.get('/other/')))
+        self.assertEqual(sampler.suppressed, {'/api/': 1, 'POST': 1})
+
+    def test_whole_request(self):
+        sampler = SamplingFilter(default_rate=0.5)
+        sampler.random = functools.partial(next, iter([0.9, 0.1]))
+        request = self.factory.get('/')
+        self.assertFalse(self.logged(sampler, request))
+        self.assertFalse(self.logged(sampler, request))
+        self.assertTrue(self.logged(sampler, self.factory.get('/')))
+        self.assertEqual(sampler.suppressed, {'default': 2})
+
+    def test_level(self):
+        sampler = SamplingFilter(default_rate=0)
+        request = self.factory.get('/')
+        self.assertTrue(self.logged(sampler, request, logging.WARNING))
+        self.assertFalse(self.logged(sampler, request, logging.INFO))
+
+    def test_outside_request(self):
+        self.assertTrue(self.logged(SamplingFilter(default_rate=0), None))
+
+    def test_rate_limit(self):
+        sampler = SamplingFilter(rate_limit=0.001, burst=2, max_buckets=1)
+        self.assertTrue(self.logged(sampler, self.factory.get('/')))
+        self.assertTrue(self.logged(sampler, self.factory.get('/')))
+        self.assertFalse(self.logged(sampler, self.factory.get('/')))
+        self.assertEqual(sampler.suppressed, {'remote_addr:127.0.0.1': 1})
+        self.assertTrue(self.logged(sampler, self.factory.get('/', REMOTE_ADDR='10.0.0.1')))
+        self.assertEqual(list(sampler.buckets), ['remote_addr:10.0.0.1'])
+
+    def test_invalid_key(self):
+        for key in ('remote_adr', 'tenant'):
+            with self.assertRaises(ImproperlyConfigured):
+                SamplingFilter(key=key)
+
+    @override_settings(REQUESTLOGGING_FIELDS={'tenant': 'header:X-Tenant'})
+    def test_configured_key(self):
+        sampler = SamplingFilter(rate_limit=0.001, burst=1, key='tenant')
+        self.assertTrue(self.logged(sampler, self.factory.get('/', HTTP_X_TENANT='a')))
+        self.assertFalse(self.logged(sampler, self.factory.get('/', HTTP_X_TENANT='a')))
+        self.assertTrue(self.logged(sampler, self.factory.get('/')))
+        self.assertEqual(sampler.suppressed, {'tenant:a': 1})
+
+
+class JSONFormatterTest(TestCase):
+
+    def setUp(self, *args, **kwargs):
+        super(JSONFormatterTest, self).setUp(*args, **kwargs)
+        self.factory = RequestFactory()
+
+    def record(self, msg='hello %s', args=('world',), exc_info=None):
+        return logging.LogRecord('json', logging.ERROR, '/fake/path', 123,
+                                 msg, args, exc_info)
+
+    def test_format(self):
+        record = self.record()
+        RequestFilter(self.factory.get('/json/')).filter(record)
+        data = json.loads(JSONFormatter().format(record))
+        self.assertEqual(list(data), list(JSONFormatter.DEFAULT_FIELDS))
+        self.assertEqual(data['message'], 'hello world')
+        self.assertEqual(data['levelname'], 'ERROR')
+        self.assertEqual(data['path_info'], '/json/')
+        self.assertEqual(data['username'], '-')
+        self.assertEqual(data['created'], record.created)
+
+    def test_missing_fields(self):
+        formatter = JSONFormatter(fields=['message', 'path_info'])
+        self.assertEqual(json.loads(formatter.format(self.record())),
+                         {'message': 'hello world', 'path_info': None})
+
+    def test_single_field_and_asctime(self):
+        formatter = JSONFormatter(fields=['asctime'], datefmt='%Y')
+        data = json.loads(formatter.format(self.record()))
+        self.assertEqual(list(data), ['asctime'])
+        self.assertEqual(len(data['asctime']), 4)
+
+    def test_exc_info(self):
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            record = self.record(exc_info=sys.exc_info())
+        line = JSONFormatter().format(record)
+        self.assertNotIn('\n', line)
+        self.assertIn('ValueError: boom', json.loads(line)['exc_info'])
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self, *args, **kwargs):
+        super(ListHandler, self).__init__(*args, **kwargs)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def configure_forwarding(test, config):
+    """
+    Configures a handler from *config* through dictConfig, forwarding to a
+    ListHandler named 'target' that no logger uses, collects garbage and
+    returns the logger using the handler.
+    """
+    logger = logging.getLogger('testapp.forwarding')
+    logging.config.dictConfig({
+        'version': 1,
+        'disable_existing_loggers': False,
+        'handlers': {
+            'forward': dict(config, handlers=['target']),
+            'target': {'()': ListHandler},
+        },
+        'loggers': {
+            'testapp.forwarding': {'handlers': ['forward'], 'level': 'DEBUG', 'propagate': False},
+        },
+    })
+    test.addCleanup(configure_logging, settings.LOGGING_CONFIG, settings.LOGGING)
+    test.addCleanup(setattr, logger, 'handlers', [])
+    gc.collect()
+    return logger
+
+
+@skipIf(QueueHandler is None, 'Requires Python 3')
+class QueueHandlerTest(TestCase):
+
+    def setUp(self, *args, **kwargs):
+        super(QueueHandlerTest, self).setUp(*args, **kwargs)
+        self.factory = RequestFactory()
+        self.target = ListHandler()
+
+    def record(self, msg='test message'):
+        return logging.LogRecord('queue', logging.INFO, '/fake/path', 123,
+                                 msg, (), None)
+
+    def test_materializes_request_fields(self):
+        handler = QueueHandler([self.target])
+        self.addCleanup(handler.close)
+        handler.addFilter(RequestFilter())
+        request = self.factory.get('/queued/')
+        request.user = SimpleLazyObject(
+            lambda: User.objects.create_user(username='queued', password='test'))
+        set_current_request(request)
+        try:
+            handler.handle(self.record())
+        finally:
+            set_current_request(None)
+        handler.stop()
+        record, = self.target.records
+        self.assertEqual(record.path_info, '/queued/')
+        self.assertIs(type(record.username), six.text_type)
+        self.assertEqual(record.username, 'queued')
+
+    def test_handler_names(self):
+        self.target.name = 'queue_test_target'
+        self.addCleanup(self.target.close)
+        handler = QueueHandler(['queue_test_target'])
+        self.addCleanup(handler.close)
+        handler.handle(self.record())
+        handler.stop()
+        self.assertEqual(len(self.target.records), 1)
+        with self.assertRaises(ValueError):
+            QueueHandler(['no_such_handler']).start()
+
+    def test_dict_config(self):
+        # The target is only referenced by name, so must not be collected
+        logger = configure_forwarding(self, {'()': 'django_requestlogging.handlers.QueueHandler'})
+        handler, = logger.handlers
+        # What RequestLoggingConfig.ready() does after Django's dictConfig
+        resolve_forwarding_handlers()
+        gc.collect()
+        logger.info('configured')
+        handler.stop()
+        target, = handler.get_handlers()
+        self.assertEqual([record.msg for record in target.records], ['configured'])
+
+    def fill(self, policy):
+        handler = QueueHandler([self.target], maxsize=2, policy=policy)
+        # Pretend the listener is running so nothing is consumed
+        handler.listener = object()
+        self.addCleanup(setattr, handler, 'listener', None)
+        for i in range(5):
+            handler.handle(self.record(str(i)))
+        return handler, [handler.queue.get_nowait().msg for _ in range(2)]
+
+    def test_drop_newest(self):
+        handler, queued = self.fill('drop_newest')
+        self.assertEqual(queued, ['0', '1'])
+        self.assertEqual(handler.dropped, 3)
+
+    def test_drop_oldest(self):
+        handler, queued = self.fill('drop_oldest')
+        self.assertEqual(queued, ['3', '4'])
+        self.assertEqual(handler.dropped, 3)
+
+    def test_invalid_policy(self):
+        with self.assertRaises(ValueError):
+            QueueHandler(policy='nonsense')
+
+
+class RequestIdTest(TestCase):
+
+    def setUp(self, *args, **kwargs):
+        super(RequestIdTest, self).setUp(*args, **kwargs)
+        self.factory = RequestFactory()
+
+    def test_generate(self):
+        ids = set(generate_request_id() for _ in range(100))
+        self.assertEqual(len(ids), 100)
+        self.assertTrue(all(REQUEST_ID_RE.match(i) for i in ids))
+
+    def test_request_id(self):
+        records = []
+
+        def view(request):
+            record = logging.LogRecord('request_id', logging.INFO, '/fake/path', 123,
+                                       'test message', (), None)
+            RequestFilter().filter(record)
+            records.append(record)
+            return HttpResponse('')
+
+        request = self.factory.get('/', HTTP_X_REQUEST_ID='from-proxy')
+        response = LogSetupMiddleware(view)(request)
+        self.assertNotEqual(request.request_id, 'from-proxy')
+        self.assertEqual(records[0].request_id, request.request_id)
+        self.assertFalse(response.has_header('X-Request-ID'))
+
+    @override_settings(REQUESTLOGGING_REQUEST_ID_HEADER='X-Request-ID')
+    def test_header(self):
+        middleware = LogSetupMiddleware(lambda request: HttpResponse(''))
+        request = self.factory.get('/', HTTP_X_REQUEST_ID='from-proxy')
+        response = middleware(request)
+        self.assertEqual(request.request_id, 'from-proxy')
+        self.assertEqual(response['X-Request-ID'], 'from-proxy')
+        # Malformed IDs are replaced
+        request = self.factory.get('/', HTTP_X_REQUEST_ID='bad id\n')
+        response = middleware(request)
+        self.assertNotEqual(request.request_id, 'bad id\n')
+        self.assertEqual(response['X-Request-ID'], request.request_id)
+
+
+class AccessLogTest(TestCase):
+
+    def setUp(self, *args, **kwargs):
+        super(AccessLogTest, self).setUp(*args, **kwargs)
+        self.factory = RequestFactory()
+        self.handler = ListHandler()
+        self.logger = logging.getLogger('testapp.access')
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.INFO)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+
+    def test_disabled(self):
+        self.assertIsNone(LogSetupMiddleware().access_logger)
+
+    @override_settings(REQUESTLOGGING_ACCESS_LOG='testapp.access')
+    def test_setting(self):
+        self.assertIs(LogSetupMiddleware().access_logger, self.logger)
+
+    def test_response(self):
+        middleware = LogSetupMiddleware(lambda request: HttpResponse('missing', status=404),
+                                        access_log='testapp.access')
+        middleware(self.factory.get('/access/'))
+        record, = self.handler.records
+        self.assertEqual(record.getMessage(), '"GET /access/" 404 7')
+        self.assertEqual(record.levelno, logging.WARNING)
+        self.assertEqual(record.path_info, '/access/')
+        self.assertEqual(record.status_code, 404)
+        self.assertEqual(record.response_bytes, 7)
+        self.assertGreaterEqual(record.duration_ms, 0)
+        self.assertGreaterEqual(record.cpu_time_ms, 0)
+
+    def test_unbound_filter(self):
+        # An unbound filter on the access logger must not reset the fields
+        self.handler.addFilter(RequestFilter())
+        middleware = LogSetupMiddleware(lambda request: HttpResponse(''), access_log='testapp.access')
+        middleware(self.factory.get('/filtered/'))
+        self.assertEqual(self.handler.records[0].path_info, '/filtered/')
+
+    def test_streaming(self):
+        middleware = LogSetupMiddleware(lambda request: StreamingHttpResponse(['ab', 'cde']),
+                                        access_log='testapp.access')
+        response = middleware(self.factory.get('/stream/'))
+        self.assertEqual(self.handler.records, [])
+        self.assertEqual(b''.join(response.streaming_content), b'abcde')
+        record, = self.handler.records
+        self.assertEqual(record.response_bytes, 5)
+        self.assertEqual(record.path_info, '/stream/')
+
+
+@skipIf(ExitStack is None, 'Requires Python 3')
+@override_settings(REQUESTLOGGING_DB_QUERIES=True)
+class QueryStatsTest(TestCase):
+
+    def setUp(self, *args, **kwargs):
+        super(QueryStatsTest, self).setUp(*args, **kwargs)
+        self.factory = RequestFactory()
+        self.handler = ListHandler()
+        self.handler.addFilter(RequestFilter())
+        self.logger = logging.getLogger('testapp.queries')
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.INFO)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+
+    def view(self, request):
+        self.logger.info('before')
+        User.objects.create(username='queries')
+        list(User.objects.filter(pk__in=[1, 2, 3]))
+        self.logger.info('after')
+        return HttpResponse('')
+
+    def test_fields(self):
+        LogSetupMiddleware(self.view, access_log='testapp.queries')(self.factory.get('/queries/'))
+        before, after, access = self.handler.records
+        self.assertEqual((before.db_queries, before.db_time_ms), (0, 0))
+        self.assertGreaterEqual(after.db_queries, 2)
+        self.assertGreater(after.db_time_ms, 0)
+        self.assertEqual(access.db_queries, after.db_queries)
+        self.assertGreaterEqual(access.db_time_ms, access.db_slowest_ms)
+        self.assertGreater(access.db_slowest_ms, 0)
+        self.assertNotEqual(access.db_slowest_sql, '-')
+
+    def test_unwrapped_after_response(self):
+        request = self.factory.get('/queries/')
+        LogSetupMiddleware(self.view)(request)
+        count = request.logging_queries.count
+        self.assertFalse(connection.execute_wrappers)
+        User.objects.count()
+        self.assertEqual(request.logging_queries.count, count)
+
+    def test_field_names(self):
+        self.assertEqual(request_field_names(), REQUEST_FIELDS + ('db_queries', 'db_time_ms'))
+        record = logging.makeLogRecord({})
+        RequestFilter().filter(record)
+        self.assertEqual(record.db_queries, '-')
+        with override_settings(REQUESTLOGGING_DB_QUERIES=False):
+            self.assertEqual(request_field_names(), REQUEST_FIELDS)
+            self.assertFalse(LogSetupMiddleware().db_queries)
+
+    def test_disabled_without_middleware(self):
+        # Requests bound without the middleware have no counts
+        record = logging.makeLogRecord({})
+        RequestFilter(self.factory.get('/')).filter(record)
+        self.assertFalse(hasattr(record, 'db_queries'))
+
+    def test_stats(self):
+        stats = QueryStats()
+        self.assertEqual(stats.slowest_sql, '-')
+        calls = []
+        self.assertEqual(stats(lambda *args: calls.append(args) or 'result', 'SELECT 1', (), False, {}), 'result')
+        self.assertEqual(calls, [('SELECT 1', (), False, {})])
+        self.assertEqual(stats.count, 1)
+        self.assertEqual(stats.slowest_sql, 'SELECT %s')
+
+    def test_normalize_sql(self):
+        self.assertEqual(
+            normalize_sql("SELECT  a1 FROM t\n WHERE id IN (%s, %s,%s) AND name = 'it''s' AND n > 2.5"),
+            "SELECT a1 FROM t WHERE id IN (%s, ...) AND name = %s AND n > %s",
+        )
+
+
+@skipIf(RequestBufferHandler is None, 'Requires Python 3')
+class RequestBufferHandlerTest(TestCase):
+
+    def setUp(self, *args, **kwargs):
+        super(RequestBufferHandlerTest, self).setUp(*args, **kwargs)
+        self.factory = RequestFactory()
+        self.target = ListHandler()
+        self.logger = logging.getLogger('testapp.buffered')
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+        self.addCleanup(setattr, self.logger, 'propagate', True)
+        self.addCleanup(self.logger.setLevel, logging.NOTSET)
+
+    def handler(self, **kwargs):
+        handler = RequestBufferHandler([self.target], **kwargs)
+        handler.addFilter(RequestFilter())
+        self.logger.addHandler(handler)
+        self.addCleanup(self.logger.removeHandler, handler)
+        return handler
+
+    def view(self, status=200, error=False):
+        def view(request):
+            self.logger.debug('debug')
+            self.logger.info('info')
+            self.assertEqual(self.target.records, [])
+            if error:
+                raise ValueError('failed')
+            return HttpResponse(status=status)
+        return view
+
+    def messages(self):
+        return [record.getMessage() for record in self.target.records]
+
+    def test_dict_config(self):
+        # The target is only referenced by name, so must not be collected
+        logger = configure_forwarding(self, {'()': 'django_requestlogging.handlers.RequestBufferHandler'})
+        handler, = logger.handlers
+
+        def view(request):
+            logger.info('buffered')
+            return HttpResponse(status=500)
+        LogSetupMiddleware(view, buffer=True)(self.factory.get('/'))
+        target, = handler.get_handlers()
+        self.assertEqual([record.getMessage() for record in target.records], ['buffered'])
+
+    def test_success(self):
+        self.handler()
+        LogSetupMiddleware(self.view(), buffer=True)(self.factory.get('/buffered/'))
+        self.assertEqual(self.messages(), ['info'])
+        self.assertEqual(self.target.records[0].path_info, '/buffered/')
+
+    def test_server_error(self):
+        self.handler()
+        LogSetupMiddleware(self.view(status=500), buffer=True)(self.factory.get('/'))
+        self.assertEqual(self.messages(), ['debug', 'info'])
+
+    def test_exception(self):
+        self.handler()
+        middleware = LogSetupMiddleware(self.view(error=True), buffer=True)
+        request = self.factory.get('/failed/')
+        middleware.process_request(request)
+        with self.assertRaises(ValueError):
+            middleware.get_response(request)
+        middleware.process_exception(request, ValueError())
+        self.assertEqual(self.messages(), ['debug', 'info'])
+        self.assertEqual(self.target.records[0].path_info, '/failed/')
+        middleware.process_response(request, HttpResponse(status=500))
+        self.assertEqual(len(self.target.records), 2)
+
+    def test_flush_level(self):
+        self.handler()
+
+        def view(request):
+            self.logger.debug('debug')
+            self.logger.error('error')
+            return HttpResponse()
+
+        LogSetupMiddleware(view, buffer=True)(self.factory.get('/'))
+        self.assertEqual(self.messages(), ['debug', 'error'])
+
+    def test_latency(self):
+        self.handler(latency_ms=0)
+        LogSetupMiddleware(self.view(), buffer=True)(self.factory.get('/'))
+        self.assertEqual(self.messages(), ['debug', 'info'])
+
+    def test_combine(self):
+        self.handler(combine=True)
+        LogSetupMiddleware(self.view(status=503), buffer=True)(self.factory.get('/combined/'))
+        record, = self.target.records
+        self.assertEqual(record.getMessage(), '2 records')
+        self.assertEqual(record.levelno, logging.INFO)
+        self.assertEqual(record.path_info, '/combined/')
+        self.assertEqual([event['message'] for event in record.records], ['debug', 'info'])
+        self.assertEqual(record.records[0]['levelname'], 'DEBUG')
+
+    def test_outside_request(self):
+        self.handler()
+        self.logger.debug('debug')
+        self.assertEqual(self.messages(), ['debug'])
+
+    def test_disabled(self):
+        self.handler()
+        self.assertFalse(LogSetupMiddleware().buffer)
+        LogSetupMiddleware(lambda request: self.logger.debug('debug') or HttpResponse(),
+                           buffer=False)(self.factory.get('/'))
+        self.assertEqual(self.messages(), ['debug'])
+
+    @override_settings(REQUESTLOGGING_BUFFER=True)
+    def test_setting(self):
+        self.assertTrue(LogSetupMiddleware().buffer)
+
+
+class ChecksTest(TestCase):
+
+    def setUp(self, *args, **kwargs):
+        super(ChecksTest, self).setUp(*args, **kwargs)
+        self.logger = logging.getLogger('testapp.checks')
+        self.addCleanup(logging.Logger.manager.loggerDict.pop, 'testapp.checks', None)
+
+    def handler(self, name, fmt='%(path_info)s %(message)s', style='%'):
+        handler = logging.Handler()
+        handler.name = name
+        if six.PY3:
+            handler.setFormatter(logging.Formatter(fmt, style=style))
+        else:
+            handler.setFormatter(logging.Formatter(fmt))
+        self.logger.addHandler(handler)
+        self.addCleanup(handler.close)
+        self.addCleanup(self.logger.removeHandler, handler)
+        return handler
+
+    def warned(self):
+        return [warning.obj for warning in check_request_fields()
+                if warning.obj in ('unfiltered', 'filtered', 'target', 'plain', 'braces')]
+
+    def test_app_config(self):
+        self.assertIsInstance(apps.get_app_config('django_requestlogging'), RequestLoggingConfig)
+
+    def test_unfiltered_handler(self):
+        self.handler('unfiltered')
+        self.handler('plain', fmt='%(message)s')
+        warning, = [w for w in check_request_fields() if w.obj == 'unfiltered']
+        self.assertEqual(warning.id, 'django_requestlogging.W001')
+        self.assertIn('path_info', warning.msg)
+        self.assertEqual(self.warned(), ['unfiltered'])
+
+    @skipIf(six.PY2, 'Requires Python 3')
+    def test_format_styles(self):
+        self.handler('braces', fmt='{username} {message}', style='{')
+        self.assertEqual(self.warned(), ['braces'])
+
+    def test_filtered(self):
+        self.handler('filtered').addFilter(RequestFilter())
+        self.assertEqual(self.warned(), [])
+
+    def test_filtered_logger(self):
+        self.handler('unfiltered')
+        self.logger.addFilter(RequestFilter())
+        self.addCleanup(setattr, self.logger, 'filters', [])
+        self.assertEqual(self.warned(), [])
+
+    @skipIf(QueueHandler is None, 'Requires Python 3')
+    def test_target_handler(self):
+        target = self.handler('target')
+        self.logger.removeHandler(target)
+        queue_handler = QueueHandler([target])
+        queue_handler.addFilter(RequestFilter())
+        self.addCleanup(queue_handler.close)
+        self.logger.addHandler(queue_handler)
+        self.addCleanup(self.logger.removeHandler, queue_handler)
+        self.assertEqual(self.warned(), [])
+
+    def test_build_filterer_index(self):
+        self.logger.addFilter(RequestFilter())
+        self.addCleanup(setattr, self.logger, 'filters', [])
+        invalidate_filterer_index()
+        filterers = build_filterer_index()
+        self.assertIn(self.logger, filterers)
+        self.assertIs(LogSetupMiddleware().find_filterers_with_filter(RequestFilter), filterers)
+        # Modules imported later create loggers without invalidating it
+        logging.getLogger('testapp.lazily_imported')
+        self.addCleanup(logging.Logger.manager.loggerDict.pop, 'testapp.lazily_imported', None)
+        self.assertIs(LogSetupMiddleware().find_filterers_with_filter(RequestFilter), filterers)
+
+    def test_ready(self):
+        # Loading the app neither installs the record factory nor scans
+        # for filterers unless the binding uses them
+        import django_requestlogging.middleware
+        config = apps.get_app_config('django_requestlogging')
+        factory = logging.getLogRecordFactory() if hasattr(logging, 'getLogRecordFactory') else None
+        for binding in ('context', 'factory'):
+            with override_settings(REQUESTLOGGING_BINDING=binding):
+                invalidate_filterer_index()
+                config.ready()
+                self.assertNotEqual(django_requestlogging.middleware._filterer_index[0], logging_config_key())
+        if factory is not None:
+            self.assertIs(logging.getLogRecordFactory(), factory)
+        with override_settings(REQUESTLOGGING_BINDING='filters'):
+            config.ready()
+        self.assertEqual(django_requestlogging.middleware._filterer_index[0], logging_config_key())
+
+
+@override_settings(REQUESTLOGGING_METRICS=True)
+class MetricsTest(TestCase):
+
+    def setUp(self, *args, **kwargs):
+        super(MetricsTest, self).setUp(*args, **kwargs)
+        self.factory = RequestFactory()
+        self.logger = logging.getLogger('testapp.metrics')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.handler = ListHandler()
+        self.logger.addHandler(self.handler)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+        self.addCleanup(setattr, self.logger, 'propagate', True)
+        self.addCleanup(logging.Logger.manager.loggerDict.pop, 'testapp.metrics', None)
+
+    def test_disabled(self):
+        with override_settings(REQUESTLOGGING_METRICS=False):
+            self.assertIsNone(get_metrics())
+            self.assertIsNone(RequestFilter().metrics)
+            self.assertIsNone(LogSetupMiddleware().metrics)
+            self.assertEqual(metrics_view(self.factory.get('/metrics')).status_code, 404)
+
+    def test_request(self):
+        # Stacked filters: one on the logger, one on its handler
+        self.logger.addFilter(RequestFilter())
+        self.addCleanup(setattr, self.logger, 'filters', [])
+        self.handler.addFilter(RequestFilter())
+
+        def view(request):
+            for i in range(3):
+                self.logger.info('line %d', i)
+            return HttpResponse()
+
+        LogSetupMiddleware(view)(self.factory.get('/'))
+        metrics = get_metrics()
+        self.assertEqual(metrics.filter_calls.value, 6)
+        self.assertEqual(metrics.records.value, 3)
+        self.assertEqual(metrics.bind_seconds.count, 1)
+        self.assertEqual(metrics.unbind_seconds.count, 1)
+        records = metrics.registry.collect()['requestlogging_records_per_request']
+        self.assertEqual(records['count'], 1)
+        self.assertEqual(records['sum'], 3)
+        self.assertEqual(records['buckets']['2'], 0)
+        self.assertEqual(records['buckets']['5'], 1)
+
+    def test_histogram(self):
+        histogram = Histogram('test', 'A test.', buckets=(1, 10))
+        for value in (0.5, 1, 5, 50):
+            histogram.observe(value)
+        self.assertEqual(list(histogram.samples()), [
+            ('test_bucket', {'le': '1'}, 2),
+            ('test_bucket', {'le': '10'}, 3),
+            ('test_bucket', {'le': '+Inf'}, 4),
+            ('test_count', {}, 4),
+            ('test_sum', {}, 56.5),
+        ])
+
+    @skipIf(QueueHandler is None, 'Requires Python 3')
+    def test_queue_handler(self):
+        handler = QueueHandler([self.handler], maxsize=1, policy='drop_newest')
+        handler.name = 'metrics_queue'
+        self.addCleanup(handler.close)
+        # No listener, so records stay queued
+        handler.listener = object()
+        self.addCleanup(setattr, handler, 'listener', None)
+        for _ in range(3):
+            handler.handle(logging.makeLogRecord({'msg': 'queued'}))
+        text = metrics_view(self.factory.get('/metrics')).content.decode('utf-8')
+        self.assertIn('# TYPE requestlogging_queue_depth gauge\n', text)
+        self.assertIn('requestlogging_queue_depth{handler="metrics_queue"} 1\n', text)
+        self.assertIn('requestlogging_queue_dropped_total{handler="metrics_queue"} 2\n', text)
+        self.assertIn('# TYPE requestlogging_bind_seconds histogram\n', text)
+
+
+@skipIf(CoalescingHandler is None, 'Requires Python 3')
+class CoalescingHandlerTest(TestCase):
+
+    def setUp(self, *args, **kwargs):
+        super(CoalescingHandlerTest, self).setUp(*args, **kwargs)
+        self.factory = RequestFactory()
+        self.target = ListHandler()
+        self.logger = logging.getLogger('testapp.coalescing')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.addCleanup(setattr, self.logger, 'propagate', True)
+        self.addCleanup(logging.Logger.manager.loggerDict.pop, 'testapp.coalescing', None)
+
+    def handler(self, **kwargs):
+        handler = CoalescingHandler([self.target], **kwargs)
+        handler.addFilter(RequestFilter())
+        self.logger.addHandler(handler)
+        self.addCleanup(handler.close)
+        self.addCleanup(self.logger.removeHandler, handler)
+        return handler
+
+    def record(self, msg, created, *args):
+        return logging.makeLogRecord({'name': 'testapp.coalescing', 'msg': msg, 'args': args,
+                                      'created': created, 'levelno': logging.INFO, 'levelname': 'INFO'})
+
+    def messages(self):
+        return [record.getMessage() for record in self.target.records]
+
+    def test_structured_messages(self):
+        handler = self.handler()
+        handler.handle(self.record({'event': 'x'}, 1))
+        handler.handle(self.record({'event': 'x'}, 2))
+        self.assertEqual(self.messages(), ["{'event': 'x'}", "{'event': 'x'}"])
+
+    def test_dict_config(self):
+        # The target is only referenced by name, so must not be collected
+        logger = configure_forwarding(self, {'()': 'django_requestlogging.handlers.CoalescingHandler'})
+        handler, = logger.handlers
+        logger.info('configured')
+        target, = handler.get_handlers()
+        self.assertEqual([record.getMessage() for record in target.records], ['configured'])
+
+    def test_request(self):
+        self.handler()
+
+        def view(request):
+            for i in range(100):
+                self.logger.info('retry %d', i)
+            self.logger.warning('retry %d', 0)
+            self.assertEqual(self.messages(), ['retry 0', 'retry 0'])
+            return HttpResponse()
+
+        LogSetupMiddleware(view)(self.factory.get('/coalesce/'))
+        self.assertEqual(self.messages(), ['retry 0', 'retry 0', 'retry 99 [repeated 99 more times]'])
+        summary = self.target.records[-1]
+        self.assertEqual(summary.coalesced, 99)
+        self.assertEqual(summary.path_info, '/coalesce/')
+        self.assertLessEqual(summary.first_created, summary.last_created)
+        # A new request starts new runs
+        self.target.records = []
+        LogSetupMiddleware(view)(self.factory.get('/coalesce/'))
+        self.assertEqual(len(self.target.records), 3)
+
+    def test_window(self):
+        handler = self.handler(window=10)
+        for created in (100, 101, 102):
+            handler.handle(self.record('tick %s', created, created))
+        self.assertEqual(self.messages(), ['tick 100'])
+        handler.handle(self.record('tick %s', 111, 111))
+        self.assertEqual(self.messages(), ['tick 100', 'tick 102 [repeated 2 more times]', 'tick 111'])
+        summary = self.target.records[1]
+        self.assertEqual((summary.first_created, summary.last_created), (101, 102))
+
+    def test_window_expires_other_runs(self):
+        handler = self.handler(window=10)
+        handler.handle(self.record('a', 100))
+        handler.handle(self.record('a', 101))
+        handler.handle(self.record('b', 120))
+        self.assertEqual(self.messages(), ['a', 'a [repeated 1 more times]', 'b'])
+
+    def test_max_keys(self):
+        handler = self.handler(window=60, max_keys=2)
+        for msg in ('a', 'a', 'b', 'c'):
+            handler.handle(self.record(msg, 100))
+        self.assertEqual(len(handler.runs), 2)
+        self.assertEqual(self.messages(), ['a', 'b', 'a [repeated 1 more times]', 'c'])
+
+    def test_flush(self):
+        handler = self.handler(window=60)
+        handler.handle(self.record('a', 100))
+        handler.handle(self.record('a', 100))
+        handler.flush()
+        self.assertEqual(self.messages(), ['a', 'a [repeated 1 more times]'])
+        self.assertEqual(len(handler.runs), 0)
+
+
+@skipIf(SegmentFileHandler is None, 'Requires Python 3')
+class SegmentFileHandlerTest(TestCase):
+
+    def setUp(self, *args, **kwargs):
+        super(SegmentFileHandlerTest, self).setUp(*args, **kwargs)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def handler(self, **kwargs):
+        handler = SegmentFileHandler(self.directory, **kwargs)
+        handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        self.addCleanup(handler.close)
+        return handler
+
+    def record(self, msg, created, level=logging.INFO):
+        return logging.makeLogRecord({'msg': msg, 'created': created, 'levelno': level,
+                                      'levelname': logging.getLevelName(level)})
+
+    def segments(self):
+        return sorted(os.listdir(self.directory))
+
+    def read(self, name):
+        with open(os.path.join(self.directory, name), 'rb') as f:
+            return f.read()
+
+    def test_buffering(self):
+        handler = self.handler(buffer_size=1024, flush_interval=60)
+        handler.handle(self.record('one', 1500000000.5))
+        name = 'requests-20170714-%d.log' % os.getpid()
+        self.assertEqual(self.segments(), [name])
+        self.assertEqual(self.read(name), b'')
+        handler.handle(self.record('two\nlines', 1500000001.25, logging.ERROR))
+        self.assertEqual(self.read(name), b'1500000000.500000\tINFO one\n'
+                                          b'1500000001.250000\tERROR two\n\tlines\n')
+        handler.handle(self.record('three', 1500000002))
+        handler.flush()
+        self.assertTrue(self.read(name).endswith(b'\tINFO three\n'))
+
+    def test_idle_flush(self):
+        handler = self.handler(flush_interval=0.1)
+        handler.handle(self.record('idle', 1500000000))
+        name = 'requests-20170714-%d.log' % os.getpid()
+        deadline = time.time() + 5
+        while not self.read(name) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.read(name), b'1500000000.000000\tINFO idle\n')
+
+    def test_daily_segments(self):
+        handler = self.handler(flush_interval=0)
+        handler.handle(self.record('today', 1500000000))
+        handler.handle(self.record('tomorrow', 1500000000 + 86400))
+        self.assertEqual([name.split('-')[1] for name in self.segments()], ['20170714', '20170715'])
+
+    def test_ordered(self):
+        # A record created earlier but handed over later, by another thread
+        handler = self.handler(flush_interval=0)
+        handler.handle(self.record('later', 1500000001))
+        handler.handle(self.record('earlier', 1500000000.5))
+        name, = self.segments()
+        self.assertEqual(self.read(name), b'1500000001.000000\tINFO later\n'
+                                          b'1500000001.000000\tINFO earlier\n')
+
+    def test_fork(self):
+        handler = self.handler(flush_interval=60)
+        handler.handle(self.record('parent', 1500000000))
+        # Pretend this process was forked after the record was logged
+        handler.pid = -1
+        handler.handle(self.record('child', 1500000001))
+        handler.flush()
+        name, = self.segments()
+        self.assertEqual(self.read(name), b'1500000001.000000\tINFO child\n')
+
+    def test_merge(self):
+        paths = []
+        for pid, entries in enumerate([[(3, 'c'), (5, 'e\ntraceback')], [(1, 'a'), (3, 'd'), (4, 'd2')], []]):
+            path = os.path.join(self.directory, 'requests-20170714-%d.log' % pid)
+            with open(path, 'wb') as f:
+                f.write(''.join(encode_entry(created, text) for created, text in entries).encode('utf-8'))
+            paths.append(path)
+        output = six.BytesIO()
+        self.assertEqual(merge_segment_files(paths, output), 5)
+        self.assertEqual(output.getvalue(), b'a\nc\nd\nd2\ne\ntraceback\n')
+
+        # Other files in the directory, such as an earlier merge, are skipped
+        with open(os.path.join(self.directory, 'merged.log'), 'wb') as f:
+            f.write(b'0.000000\tstale\n')
+        merged = os.path.join(self.directory, 'merged.txt')
+        call_command('merge_log_segments', self.directory, output=merged, timestamps=True, verbosity=0)
+        with open(merged, 'rb') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0], b'1.000000\ta')
+        self.assertEqual(lines[-1], b'\ttraceback')
+        output = six.BytesIO()
+        self.assertEqual(merge_segment_files([self.directory], output, prefix='merged'), 0)
+
+    def test_read_entries_torn_lines(self):
+        stream = six.BytesIO(b'garbage\n1.5\tone\npartial li')
+        self.assertEqual(list(read_entries(stream)), [(0.0, [b'garbage\n']), (1.5, [b'1.5\tone\n', b'partial li'])])
+
+
+@skipIf(CompressingRotatingFileHandler is None, 'Requires Python 3')
+class CompressingRotatingFileHandlerTest(TestCase):
+
+    def setUp(self, *args, **kwargs):
+        super(CompressingRotatingFileHandlerTest, self).setUp(*args, **kwargs)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.filename = os.path.join(self.directory, 'requests.log')
+
+    def handler(self, **kwargs):
+        handler = CompressingRotatingFileHandler(self.filename, **kwargs)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.addCleanup(handler.close)
+        return handler
+
+    def log(self, handler, *messages):
+        for message in messages:
+            handler.handle(logging.makeLogRecord({'msg': message, 'levelno': logging.INFO}))
+
+    def rotated(self):
+        return sorted(name for name in os.listdir(self.directory) if name != 'requests.log')
+
+    def read_gzip(self, name):
+        with gzip.open(os.path.join(self.directory, name), 'rb') as f:
+            return f.read()
+
+    def test_rotation(self):
+        handler = self.handler(max_bytes=10, buffer_size=1)
+        self.log(handler, 'aaaa', 'bbbb', 'cccc', 'dddd', 'eeee')
+        handler.close()
+        names = self.rotated()
+        self.assertEqual(len(names), 2)
+        self.assertTrue(all(name.startswith('requests.log.') and name.endswith('.gz') for name in names))
+        self.assertEqual([self.read_gzip(name) for name in names], [b'aaaa\nbbbb\n', b'cccc\ndddd\n'])
+        with open(self.filename, 'rb') as f:
+            self.assertEqual(f.read(), b'eeee\n')
+
+    def test_idle_flush(self):
+        handler = self.handler(flush_interval=0.1)
+        self.log(handler, 'idle')
+        deadline = time.time() + 5
+        while not os.path.getsize(self.filename) and time.time() < deadline:
+            time.sleep(0.01)
+        with open(self.filename, 'rb') as f:
+            self.assertEqual(f.read(), b'idle\n')
+
+    def test_buffered_records_count(self):
+        # Records still in the buffer count towards max_bytes
+        handler = self.handler(max_bytes=10, flush_interval=60)
+        self.log(handler, 'aaaa', 'bbbb', 'cccc')
+        handler.close()
+        name, = self.rotated()
+        self.assertEqual(self.read_gzip(name), b'aaaa\nbbbb\n')
+
+    def test_backup_count(self):
+        handler = self.handler(max_bytes=5, buffer_size=1, backup_count=2)
+        self.log(handler, 'aaaa', 'bbbb', 'cccc', 'dddd', 'eeee')
+        handler.close()
+        self.assertEqual([self.read_gzip(name) for name in self.rotated()], [b'cccc\n', b'dddd\n'])
+
+    def test_uncompressed(self):
+        handler = self.handler(max_bytes=5, buffer_size=1, compression=None)
+        self.log(handler, 'aaaa', 'bbbb')
+        handler.close()
+        name, = self.rotated()
+        with open(os.path.join(self.directory, name), 'rb') as f:
+            self.assertEqual(f.read(), b'aaaa\n')
+
+    def test_leftovers(self):
+        # Files rotated by a process that stopped before compressing them
+        with open(self.filename + '.20170714T000000.000000', 'wb') as f:
+            f.write(b'left over\n')
+        with open(self.filename + '.20170714T000000.000001.gz.tmp', 'wb') as f:
+            f.write(b'torn')
+        self.handler().close()
+        self.assertEqual(self.rotated(), ['requests.log.20170714T000000.000000.gz'])
+        self.assertEqual(self.read_gzip(self.rotated()[0]), b'left over\n')
+
+    def test_unrelated_files(self):
+        # Only the names rotate() produces are compressed or pruned
+        for name in ('requests.log.bak', 'requests.log.lock'):
+            with open(os.path.join(self.directory, name), 'wb') as f:
+                f.write(b'keep\n')
+        handler = self.handler(max_bytes=5, buffer_size=1, backup_count=1)
+        self.log(handler, 'aaaa', 'bbbb', 'cccc')
+        handler.close()
+        name, bak, lock = self.rotated()
+        self.assertEqual((bak, lock), ('requests.log.bak', 'requests.log.lock'))
+        self.assertEqual(self.read_gzip(name), b'bbbb\n')
+
+    def test_compression(self):
+        with self.assertRaises(ValueError):
+            CompressingRotatingFileHandler(self.filename, compression='bzip2')
+
+
+@skipIf(BatchingSocketHandler is None, 'Requires Python 3')
+class BatchingSocketHandlerTest(TestCase):
+
+    def setUp(self, *args, **kwargs):
+        super(BatchingSocketHandlerTest, self).setUp(*args, **kwargs)
+        self.collector = FakeCollector()
+        self.addCleanup(lambda: self.collector.stop())
+
+    def handler(self, **kwargs):
+        kwargs.setdefault('flush_interval', 0.05)
+        handler = BatchingSocketHandler('127.0.0.1', self.collector.port, **kwargs)
+        handler.setFormatter(JSONFormatter(fields=['levelname', 'message']))
+        self.addCleanup(handler.close)
+        return handler
+
+    def record(self, msg, level=logging.INFO):
+        return logging.makeLogRecord({'msg': msg, 'levelno': level, 'levelname': logging.getLevelName(level)})
+
+    def test_frames(self):
+        stream = six.BytesIO(encode_frame(b'[1]') + encode_frame(b'[]') + encode_frame(b'[2, 3]')[:-1])
+        self.assertEqual(list(iter_frames(stream)), [b'[1]', b'[]'])
+
+    def test_batching(self):
+        handler = self.handler(batch_size=3, flush_interval=60)
+        for i in range(7):
+            handler.handle(self.record('message %d' % i))
+        self.assertTrue(self.collector.wait_for(6))
+        self.assertEqual(len(self.collector.frames), 2)
+        # close() sends what is left without waiting for the interval
+        handler.close()
+        self.assertTrue(self.collector.wait_for(7))
+        self.assertEqual(self.collector.records[-1], {'levelname': 'INFO', 'message': 'message 6'})
+        self.assertEqual([json.loads(frame.decode('utf-8'))[0]['message'] for frame in self.collector.frames],
+                         ['message 0', 'message 3', 'message 6'])
+
+    def test_request_fields(self):
+        handler = self.handler()
+        handler.setFormatter(JSONFormatter(fields=['message', 'request_method', 'path_info']))
+        handler.addFilter(RequestFilter())
+        request = RequestFactory().get('/collected')
+        set_current_request(request)
+        try:
+            handler.handle(self.record('in a request'))
+        finally:
+            set_current_request(None)
+        self.assertTrue(self.collector.wait_for(1))
+        self.assertEqual(self.collector.records,
+                         [{'message': 'in a request', 'request_method': 'GET', 'path_info': '/collected'}])
+
+    def test_spill_and_replay(self):
+        spill_path = os.path.join(tempfile.mkdtemp(), 'spill')
+        self.addCleanup(shutil.rmtree, os.path.dirname(spill_path))
+        handler = self.handler(spill_path=spill_path, backoff=(0.01, 0.01))
+        handler.handle(self.record('before'))
+        self.assertTrue(self.collector.wait_for(1))
+
+        port = self.collector.port
+        self.collector.stop()
+        handler.handle(self.record('while down'))
+        handler.handle(self.record('still down'))
+        deadline = time.time() + 5
+        while not os.path.exists(spill_path) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(os.path.exists(spill_path))
+
+        self.collector = FakeCollector(port)
+        handler.handle(self.record('after'))
+        self.assertTrue(self.collector.wait_for(3))
+        self.assertEqual([record['message'] for record in self.collector.records],
+                         ['while down', 'still down', 'after'])
+        self.assertFalse(os.path.exists(spill_path))
+        self.assertEqual(handler.dropped, 0)
+
+    def test_drops_without_spill(self):
+        self.collector.stop()
+        handler = self.handler(backoff=(60, 60))
+        handler.handle(self.record('lost'))
+        handler.close()
+        self.assertEqual(handler.dropped, 1)
+
+    def test_prepare(self):
+        handler = self.handler(flush_interval=60)
+        state = {'v': 1}
+        try:
+            raise ValueError('failed')
+        except ValueError:
+            record = logging.makeLogRecord({'msg': 'state %s', 'args': (state,), 'levelno': logging.ERROR,
+                                            'levelname': 'ERROR', 'exc_info': sys.exc_info()})
+        handler.handle(record)
+        state['v'] = 2
+        handler.close()
+        self.assertTrue(self.collector.wait_for(1))
+        sent, = self.collector.records
+        self.assertEqual(sent['message'], "state {'v': 1}")
+        self.assertIn('ValueError: failed', sent['exc_info'])
+        # The caller's record is left alone
+        self.assertEqual(record.args, (state,))
+        self.assertIsNotNone(record.exc_info)
+
+    def test_full_queue(self):
+        handler = self.handler(maxsize=1)
+        # Without starting the thread, nothing takes from the queue
+        handler.thread = object()
+        handler.handle(self.record('queued'))
+        handler.handle(self.record('dropped'))
+        self.assertEqual(handler.dropped, 1)
+        handler.thread = None
+
+
+class AnalyticsTest(TestCase):
+
+    def setUp(self, *args, **kwargs):
+        super(AnalyticsTest, self).setUp(*args, **kwargs)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'requests.jsonl')
+        formatter = JSONFormatter(fields=['levelname', 'request_method', 'path_info', 'remote_addr',
+                                          'status_code', 'duration_ms'])
+        with open(self.path, 'wb') as f:
+            for i in range(1000):
+                record = logging.makeLogRecord({
+                    'levelname': 'INFO', 'request_method': 'GET', 'path_info': '/a/' if i % 4 else '/b/',
+                    'remote_addr': '10.0.0.%d' % (i % 3), 'status_code': 500 if i % 10 == 0 else 200,
+                    'duration_ms': float(i + 1),
+                })
+                f.write(formatter.format(record).encode('utf-8') + b'\n')
+            f.write(b'not json\n')
+
+    def test_analyze(self):
+        stats = analyze([self.path])
+        report = stats.as_dict(percentiles=(50, 100))
+        self.assertEqual(report['records'], 1000)
+        self.assertEqual(report['skipped'], 1)
+        a, b = report['endpoints']
+        self.assertEqual((a['endpoint'], a['count'], b['endpoint'], b['count']), ('GET /a/', 750, 'GET /b/', 250))
+        # Every fourth request is to /b/, and every tenth one failed
+        self.assertEqual(b['errors'], 50)
+        self.assertAlmostEqual(a['error_rate'], 50 / 750.0)
+        self.assertAlmostEqual(a['p100_ms'], 1000, delta=1000 * 0.01)
+        self.assertAlmostEqual(b['p50_ms'], 501, delta=501 * 0.01 + 4)
+        self.assertEqual(report['remote_addrs'][0], {'remote_addr': '10.0.0.0', 'count': 334})
+
+    def test_processes(self):
+        expected = analyze([self.path]).as_dict()
+        self.assertEqual(analyze([self.path], processes=3).as_dict(), expected)
+
+    def test_byte_ranges(self):
+        size = os.path.getsize(self.path)
+        lines = []
+        for start, end in split_ranges(self.path, 7):
+            lines.extend(iter_lines(self.path, start, end))
+        self.assertEqual(sum(map(len, lines)), size)
+        self.assertEqual(len(lines), 1001)
+
+    def test_format_string(self):
+        fmt = '%(remote_addr)s "%(request_method)s %(path_info)s" %(status_code)d %(duration_ms).1f %(message)s'
+        lines = [b'1.2.3.4 "GET /x/" 200 12.5 hello world\n', b'1.2.3.4 "POST /x/" 503 3.0 oops\n', b'junk\n']
+        stats = analyze_lines(lines, format_parser(fmt))
+        report = stats.as_dict(percentiles=(50,))
+        self.assertEqual(report['skipped'], 1)
+        self.assertEqual([e['endpoint'] for e in report['endpoints']], ['GET /x/', 'POST /x/'])
+        self.assertEqual(report['endpoints'][1]['errors'], 1)
+        self.assertAlmostEqual(report['endpoints'][0]['p50_ms'], 12.5, delta=0.2)
+
+    def test_mixed(self):
+        # An application log: each request logs lines of its own, then
+        # its access record
+        stats = Stats()
+        for i in range(10):
+            fields = {'request_method': 'GET', 'path_info': '/mixed/', 'remote_addr': '10.0.0.1'}
+            stats.add(dict(fields, levelname='INFO'))
+            stats.add(dict(fields, levelname='ERROR' if i == 0 else 'INFO'))
+            stats.add(dict(fields, levelname='INFO', status_code=500 if i < 2 else 200, duration_ms=i))
+        report = stats.as_dict()
+        self.assertEqual(report['records'], 30)
+        endpoint, = report['endpoints']
+        self.assertEqual((endpoint['count'], endpoint['errors']), (10, 2))
+        self.assertAlmostEqual(endpoint['error_rate'], 0.2)
+        self.assertEqual(report['remote_addrs'], [{'remote_addr': '10.0.0.1', 'count': 10}])
+        # Merged from processes that only saw some of the access records
+        merged = Stats()
+        merged.add({'path_info': '/mixed/', 'levelname': 'ERROR'})
+        merged.merge(stats)
+        self.assertEqual(merged.as_dict()['endpoints'][0]['count'], 10)
+
+    def test_bounded(self):
+        stats = Stats(max_endpoints=2, top=2)
+        for i in range(10):
+            stats.add({'path_info': '/%d/' % i, 'remote_addr': str(i)})
+        self.assertEqual(sorted(stats.endpoints), ['(other)', '- /0/', '- /1/'])
+        self.assertEqual(stats.endpoints['(other)'].count, 8)
+        self.assertEqual(len(stats.remote_addrs.counts), 2)
+
+    def test_sketch(self):
+        sketch = Sketch(accuracy=0.01)
+        for value in range(1, 10001):
+            sketch.add(value)
+        for q in (0.1, 0.5, 0.99):
+            self.assertAlmostEqual(sketch.quantile(q), q * 9999 + 1, delta=(q * 9999 + 1) * 0.011)
+
+    def test_command(self):
+        out = six.StringIO()
+        call_command('analyze_request_logs', self.path, '--json', '--top', '1', stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual([e['endpoint'] for e in report['endpoints']], ['GET /a/'])
+        out = six.StringIO()
+        call_command('analyze_request_logs', self.path, stdout=out)
+        self.assertIn('GET /b/', out.getvalue())
+        self.assertIn('p99_ms', out.getvalue())
+
+
 class LoggingMiddlewareInUseTest(TestCase):
 
     def test_views_work_with_middleware_applied(self):